@@ -11,10 +11,203 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import byteplay as bp
+import __builtin__
+import collections
+import opcode
+import threading
 
+import bytecode
+import rewriter
+import suggest
 
-def patch_code(code):
+
+# Version of the instrumentation. It must be changed whenever the patched code
+# changes, as it is part of the key of cached code objects.
+VERSION = '3'
+
+
+# Names of the variables where the operands are stored.
+ATTR_NAME = '_s_attr'
+INDEX_NAME = '_s_index'
+
+# Where the operands are stored.
+# The module globals. This is the default.
+CAPTURE_GLOBALS = 'globals'
+# Fast local slots added to each function. Code which does not use fast locals
+# (module and class bodies, functions using exec) falls back to the globals.
+CAPTURE_LOCALS = 'locals'
+# Attributes of a threading.local object, so concurrent threads never see each
+# other's operands. The object is installed in __builtin__ as THREAD_STATE_NAME.
+# The frames of a thread share its slots, so they are reset to the object itself
+# (see get_thread_operands) instead of deleted, as a nested operation may have
+# reset them already.
+CAPTURE_THREAD = 'thread'
+# A ring with the last RING_SIZE captures of each thread, across frames. It is
+# never cleaned, so the operands of the operations leading to a failure are
+# kept too. The ring is installed in __builtin__ as RING_STATE_NAME.
+CAPTURE_RING = 'ring'
+CAPTURE_MODES = (CAPTURE_GLOBALS, CAPTURE_LOCALS, CAPTURE_THREAD, CAPTURE_RING)
+
+THREAD_STATE_NAME = '_s_tls'
+RING_STATE_NAME = '_s_ring'
+RING_SIZE = 16
+
+# Families of opcodes that can be instrumented.
+ATTRIBUTES = 'attributes'
+SUBSCRIPTS = 'subscripts'
+FAMILIES = (ATTRIBUTES, SUBSCRIPTS)
+
+ATTRIBUTE_OPCODES = (bytecode.LOAD_ATTR, bytecode.STORE_ATTR,
+                     bytecode.DELETE_ATTR)
+SUBSCRIPT_OPCODES = (bytecode.BINARY_SUBSCR, bytecode.STORE_SUBSCR,
+                     bytecode.DELETE_SUBSCR)
+
+# Opcodes which are assumed not to change the attributes of any object, so an
+# attribute loaded before them can be loaded again without failing.
+ATTRIBUTE_PRESERVING_OPCODES = (
+    bytecode.LOAD_FAST, bytecode.LOAD_CONST, bytecode.LOAD_GLOBAL,
+    bytecode.LOAD_NAME, bytecode.LOAD_DEREF, bytecode.LOAD_ATTR,
+    bytecode.STORE_FAST, bytecode.POP_TOP, bytecode.DUP_TOP, bytecode.DUP_TOPX,
+    bytecode.ROT_TWO, bytecode.ROT_THREE, bytecode.ROT_FOUR,
+    bytecode.BUILD_TUPLE, bytecode.BUILD_LIST, rewriter.SetLineno)
+# Opcodes which cannot raise an exception, so the operands of a site followed
+# only by these and then by another site do not need to be cleaned. LOAD_FAST
+# and LOAD_DEREF are not among them, as they raise when the variable is
+# unbound, which would leave the operands behind.
+TRANSPARENT_OPCODES = (bytecode.LOAD_CONST, rewriter.SetLineno)
+
+
+class CodeStats(object):
+    """Statistics of the patching of one code object.
+
+    Sizes are in bytes of bytecode. sites maps each family in FAMILIES to the
+    number of instrumented opcodes, and elided to the number of opcodes of the
+    family left alone because they were proven safe (see get_safe_sites).
+    skipped tells whether the whole code object was left uninstrumented, as
+    requested by the skip function of patch_code.
+    """
+    def __init__(self, name, filename, firstlineno):
+        self.name = name
+        self.filename = filename
+        self.firstlineno = firstlineno
+        self.sites = dict.fromkeys(FAMILIES, 0)
+        self.elided = dict.fromkeys(FAMILIES, 0)
+        self.skipped = False
+        self.original_size = 0
+        self.patched_size = 0
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'filename': self.filename,
+            'firstlineno': self.firstlineno,
+            'sites': dict(self.sites),
+            'elided': dict(self.elided),
+            'skipped': self.skipped,
+            'original_size': self.original_size,
+            'patched_size': self.patched_size,
+        }
+
+
+# First element of the constant holding the suggestion table of a code object
+# (see add_suggestion_tables).
+SUGGESTION_TABLE_MARKER = '_s_suggestions'
+
+BUILTIN_NAMES = frozenset(dir(__builtin__))
+
+# Names bound in the namespace of every module.
+MODULE_ATTRIBUTE_NAMES = frozenset([
+    '__builtins__', '__doc__', '__file__', '__loader__', '__name__',
+    '__package__', '__path__'])
+
+
+def get_code_size(code):
+    """Returns the size in bytes of a list of rewriter.Code instructions.
+
+    EXTENDED_ARG prefixes are not counted.
+    """
+    return sum(3 if op >= opcode.HAVE_ARGUMENT else 1
+               for op, _ in code if rewriter.isopcode(op))
+
+
+def get_thread_state():
+    """Returns the threading.local object used by CAPTURE_THREAD.
+
+    It is created and installed in __builtin__ the first time.
+    """
+    return vars(__builtin__).setdefault(THREAD_STATE_NAME, threading.local())
+
+
+def get_thread_operands():
+    """Returns the operands stored in the thread state by variable name.
+
+    The slots reset by a cleanup are left out.
+    """
+    state = get_thread_state()
+    return dict((name, value) for name, value in vars(state).items()
+                if value is not state)
+
+
+class RingState(threading.local):
+    """The ring of captures of CAPTURE_RING of each thread.
+
+    Each capture is appended as three consecutive entries of ring: the site,
+    a tuple (filename, lineno, opname), the object and the key, which is the
+    name for attribute opcodes. The ring is created full of None and has a
+    maximum length, so appending an entry drops the oldest one and never
+    allocates memory. record is the append method of ring, called by the
+    patched code.
+
+    The ring holds strong references, even after the operations succeed, so
+    it keeps alive up to RING_SIZE objects and keys per thread until they are
+    overwritten or the ring is cleared.
+    """
+    def __init__(self):
+        self.ring = collections.deque([None] * (3 * RING_SIZE), 3 * RING_SIZE)
+        self.record = self.ring.append
+
+    def get_captures(self):
+        """Returns the list of (site, object, key) captured, oldest first."""
+        entries = list(self.ring)
+        return [tuple(entries[i:i + 3]) for i in xrange(0, len(entries), 3)
+                if entries[i] is not None]
+
+    def clear(self):
+        """Drops every capture, releasing the objects and keys."""
+        self.ring.extend([None] * (3 * RING_SIZE))
+
+
+def get_ring_state():
+    """Returns the RingState object used by CAPTURE_RING.
+
+    It is created and installed in __builtin__ the first time.
+    """
+    state = vars(__builtin__).get(RING_STATE_NAME)
+    if state is None:
+        state = vars(__builtin__).setdefault(RING_STATE_NAME, RingState())
+    return state
+
+
+def get_ring_captures():
+    """Returns the captures of the ring of this thread (see RingState).
+
+    The list is empty if CAPTURE_RING was never used.
+    """
+    state = vars(__builtin__).get(RING_STATE_NAME)
+    if state is None:
+        return []
+    return state.get_captures()
+
+
+def clear_ring_captures():
+    """Clears the ring of this thread (see RingState), if it was installed."""
+    state = vars(__builtin__).get(RING_STATE_NAME)
+    if state is not None:
+        state.clear()
+
+
+def patch_code(code, capture=CAPTURE_GLOBALS, families=FAMILIES, stats=None,
+               skip=None):
     """Recursively patches a code object to store variables for later debugging.
 
     This will replace the bytecode as follow:
@@ -42,46 +235,552 @@ def patch_code(code):
      opcode. In this case the exception handling code can analyze the stored
      values and print more useful information to the user.
 
+     When capture is CAPTURE_LOCALS, STORE_FAST and DELETE_FAST are used
+     instead, so the operands live in the frame and not in the module
+     dictionary. When capture is CAPTURE_THREAD, they are stored as
+     attributes of the object returned by get_thread_state (loaded with
+     LOAD_GLOBAL and STORE_ATTR), which needs no locking, and cleaned by
+     storing that object in them.
+     When capture is CAPTURE_RING, the site and the operands are appended to
+     the ring returned by get_ring_state instead, with three calls to its
+     record method, and nothing is cleaned.
+
+     The code of a module also gets the suggestion tables of its global
+     names which may be misspelled (see add_suggestion_tables).
+
+     Only the opcodes of the given families are patched, and sites which
+     cannot fail in an interesting way are skipped (see get_safe_sites). When
+     a site is followed by another one storing the same variables, its cleanup
+     is omitted, as those variables are overwritten anyway.
+
     Args:
       code: a types.CodeType object. It may represent a function, module, etc.
+      capture: one of CAPTURE_MODES.
+      families: a sequence of elements of FAMILIES.
+      stats: if not None, a list to which a CodeStats is appended for code and
+        each of its nested code objects.
+      skip: if not None, a function called with the rewriter.Code of code and
+        of each of its nested code objects, returning whether it must be left
+        uninstrumented. Its nested code objects are still patched.
 
     Returns:
       a new patched code object.
     """
-    f_code = bp.Code.from_code(code)
-    f_code = patch_bp_code(f_code)
+    if capture not in CAPTURE_MODES:
+        raise ValueError('Unknown capture mode: %r' % (capture,))
+    for family in families:
+        if family not in FAMILIES:
+            raise ValueError('Unknown opcode family: %r' % (family,))
+    if capture == CAPTURE_THREAD:
+        get_thread_state()
+    elif capture == CAPTURE_RING:
+        get_ring_state()
+    f_code = rewriter.Code.from_code(code)
+    add_suggestion_tables(f_code)
+    f_code = patch_rewriter_code(f_code, capture, families, stats,
+                                 get_module_names(f_code),
+                                 not f_code.newlocals, skip)
     return f_code.to_code()
 
 
-def patch_bp_code(f_code):
-    """Helper function to patch a bp.Code object.
+def uses_fast_locals(f_code):
+    """Returns whether the rewriter.Code stores its variables in fast slots."""
+    return f_code.newlocals and not any(
+        op in (bytecode.LOAD_NAME, bytecode.STORE_NAME, bytecode.DELETE_NAME)
+        for op, _ in f_code.code)
+
+
+def get_previous_ops(code, index, count):
+    """Returns the count instructions before index, or None.
+
+    None is returned if any of them is a label, as then they may not be the
+    ones executed just before the instruction at index.
+    """
+    if index < count:
+        return None
+    previous = code[index - count:index]
+    if any(isinstance(op, rewriter.Label) for op, _ in previous):
+        return None
+    return previous
+
+
+def iter_codes(f_code):
+    """Yields f_code and its nested rewriter.Code objects."""
+    yield f_code
+    for op, arg in f_code.code:
+        if op == bytecode.LOAD_CONST and isinstance(arg, rewriter.Code):
+            for nested_code in iter_codes(arg):
+                yield nested_code
+
+
+def get_import_names(code, store_ops, rebind_ops):
+    """Returns the names which are only bound by import statements.
 
     Args:
-      f_code: an byteplay.Code object
+      code: a list of rewriter.Code instructions.
+      store_ops: opcodes binding the names of interest.
+      rebind_ops: opcodes binding or deleting those names.
+
+    Returns:
+      a pair of sets (names stored just after IMPORT_NAME, names bound or
+      deleted in any other way).
+    """
+    imported, rebound = set(), set()
+    previous = None
+    for op, arg in code:
+        if op in store_ops and previous == bytecode.IMPORT_NAME:
+            imported.add(arg)
+        elif op in rebind_ops:
+            rebound.add(arg)
+        if op != rewriter.SetLineno:
+            previous = op
+    return imported, rebound
+
+
+def get_constant_locals(f_code):
+    """Returns the locals of f_code only bound to constant sequences.
+
+    Returns:
+      a dictionary from the names of the locals that are only ever assigned
+      constant tuples or strings to the length of the shortest of them.
+    """
+    lengths = {}
+    rebound = set(f_code.args)
+    previous = None
+    for op, arg in f_code.code:
+        if op == bytecode.STORE_FAST:
+            if (previous and previous[0] == bytecode.LOAD_CONST and
+                    isinstance(previous[1], (tuple, basestring))):
+                lengths[arg] = min(lengths.get(arg, len(previous[1])),
+                                   len(previous[1]))
+            else:
+                rebound.add(arg)
+        elif op == bytecode.DELETE_FAST:
+            rebound.add(arg)
+        if op != rewriter.SetLineno:
+            previous = op, arg
+    return dict((name, length) for name, length in lengths.items()
+                if name not in rebound)
+
+
+def get_module_names(f_code):
+    """Returns the global names of a module only ever bound to modules.
+
+    These are the names bound by import statements (import x, import x as y)
+    and never assigned or deleted in any other way, in the module or in any
+    of its functions. Assignments through globals() or setattr on the module
+    are not detected. Nothing is returned for code using exec or import *, or
+    which is not the code of a module.
+    """
+    if f_code.newlocals:
+        return frozenset()
+    imported, rebound = get_import_names(
+        f_code.code, (bytecode.STORE_NAME, bytecode.STORE_GLOBAL),
+        (bytecode.STORE_NAME, bytecode.STORE_GLOBAL, bytecode.DELETE_NAME,
+         bytecode.DELETE_GLOBAL))
+    for nested_code in iter_codes(f_code):
+        if any(op in (bytecode.EXEC_STMT, bytecode.IMPORT_STAR)
+               for op, _ in nested_code.code):
+            return frozenset()
+        if nested_code is not f_code:
+            nested_imported, nested_rebound = get_import_names(
+                nested_code.code, (bytecode.STORE_GLOBAL,),
+                (bytecode.STORE_GLOBAL, bytecode.DELETE_GLOBAL))
+            imported.update(nested_imported)
+            rebound.update(nested_rebound)
+    return frozenset(imported - rebound)
+
+
+def get_global_names(f_code):
+    """Returns the names bound in the global namespace of a module, or None.
+
+    These are the names stored by the module and the ones its functions
+    declare global. None is returned for code using exec or import *, or
+    which is not the code of a module, as then they are not known.
+    """
+    if f_code.newlocals:
+        return None
+    names = set(MODULE_ATTRIBUTE_NAMES)
+    for nested_code in iter_codes(f_code):
+        for op, arg in nested_code.code:
+            if op in (bytecode.EXEC_STMT, bytecode.IMPORT_STAR):
+                return None
+            if op == bytecode.STORE_GLOBAL or (
+                    op == bytecode.STORE_NAME and nested_code is f_code):
+                names.add(arg)
+    return frozenset(names)
+
+
+def get_local_names(f_code):
+    """Returns the names f_code binds in its own scope or its closure."""
+    names = set(f_code.args) | set(f_code.freevars)
+    for op, arg in f_code.code:
+        if op in (bytecode.STORE_FAST, bytecode.STORE_NAME,
+                  bytecode.STORE_DEREF, bytecode.LOAD_CLOSURE):
+            names.add(arg)
+    return names
+
+
+def get_suggestion_table(f_code, global_names):
+    """Returns the suggestions for the names of f_code which may be misspelled.
+
+    These are the names looked up in the global namespace which are neither
+    bound in the module nor builtins, so they raise NameError unless they are
+    bound by other means (for example through globals()). Their suggestions
+    are the similar local, global and builtin names.
+
+    Args:
+      f_code: a rewriter.Code object.
+      global_names: the names bound in the global namespace of the module of
+        f_code (see get_global_names).
+
+    Returns:
+      a tuple of pairs (name, tuple of suggestions), sorted by name.
+    """
+    local_names = get_local_names(f_code)
+    known_names = global_names | BUILTIN_NAMES | local_names
+    unknown_names = set(arg for op, arg in f_code.code
+                        if op in (bytecode.LOAD_GLOBAL, bytecode.LOAD_NAME) and
+                        arg not in known_names)
+    if not unknown_names:
+        return ()
+    index = suggest.SuggestionIndex(
+        sorted(local_names) + sorted(global_names) + sorted(BUILTIN_NAMES))
+    return tuple((name, tuple(index.suggest(name)))
+                 for name in sorted(unknown_names))
+
+
+def add_suggestion_tables(f_code):
+    """Attaches their suggestion tables to a module and its nested code.
+
+    The table of each code object (see get_suggestion_table) is loaded by an
+    unreachable LOAD_CONST appended after its final return, so it is kept in
+    its co_consts (and marshalled with it) without being run. Code objects
+    with nothing to suggest are left unchanged, as is code for which the
+    global names are not known (see get_global_names).
+
+    Args:
+      f_code: a rewriter.Code object. It is modified in place.
+    """
+    global_names = get_global_names(f_code)
+    if global_names is None:
+        return
+    for nested_code in iter_codes(f_code):
+        if (not nested_code.code or
+                nested_code.code[-1][0] not in rewriter.TERMINAL_OPCODES):
+            continue
+        table = get_suggestion_table(nested_code, global_names)
+        if table:
+            nested_code.code.append(
+                (bytecode.LOAD_CONST, (SUGGESTION_TABLE_MARKER,) + table))
+
+
+def find_suggestion_table(code):
+    """Returns the suggestion table attached to a code object, or None.
+
+    Args:
+      code: a types.CodeType object.
+
+    Returns:
+      a dictionary from the names of code which may be misspelled to a tuple
+      with their suggestions, or None if code has no table.
+    """
+    consts = code.co_consts
+    if (consts and isinstance(consts[-1], tuple) and consts[-1] and
+            consts[-1][0] == SUGGESTION_TABLE_MARKER):
+        return dict(consts[-1][1:])
+    return None
+
+
+def get_safe_sites(f_code, module_names=frozenset(), is_module=False):
+    """Returns the indexes of the sites of f_code which need no capture.
+
+    These are:
+      - attribute loads on a module, that is a global name in module_names or
+        a local only bound by import statements. When they fail, the module
+        can still be recovered from the frame (see
+        debug_exception.get_backend_debug_vars);
+      - subscripts of a constant tuple or string, or of a local only bound to
+        those (see get_constant_locals), by a constant index in range, which
+        cannot fail;
+      - attribute loads of a name and attribute already loaded in the same
+        basic block, with only ATTRIBUTE_PRESERVING_OPCODES in between.
+
+    Args:
+      f_code: a rewriter.Code object.
+      module_names: global names bound only to modules (see
+        get_module_names).
+      is_module: whether f_code is the code of the module, so LOAD_NAME is a
+        global lookup.
+    """
+    code = f_code.code
+    global_ops = (bytecode.LOAD_GLOBAL, bytecode.LOAD_NAME) if is_module else (
+        bytecode.LOAD_GLOBAL,)
+    local_modules = set()
+    constant_locals = {}
+    if f_code.newlocals:
+        imported, rebound = get_import_names(
+            code, (bytecode.STORE_FAST,),
+            (bytecode.STORE_FAST, bytecode.DELETE_FAST))
+        local_modules = imported - rebound - set(f_code.args)
+        constant_locals = get_constant_locals(f_code)
+
+    safe_sites = set()
+    loaded = set()
+    for index, (op, arg) in enumerate(code):
+        if op == bytecode.LOAD_ATTR:
+            previous = get_previous_ops(code, index, 1)
+            if previous:
+                base_op, base_name = previous[0]
+                if ((base_op in global_ops and base_name in module_names) or
+                        (base_op == bytecode.LOAD_FAST and
+                         base_name in local_modules) or
+                        (base_op, base_name, arg) in loaded):
+                    safe_sites.add(index)
+                if base_op in (bytecode.LOAD_FAST, bytecode.LOAD_GLOBAL,
+                               bytecode.LOAD_NAME, bytecode.LOAD_DEREF):
+                    loaded.add((base_op, base_name, arg))
+        elif op == bytecode.BINARY_SUBSCR:
+            previous = get_previous_ops(code, index, 2)
+            if previous and previous[1][0] == bytecode.LOAD_CONST:
+                (container_op, container), key = previous[0], previous[1][1]
+                length = None
+                if (container_op == bytecode.LOAD_CONST and
+                        isinstance(container, (tuple, basestring))):
+                    length = len(container)
+                elif container_op == bytecode.LOAD_FAST:
+                    length = constant_locals.get(container)
+                if (length is not None and isinstance(key, (int, long)) and
+                        -length <= key < length):
+                    safe_sites.add(index)
+
+        if op not in ATTRIBUTE_PRESERVING_OPCODES:
+            loaded.clear()
+        elif op == bytecode.STORE_FAST:
+            loaded = set(item for item in loaded
+                         if item[:2] != (bytecode.LOAD_FAST, arg))
+    return safe_sites
+
+
+def patch_rewriter_code(f_code, capture=CAPTURE_GLOBALS, families=FAMILIES,
+                        stats=None, module_names=frozenset(), is_module=False,
+                        skip=None):
+    """Helper function to patch a rewriter.Code object.
+
+    Args:
+      f_code: a rewriter.Code object.
+      capture: one of CAPTURE_MODES.
+      families: a sequence of elements of FAMILIES.
+      stats: None or a list where CodeStats are appended.
+      module_names: global names bound only to modules (see
+        get_module_names).
+      is_module: whether f_code is the code of a module.
+      skip: None or a function telling whether to leave a rewriter.Code
+        uninstrumented.
 
     Returns:
       a new patched object (see patch_code for details).
     """
+    if skip is not None and skip(f_code):
+        return skip_rewriter_code(f_code, capture, families, stats,
+                                  module_names, skip)
+    if capture == CAPTURE_RING:
+        return patch_ring_code(f_code, families, stats, module_names,
+                               is_module, skip)
+    if capture == CAPTURE_THREAD:
+        def store(name):
+            return [(bytecode.LOAD_GLOBAL, THREAD_STATE_NAME),
+                    (bytecode.STORE_ATTR, name)]
+
+        def delete(name):
+            return [(bytecode.LOAD_GLOBAL, THREAD_STATE_NAME),
+                    (bytecode.DUP_TOP, None), (bytecode.STORE_ATTR, name)]
+    else:
+        if capture == CAPTURE_LOCALS and uses_fast_locals(f_code):
+            store_op, delete_op = bytecode.STORE_FAST, bytecode.DELETE_FAST
+        else:
+            store_op, delete_op = bytecode.STORE_GLOBAL, bytecode.DELETE_GLOBAL
+
+        def store(name):
+            return [(store_op, name)]
+
+        def delete(name):
+            return [(delete_op, name)]
+
+    subscript_opcodes = SUBSCRIPT_OPCODES if SUBSCRIPTS in families else ()
+    attribute_opcodes = ATTRIBUTE_OPCODES if ATTRIBUTES in families else ()
+
+    code_stats = CodeStats(f_code.name, f_code.filename, f_code.firstlineno)
+    if stats is not None:
+        stats.append(code_stats)
+
+    # The variables stored by each instrumented site.
+    safe_sites = get_safe_sites(f_code, module_names, is_module)
+    site_names = {}
+    for index, (op, _) in enumerate(f_code.code):
+        if index in safe_sites:
+            continue
+        if op in subscript_opcodes:
+            site_names[index] = (INDEX_NAME, ATTR_NAME)
+        elif op in attribute_opcodes:
+            site_names[index] = (ATTR_NAME,)
+
+    def get_next_site_names(index):
+        """Returns the names stored by the site run right after index."""
+        for next_index in xrange(index + 1, len(f_code.code)):
+            op = f_code.code[next_index][0]
+            if next_index in site_names:
+                return site_names[next_index]
+            if not (isinstance(op, rewriter.Label) or
+                    op in TRANSPARENT_OPCODES):
+                break
+        return ()
+
     code = []
-    for op in f_code.code:
-        if op[0] in (bp.BINARY_SUBSCR, bp.STORE_SUBSCR, bp.DELETE_SUBSCR):
-            code.extend([(bp.DUP_TOPX, 2),
-                         (bp.STORE_GLOBAL, '_s_index'),
-                         (bp.STORE_GLOBAL, '_s_attr')])
-            code.append(op)
-            code.extend([(bp.DELETE_GLOBAL, '_s_index'),
-                         (bp.DELETE_GLOBAL, '_s_attr')])
-        elif op[0] in (bp.LOAD_ATTR, bp.STORE_ATTR, bp.DELETE_ATTR):
-            code.extend([(bp.DUP_TOP, None),
-                         (bp.STORE_GLOBAL, '_s_attr')])
-            code.append(op)
-            code.extend([(bp.DELETE_GLOBAL, '_s_attr')])
-        elif op[0] == bp.LOAD_CONST:
-            if isinstance(op[1], bp.Code):
-                code.append((op[0], patch_bp_code(op[1])))
+    for index, op in enumerate(f_code.code):
+        if index in site_names:
+            names = site_names[index]
+            if len(names) == 2:
+                code.append((bytecode.DUP_TOPX, 2))
+                code_stats.sites[SUBSCRIPTS] += 1
             else:
-                code.append(op)
+                code.append((bytecode.DUP_TOP, None))
+                code_stats.sites[ATTRIBUTES] += 1
+            for name in names:
+                code.extend(store(name))
+            code.append(op)
+            next_names = get_next_site_names(index)
+            for name in names:
+                if name not in next_names:
+                    code.extend(delete(name))
+        elif op[0] == bytecode.LOAD_CONST and isinstance(op[1], rewriter.Code):
+            code.append((op[0], patch_rewriter_code(op[1], capture,
+                                                    families, stats,
+                                                    module_names, skip=skip)))
         else:
+            if index in safe_sites:
+                if op[0] in subscript_opcodes:
+                    code_stats.elided[SUBSCRIPTS] += 1
+                elif op[0] in attribute_opcodes:
+                    code_stats.elided[ATTRIBUTES] += 1
             code.append(op)
+    code_stats.original_size = get_code_size(f_code.code)
+    code_stats.patched_size = get_code_size(code)
+    f_code.code = code
+    return f_code
+
+
+def get_ring_capture(op, arg, filename, lineno):
+    """Returns the instructions appending a capture of op to the ring.
+
+    They leave the stack as it was. The object and key of subscripts are the
+    two values at the top of the stack, and attributes capture the value at
+    the top and their name.
+    """
+    record = [(bytecode.LOAD_GLOBAL, RING_STATE_NAME),
+              (bytecode.LOAD_ATTR, 'record')]
+    call = [(bytecode.CALL_FUNCTION, 1), (bytecode.POP_TOP, None)]
+    code = record + [(bytecode.LOAD_CONST,
+                      (filename, lineno, opcode.opname[op]))] + call
+    if op in SUBSCRIPT_OPCODES:
+        code.extend([(bytecode.DUP_TOPX, 2), (bytecode.ROT_TWO, None)])
+        code.extend(record + [(bytecode.ROT_TWO, None)] + call)
+        code.extend(record + [(bytecode.ROT_TWO, None)] + call)
+    else:
+        code.append((bytecode.DUP_TOP, None))
+        code.extend(record + [(bytecode.ROT_TWO, None)] + call)
+        code.extend(record + [(bytecode.LOAD_CONST, arg)] + call)
+    return code
+
+
+def get_ring_site(code, lasti):
+    """Returns the site captured right before the instruction at lasti.
+
+    Args:
+      code: a types.CodeType object patched with CAPTURE_RING.
+      lasti: the offset of an instruction of code.
+
+    Returns:
+      the site constant loaded by the capture of get_ring_capture preceding
+      the instruction, or None if it is not preceded by one (for example
+      because it was a safe site).
+    """
+    co_code = code.co_code
+    op = ord(co_code[lasti])
+    if op not in SUBSCRIPT_OPCODES and op not in ATTRIBUTE_OPCODES:
+        return None
+    # The capture from the LOAD_CONST of the site on, which precedes op.
+    offset = lasti - get_code_size(get_ring_capture(op, None, None, None)[2:])
+    if offset < 0 or ord(co_code[offset]) != bytecode.LOAD_CONST:
+        return None
+    site = code.co_consts[ord(co_code[offset + 1]) +
+                          ord(co_code[offset + 2]) * 256]
+    if not isinstance(site, tuple):
+        return None
+    return site
+
+
+def patch_ring_code(f_code, families=FAMILIES, stats=None,
+                    module_names=frozenset(), is_module=False, skip=None):
+    """Helper function to patch a rewriter.Code object with CAPTURE_RING.
+
+    Args:
+      f_code: a rewriter.Code object.
+      families: a sequence of elements of FAMILIES.
+      stats: None or a list where CodeStats are appended.
+      module_names: global names bound only to modules (see
+        get_module_names).
+      is_module: whether f_code is the code of a module.
+      skip: None or a function telling whether to leave a rewriter.Code
+        uninstrumented.
+
+    Returns:
+      a new patched object (see patch_code for details).
+    """
+    subscript_opcodes = SUBSCRIPT_OPCODES if SUBSCRIPTS in families else ()
+    attribute_opcodes = ATTRIBUTE_OPCODES if ATTRIBUTES in families else ()
+
+    code_stats = CodeStats(f_code.name, f_code.filename, f_code.firstlineno)
+    if stats is not None:
+        stats.append(code_stats)
+
+    safe_sites = get_safe_sites(f_code, module_names, is_module)
+    code = []
+    lineno = f_code.firstlineno
+    for index, (op, arg) in enumerate(f_code.code):
+        if op is rewriter.SetLineno:
+            lineno = arg
+        if op in subscript_opcodes or op in attribute_opcodes:
+            family = SUBSCRIPTS if op in subscript_opcodes else ATTRIBUTES
+            if index in safe_sites:
+                code_stats.elided[family] += 1
+            else:
+                code_stats.sites[family] += 1
+                code.extend(get_ring_capture(op, arg, f_code.filename, lineno))
+        elif op == bytecode.LOAD_CONST and isinstance(arg, rewriter.Code):
+            arg = patch_rewriter_code(arg, CAPTURE_RING, families, stats,
+                                      module_names, skip=skip)
+        code.append((op, arg))
+    code_stats.original_size = get_code_size(f_code.code)
+    code_stats.patched_size = get_code_size(code)
     f_code.code = code
     return f_code
+
+
+def skip_rewriter_code(f_code, capture=CAPTURE_GLOBALS, families=FAMILIES,
+                       stats=None, module_names=frozenset(), skip=None):
+    """Leaves a rewriter.Code object uninstrumented, patching the nested ones.
+
+    The arguments are those of patch_rewriter_code.
+    """
+    code_stats = CodeStats(f_code.name, f_code.filename, f_code.firstlineno)
+    code_stats.skipped = True
+    if stats is not None:
+        stats.append(code_stats)
+    for index, (op, arg) in enumerate(f_code.code):
+        if op == bytecode.LOAD_CONST and isinstance(arg, rewriter.Code):
+            f_code.code[index] = (op, patch_rewriter_code(
+                arg, capture, families, stats, module_names, skip=skip))
+    code_stats.original_size = get_code_size(f_code.code)
+    code_stats.patched_size = code_stats.original_size
+    return f_code
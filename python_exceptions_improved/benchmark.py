@@ -0,0 +1,367 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks of the instrumentation overhead and of the enrichment latency.
+
+Run it with:
+
+    python -m python_exceptions_improved.benchmark [--quick] [--output FILE]
+
+It measures:
+  - runtime: the time per call of small workloads (attribute loops, dict and
+    list subscripts, nested closures) unpatched and patched with each capture
+    mode;
+  - import: the time to import a synthetic package tree with a plain import
+    and through ModuleImporter (without cache, with a warm cache and lazy);
+  - enrichment: for each enriched exception type and growing object or
+    namespace sizes, the time to raise the exception through
+    debug_exceptions and the time to build its message;
+  - rewriter: the throughput, in instructions per second, of patching the
+    code of some stdlib modules, and of decoding and assembling it again
+    with the rewriter and, when it is installed, with byteplay.
+
+The results are written as JSON, so two runs can be compared to find
+regressions. Every timing is the best of several repetitions.
+"""
+import argparse
+import importlib
+import inspect
+import json
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+import types
+
+try:
+    import byteplay
+except ImportError:
+    byteplay = None
+
+import asm
+import cache
+import debug_exception
+import rewriter
+import suggest
+
+
+class Point(object):
+    def __init__(self):
+        self.x = 0
+        self.y = 1
+
+
+def attribute_loop(n):
+    point = Point()
+    total = 0
+    for i in xrange(n):
+        point.x = i
+        total += point.x + point.y
+    return total
+
+
+def dict_subscripts(n):
+    mapping = {'a': 1, 'b': 2}
+    total = 0
+    for i in xrange(n):
+        mapping['a'] = i
+        total += mapping['a'] + mapping['b']
+    return total
+
+
+def list_subscripts(n):
+    sequence = [0, 1, 2]
+    total = 0
+    for i in xrange(n):
+        sequence[0] = i
+        total += sequence[0] + sequence[2]
+    return total
+
+
+def nested_closures(n):
+    items = {'key': [1]}
+
+    def outer():
+        def inner(i):
+            return items['key'][0] + i
+        return inner
+    inner = outer()
+    total = 0
+    for i in xrange(n):
+        total += inner(i)
+    return total
+
+
+WORKLOADS = (attribute_loop, dict_subscripts, list_subscripts, nested_closures)
+
+
+def fail_subscript(obj, key):
+    return obj[key]
+
+
+def fail_attribute(obj):
+    return obj.missing_attribute
+
+
+def patch_function(function, capture=asm.CAPTURE_GLOBALS):
+    """Returns a copy of function with patched code."""
+    return types.FunctionType(asm.patch_code(function.func_code, capture),
+                              function.func_globals, function.func_name,
+                              function.func_defaults, function.func_closure)
+
+
+def best_time(function, number, repeat):
+    """Returns the best time per call of function in seconds."""
+    return min(timeit.Timer(function).repeat(repeat, number)) / number
+
+
+def benchmark_runtime(iterations, repeat):
+    results = []
+    for workload in WORKLOADS:
+        unpatched = best_time(lambda: workload(iterations), 1, repeat)
+        for capture in asm.CAPTURE_MODES:
+            patched_workload = patch_function(workload, capture)
+            patched = best_time(lambda: patched_workload(iterations), 1,
+                                repeat)
+            results.append({
+                'workload': workload.__name__,
+                'capture': capture,
+                'iterations': iterations,
+                'unpatched': unpatched,
+                'patched': patched,
+                'overhead': patched / unpatched,
+            })
+    return results
+
+
+MODULE_TEMPLATE = '''
+class Item%(index)d(object):
+    def __init__(self):
+        self.values = {'key': [%(index)d]}
+'''
+
+FUNCTION_TEMPLATE = '''
+def function%(index)d(item):
+    return item.values['key'][0] + %(index)d
+'''
+
+
+def write_package(directory, name, modules, functions):
+    """Writes a package with the given number of modules and functions."""
+    package = os.path.join(directory, name)
+    os.mkdir(package)
+    with open(os.path.join(package, '__init__.py'), 'w') as f:
+        f.write('')
+    for i in xrange(modules):
+        with open(os.path.join(package, 'mod%d.py' % i), 'w') as f:
+            f.write(MODULE_TEMPLATE % {'index': i})
+            for j in xrange(functions):
+                f.write(FUNCTION_TEMPLATE % {'index': j})
+
+
+def unload_package(name):
+    for module_name in list(sys.modules):
+        if module_name == name or module_name.startswith(name + '.'):
+            del sys.modules[module_name]
+
+
+def time_import(name, modules, importer=None):
+    """Returns the time to import all the modules of a package."""
+    unload_package(name)
+    if importer:
+        importer.install()
+    try:
+        start = timeit.default_timer()
+        for i in xrange(modules):
+            importlib.import_module('%s.mod%d' % (name, i))
+        return timeit.default_timer() - start
+    finally:
+        if importer:
+            importer.uninstall()
+        unload_package(name)
+
+
+def benchmark_import(modules, functions, repeat):
+    directory = tempfile.mkdtemp()
+    name = 'exceptions_improved_benchmark'
+    dont_write_bytecode = sys.dont_write_bytecode
+    # Plain imports would otherwise read the pyc files written by the first
+    # run, while ModuleImporter always reads the sources.
+    sys.dont_write_bytecode = True
+    sys.path.insert(0, directory)
+    try:
+        write_package(directory, name, modules, functions)
+        code_cache = cache.CodeCache(os.path.join(directory, 'cache'))
+        importers = [
+            ('plain', None),
+            ('instrumented', debug_exception.ModuleImporter()),
+            ('cached', debug_exception.ModuleImporter(cache=code_cache)),
+            ('lazy', debug_exception.ModuleImporter(lazy=True)),
+        ]
+        for _, importer in importers:
+            if importer:
+                importer.uninstall()
+        # Warm up the cache.
+        time_import(name, modules, importers[2][1])
+        results = []
+        for mode, importer in importers:
+            seconds = min(time_import(name, modules, importer)
+                          for _ in xrange(repeat))
+            results.append({
+                'mode': mode,
+                'modules': modules,
+                'functions': functions,
+                'seconds': seconds,
+            })
+        return results
+    finally:
+        sys.path.remove(directory)
+        sys.dont_write_bytecode = dont_write_bytecode
+        shutil.rmtree(directory)
+
+
+def time_enrichment(function, args, repeat):
+    """Returns the best times to raise and to build the message, in seconds.
+
+    The suggestion caches are cleared before each repetition.
+    """
+    wrapped = debug_exception.debug_exceptions(function)
+    raise_time = message_time = float('inf')
+    for _ in xrange(repeat):
+        suggest.ATTRIBUTES.clear()
+        start = timeit.default_timer()
+        try:
+            wrapped(*args)
+        except Exception as e:
+            raised = timeit.default_timer()
+            str(e)
+            end = timeit.default_timer()
+        else:
+            raise AssertionError('%s did not fail' % function.__name__)
+        raise_time = min(raise_time, raised - start)
+        message_time = min(message_time, end - raised)
+    return raise_time, message_time
+
+
+def get_enrichment_cases(size):
+    """Returns (exception name, function, args) for objects of given size."""
+    names = ['name_%d' % i for i in xrange(size)]
+    large_class = type('Large', (object,), dict.fromkeys(names))
+    namespace = dict.fromkeys(names)
+    exec 'def fail_name():\n    return missing_name\n' in namespace
+    return [
+        ('IndexError', patch_function(fail_subscript), (range(size), size)),
+        ('KeyError', patch_function(fail_subscript),
+         (dict.fromkeys(names), 'name_')),
+        ('AttributeError', patch_function(fail_attribute), (large_class(),)),
+        ('NameError', namespace['fail_name'], ()),
+    ]
+
+
+def benchmark_enrichment(sizes, repeat):
+    results = []
+    for size in sizes:
+        for exception, function, args in get_enrichment_cases(size):
+            raise_time, message_time = time_enrichment(function, args, repeat)
+            results.append({
+                'exception': exception,
+                'size': size,
+                'raise': raise_time,
+                'message': message_time,
+            })
+    return results
+
+
+REWRITER_MODULES = ('inspect', 'difflib', 'argparse', 'decimal')
+
+
+def get_rewriter_corpus(module_names):
+    """Returns the code objects of the given modules compiled from source."""
+    codes = []
+    for module_name in module_names:
+        module = importlib.import_module(module_name)
+        codes.append(compile(inspect.getsource(module), module.__file__,
+                             'exec'))
+    return codes
+
+
+def benchmark_rewriter(module_names, repeat):
+    codes = get_rewriter_corpus(module_names)
+    instructions = sum(rewriter.count_instructions(code) for code in codes)
+    measures = [
+        ('rewriter', 'patch', lambda: [asm.patch_code(code) for code in codes]),
+        ('rewriter', 'roundtrip',
+         lambda: [rewriter.Code.from_code(code).to_code() for code in codes]),
+    ]
+    if byteplay is not None:
+        measures.append(
+            ('byteplay', 'roundtrip',
+             lambda: [byteplay.Code.from_code(code).to_code()
+                      for code in codes]))
+    results = []
+    for implementation, operation, function in measures:
+        seconds = best_time(function, 1, repeat)
+        results.append({
+            'implementation': implementation,
+            'operation': operation,
+            'instructions': instructions,
+            'seconds': seconds,
+            'instructions_per_second': instructions / seconds,
+        })
+    return results
+
+
+def run(quick=False, repeat=5):
+    """Runs all the benchmarks and returns the results as a dictionary."""
+    if quick:
+        iterations, modules, functions, sizes = 1000, 5, 10, (10, 1000)
+        rewriter_modules = REWRITER_MODULES[:1]
+    else:
+        iterations, modules, functions, sizes = 100000, 20, 50, (10, 1000,
+                                                                 100000)
+        rewriter_modules = REWRITER_MODULES
+    return {
+        'python': sys.version.split()[0],
+        'asm_version': asm.VERSION,
+        'repeat': repeat,
+        'runtime': benchmark_runtime(iterations, repeat),
+        'import': benchmark_import(modules, functions, repeat),
+        'enrichment': benchmark_enrichment(sizes, repeat),
+        'rewriter': benchmark_rewriter(rewriter_modules, repeat),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the instrumentation and the enrichment of '
+                    'exceptions, and writes the results as JSON.')
+    parser.add_argument('--quick', action='store_true',
+                        help='use smaller workloads')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of repetitions of each measure')
+    parser.add_argument('--output', default=None,
+                        help='file where the results are written '
+                             '(defaults to stdout)')
+    args = parser.parse_args(argv)
+    results = json.dumps(run(args.quick, args.repeat), indent=2,
+                         sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(results + '\n')
+    else:
+        print results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Helpers to read raw Python 2 bytecode."""
+import opcode
+
+
+globals().update(opcode.opmap)
+SLICE = opcode.opmap['SLICE+0']
+STORE_SLICE = opcode.opmap['STORE_SLICE+0']
+DELETE_SLICE = opcode.opmap['DELETE_SLICE+0']
+
+JUMP_OPCODES = frozenset(opcode.hasjrel + opcode.hasjabs)
+
+# Number of elements popped and pushed by opcodes with a fixed effect.
+FIXED_STACK_EFFECTS = {
+    POP_TOP: (1, 0),
+    NOP: (0, 0),
+    UNARY_POSITIVE: (1, 1),
+    UNARY_NEGATIVE: (1, 1),
+    UNARY_NOT: (1, 1),
+    UNARY_CONVERT: (1, 1),
+    UNARY_INVERT: (1, 1),
+    GET_ITER: (1, 1),
+    SLICE + 0: (1, 1),
+    SLICE + 1: (2, 1),
+    SLICE + 2: (2, 1),
+    SLICE + 3: (3, 1),
+    STORE_SLICE + 0: (2, 0),
+    STORE_SLICE + 1: (3, 0),
+    STORE_SLICE + 2: (3, 0),
+    STORE_SLICE + 3: (4, 0),
+    DELETE_SLICE + 0: (1, 0),
+    DELETE_SLICE + 1: (2, 0),
+    DELETE_SLICE + 2: (2, 0),
+    DELETE_SLICE + 3: (3, 0),
+    STORE_MAP: (3, 1),
+    STORE_SUBSCR: (3, 0),
+    DELETE_SUBSCR: (2, 0),
+    PRINT_EXPR: (1, 0),
+    PRINT_ITEM: (1, 0),
+    PRINT_ITEM_TO: (2, 0),
+    PRINT_NEWLINE: (0, 0),
+    PRINT_NEWLINE_TO: (1, 0),
+    LIST_APPEND: (1, 0),
+    SET_ADD: (1, 0),
+    MAP_ADD: (2, 0),
+    LOAD_LOCALS: (0, 1),
+    IMPORT_STAR: (1, 0),
+    EXEC_STMT: (3, 0),
+    YIELD_VALUE: (1, 1),
+    BUILD_CLASS: (3, 1),
+    STORE_NAME: (1, 0),
+    DELETE_NAME: (0, 0),
+    STORE_ATTR: (2, 0),
+    DELETE_ATTR: (1, 0),
+    STORE_GLOBAL: (1, 0),
+    DELETE_GLOBAL: (0, 0),
+    LOAD_CONST: (0, 1),
+    LOAD_NAME: (0, 1),
+    BUILD_MAP: (0, 1),
+    LOAD_ATTR: (1, 1),
+    COMPARE_OP: (2, 1),
+    IMPORT_NAME: (2, 1),
+    IMPORT_FROM: (0, 1),
+    LOAD_GLOBAL: (0, 1),
+    LOAD_FAST: (0, 1),
+    STORE_FAST: (1, 0),
+    DELETE_FAST: (0, 0),
+    LOAD_CLOSURE: (0, 1),
+    LOAD_DEREF: (0, 1),
+    STORE_DEREF: (1, 0),
+}
+for _name, _op in opcode.opmap.items():
+    if _name.startswith(('BINARY_', 'INPLACE_')):
+        FIXED_STACK_EFFECTS[_op] = (2, 1)
+
+
+def iter_instructions(co_code):
+    """Yields (offset, opcode, argument) tuples for raw bytecode.
+
+    EXTENDED_ARG prefixes are folded into the argument of the next opcode, and
+    the offset is the one of the opcode itself. The argument is None for
+    opcodes without one.
+    """
+    extended_arg = 0
+    i = 0
+    n = len(co_code)
+    while i < n:
+        op = ord(co_code[i])
+        if op < opcode.HAVE_ARGUMENT:
+            yield i, op, None
+            i += 1
+            continue
+        arg = ord(co_code[i + 1]) + ord(co_code[i + 2]) * 256 + extended_arg
+        if op == EXTENDED_ARG:
+            extended_arg = arg << 16
+        else:
+            extended_arg = 0
+            yield i, op, arg
+        i += 3
+
+
+def get_stack_effect(op, arg):
+    """Returns (popped, pushed) for the opcode or None if it is not known.
+
+    Opcodes that jump or manipulate blocks are not known, as their effect
+    depends on the path taken.
+    """
+    if op in FIXED_STACK_EFFECTS:
+        return FIXED_STACK_EFFECTS[op]
+    if op == DUP_TOP:
+        return 1, 2
+    if op == DUP_TOPX:
+        return arg, 2 * arg
+    if op in (ROT_TWO, ROT_THREE, ROT_FOUR):
+        depth = {ROT_TWO: 2, ROT_THREE: 3, ROT_FOUR: 4}[op]
+        return depth, depth
+    if op == UNPACK_SEQUENCE:
+        return 1, arg
+    if op in (BUILD_TUPLE, BUILD_LIST, BUILD_SET, BUILD_SLICE):
+        return arg, 1
+    if op == RAISE_VARARGS:
+        return arg, 0
+    if op == MAKE_FUNCTION:
+        return arg + 1, 1
+    if op == MAKE_CLOSURE:
+        return arg + 2, 1
+    if op in (CALL_FUNCTION, CALL_FUNCTION_VAR, CALL_FUNCTION_KW,
+              CALL_FUNCTION_VAR_KW):
+        popped = 1 + (arg & 0xFF) + 2 * ((arg >> 8) & 0xFF)
+        if op in (CALL_FUNCTION_VAR, CALL_FUNCTION_KW):
+            popped += 1
+        elif op == CALL_FUNCTION_VAR_KW:
+            popped += 2
+        return popped, 1
+    return None
@@ -0,0 +1,126 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import errno
+import hashlib
+import imp
+import marshal
+import os
+import tempfile
+
+import asm
+
+
+CACHE_DIR_ENVIRONMENT_VARIABLE = 'EXCEPTIONS_IMPROVED_CACHE_DIR'
+
+
+def get_default_directory():
+    """Returns the directory used to store the cache when none is given."""
+    directory = os.environ.get(CACHE_DIR_ENVIRONMENT_VARIABLE)
+    if directory:
+        return directory
+    return os.path.join(os.path.expanduser('~'), '.cache',
+                        'python-exceptions-improved')
+
+
+class CodeCache(object):
+    """Content addressed on-disk cache of patched code objects.
+
+    Each entry is a file holding the interpreter magic number followed by the
+    marshaled patched code. Entries are keyed by a hash of the raw contents of
+    the module (source or pyc), its path, the interpreter magic number, the
+    instrumentation version (asm.VERSION) and the patching options, so a stale
+    entry is never returned: any change just produces a different key.
+
+    The number of hits and misses is recorded in the attributes with the same
+    name.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory or get_default_directory()
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, data, file_path, options=()):
+        """Returns the key under which the patched code of data is stored.
+
+        Args:
+          data: a string with the raw contents of the module file.
+          file_path: the path of the module. It is part of the key as it is
+            embedded in the code object (co_filename).
+          options: a tuple with the options used to patch the code.
+
+        Returns:
+          a hexadecimal string.
+        """
+        digest = hashlib.sha1()
+        for part in (imp.get_magic(), asm.VERSION, repr(options), file_path,
+                     data):
+            digest.update(part)
+            digest.update('\0')
+        return digest.hexdigest()
+
+    def get_path(self, key):
+        """Returns the path of the file storing the entry for key."""
+        return os.path.join(self.directory, key[:2], key[2:] + '.pyc')
+
+    def load(self, key):
+        """Returns the code object stored under key or None if missing."""
+        try:
+            with open(self.get_path(key), 'rb') as f:
+                data = f.read()
+        except IOError:
+            self.misses += 1
+            return None
+
+        magic = imp.get_magic()
+        if not data.startswith(magic):
+            self.misses += 1
+            return None
+        try:
+            code = marshal.loads(data[len(magic):])
+        except (EOFError, ValueError, TypeError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return code
+
+    def store(self, key, code):
+        """Stores the code object under key.
+
+        The entry is written to a temporary file which is then renamed, so
+        concurrent readers never see a partial entry. Errors are ignored, as
+        the cache is just an optimization.
+        """
+        path = self.get_path(key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                return
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(imp.get_magic())
+                f.write(marshal.dumps(code))
+            os.rename(tmp_path, path)
+        except (IOError, OSError, ValueError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get_stats(self):
+        """Returns a dictionary with the number of hits and misses."""
+        return {'hits': self.hits, 'misses': self.misses}
@@ -15,12 +15,24 @@ import os
 import sys
 import imp
 import ast
+import collections
+import inspect
+import json
 import marshal
-import difflib
-import itertools
 import re
+import threading
+import time
+import weakref
 
 import asm
+import finder
+import lazy as lazy_module
+import policy as policy_module
+import postmortem
+import registry
+import render
+import suggest
+import switch
 
 
 class ModuleImporter(object):
@@ -29,8 +41,53 @@ class ModuleImporter(object):
     It is both a finder (find_module) and a loader (load_module).
 
     See PEP 302 (http://www.python.org/dev/peps/pep-0302/) for further details.
+
+    If a cache.CodeCache is given, patched code objects are looked up there
+    before parsing and patching the module, and stored there afterwards.
+
+    capture is one of asm.CAPTURE_MODES and selects where the patched code
+    stores the operands. Use asm.CAPTURE_THREAD (or asm.CAPTURE_LOCALS) for
+    code running in several threads, and asm.CAPTURE_RING to also report the
+    operands of the operations run before the failure.
+
+    policy is a policy.InstrumentationPolicy deciding which modules are
+    patched and which opcodes are instrumented. Modules rejected by it are left
+    to the other importers. By default everything is patched.
+
+    If lazy is true, module level code is run unpatched and each function is
+    patched the first time it is called (see lazy.LazyPatcher).
+
+    If switchable is true, module level code is run unpatched and each function
+    is registered with its original and patched code in switch.SWITCH, so the
+    instrumentation can be turned on and off at runtime. It cannot be combined
+    with lazy.
+
+    Statistics of the patching of each module are kept in stats, a mapping
+    from file paths to ModuleStats (see also get_stats).
+
+    Modules are looked up with a finder.PathFinder, which caches the listings
+    of the directories of the path, and files are only opened when the module
+    is loaded.
     """
-    def __init__(self):
+    def __init__(self, cache=None, capture=asm.CAPTURE_GLOBALS, policy=None,
+                 lazy=False, switchable=False):
+        if lazy and switchable:
+            raise ValueError('lazy and switchable cannot be combined')
+        self.cache = cache
+        self.capture = capture
+        self.policy = policy or policy_module.InstrumentationPolicy()
+        self.lazy_patcher = None
+        self.stats = collections.OrderedDict()
+        self.finder = finder.PathFinder()
+        # Specs of the modules found and not loaded yet, by module name.
+        self.specs = {}
+        if capture == asm.CAPTURE_THREAD:
+            asm.get_thread_state()
+        elif capture == asm.CAPTURE_RING:
+            asm.get_ring_state()
+        if lazy:
+            self.lazy_patcher = lazy_module.LazyPatcher(self.patch_code)
+        self.switch = switch.SWITCH if switchable else None
         self.install()
 
     def install(self):
@@ -43,35 +100,150 @@ class ModuleImporter(object):
         if self in sys.meta_path:
             sys.meta_path.remove(self)
 
-    def get_module_from_package(self, name, file, file_path):
-        if os.path.exists(os.path.join(file_path, '__init__.pyc')):
-            return self.get_module_from_pyc(
-                name, None, os.path.join(file_path, '__init__.pyc'))
-        elif os.path.exists(os.path.join(file_path, '__init__.py')):
-            return self.get_module_from_source(
-                name, None, os.path.join(file_path, '__init__.py'))
+    def get_module_from_package(self, name, file_path):
+        source_path = os.path.join(file_path, '__init__.py')
+        pyc_path = os.path.join(file_path, '__init__.pyc')
+        # A precompiled __init__.py is loaded without patching anything.
+        if os.path.exists(pyc_path) and not self.is_precompiled(source_path):
+            return self.get_module_from_pyc(name, pyc_path)
+        elif os.path.exists(source_path):
+            return self.get_module_from_source(name, source_path)
 
-    def get_module_from_source(self, name, file, file_path):
-        try:
-            if not file:
-                file = open(file_path, 'U')
-            code_tree = ast.parse(file.read())
-            return self.get_module_from_code(
-                name, compile(code_tree, file_path, 'exec'))
-        finally:
-            file.close()
-
-    def get_module_from_pyc(self, name, file, file_path):
-        try:
-            if not file:
-                file = open(file_path, 'rb')
-            file.read(8)
-            return self.get_module_from_code(name, marshal.load(file))
-        finally:
-            file.close()
+    def is_precompiled(self, file_path):
+        """Returns whether the patched code of a source file is in the cache."""
+        if self.cache is None or not os.path.exists(file_path):
+            return False
+        with open(file_path, 'U') as f:
+            source = f.read()
+        return os.path.exists(
+            self.cache.get_path(self.get_cache_key(source, file_path)))
+
+    def get_module_from_source(self, name, file_path):
+        with open(file_path, 'U') as f:
+            source = f.read()
+
+        return self.get_module_from_patched_code(
+            name, self.get_patched_code(source, file_path,
+                                        get_source_compiler(file_path)))
+
+    def get_module_from_pyc(self, name, file_path):
+        with open(file_path, 'rb') as f:
+            data = f.read()
+
+        # The code keeps the path of its source, which profiles refer to.
+        code = marshal.loads(data[8:])
+        return self.get_module_from_patched_code(
+            name, self.get_patched_code(data, file_path, lambda data: code,
+                                        code.co_filename))
+
+    def get_patched_code(self, data, file_path, load_code, source_path=None):
+        """Returns the patched code object of a module.
+
+        Args:
+          data: a string with the raw contents of the module file.
+          file_path: the path of the module file.
+          load_code: a function converting data into a code object.
+          source_path: the path of the source of the module, as in the
+            co_filename of its code. By default, file_path.
+
+        Returns:
+          the patched code object, taken from the cache if possible.
+        """
+        if self.cache is None:
+            return self.get_module_code(load_code(data))
+
+        key = self.get_cache_key(data, file_path, source_path)
+        module_code = self.cache.load(key)
+        # Stats are recorded by source path, like the patching does.
+        module_stats = self.get_module_stats(source_path or file_path)
+        if module_code is None:
+            module_stats.cache = 'miss'
+            module_code = self.get_module_code(load_code(data))
+            self.cache.store(key, module_code)
+        else:
+            module_stats.cache = 'hit'
+        return module_code
+
+    def get_patch_options(self):
+        """Returns a tuple with the options affecting the patched code."""
+        return ((self.capture, self.lazy_patcher is not None,
+                 self.switch is not None) + self.policy.get_options())
+
+    def get_cache_key(self, data, file_path, source_path=None):
+        """Returns the key of the patched code of a module in the cache.
+
+        The functions left uninstrumented are looked up by source_path (by
+        default file_path), the path of the source in the code objects.
+        """
+        return self.cache.get_key(data, file_path,
+                                  self.get_patch_options() +
+                                  self.policy.get_file_options(
+                                      source_path or file_path))
+
+    def patch_code(self, code):
+        code_stats = []
+        start = time.time()
+        patched_code = asm.patch_code(code, capture=self.capture,
+                                      families=self.policy.families,
+                                      stats=code_stats,
+                                      skip=self.policy.should_skip_code)
+        self.get_module_stats(code.co_filename).add(code_stats,
+                                                    time.time() - start)
+        return patched_code
+
+    def get_module_stats(self, file_path):
+        if file_path not in self.stats:
+            self.stats[file_path] = ModuleStats(file_path)
+        return self.stats[file_path]
+
+    def get_stats(self):
+        """Returns the statistics of the patched modules and their totals.
+
+        Returns:
+          a dictionary with the keys 'modules', a list with the statistics of
+          each module (see ModuleStats.to_dict) sorted by decreasing patch time,
+          and 'totals'.
+        """
+        modules = [module_stats.to_dict()
+                   for module_stats in self.stats.values()]
+        modules.sort(key=lambda module_stats: -module_stats['patch_time'])
+        totals = {
+            'modules': len(modules),
+            'sites': dict.fromkeys(asm.FAMILIES, 0),
+            'original_size': 0,
+            'patched_size': 0,
+            'patch_time': 0.0,
+            'cache_hits': 0,
+            'cache_misses': 0,
+            'skipped': 0,
+        }
+        for module_stats in modules:
+            totals['skipped'] += len(module_stats['skipped'])
+            for family, count in module_stats['sites'].items():
+                totals['sites'][family] += count
+            for name in ('original_size', 'patched_size', 'patch_time'):
+                totals[name] += module_stats[name]
+            if module_stats['cache'] == 'hit':
+                totals['cache_hits'] += 1
+            elif module_stats['cache'] == 'miss':
+                totals['cache_misses'] += 1
+        return {'modules': modules, 'totals': totals}
+
+    def get_module_code(self, module_code):
+        """Returns the code to execute for a module.
+
+        It is unpatched if lazy or switchable, as then functions are patched
+        individually.
+        """
+        if self.lazy_patcher or self.switch is not None:
+            return module_code
+        return self.patch_code(module_code)
 
     def get_module_from_code(self, module_name, module_code):
-        module_code = asm.patch_code(module_code)
+        return self.get_module_from_patched_code(
+            module_name, self.get_module_code(module_code))
+
+    def get_module_from_patched_code(self, module_name, module_code):
         mod = sys.modules.setdefault(module_name, imp.new_module(module_name))
 
         # The following two fields are required by PEP 302
@@ -85,44 +257,94 @@ class ModuleImporter(object):
         package = get_package(module_name, is_package)
         if package:
             mod.__package__ = package
+        if module_code.co_filename in self.stats:
+            self.stats[module_code.co_filename].module_name = module_name
         exec module_code in mod.__dict__
+        registry.TYPES.add_module(module_name, mod)
+        if self.lazy_patcher:
+            self.lazy_patcher.install(mod.__dict__)
+        if self.switch is not None:
+            self.switch.register_namespace(mod.__dict__, self.patch_code)
         return mod
 
-    def get_module(self, name, file, file_path, description):
-        try:
-            if description[2] == imp.PKG_DIRECTORY:
-                return self.get_module_from_package(name, file, file_path)
-            elif description[2] == imp.PY_SOURCE:
-                return self.get_module_from_source(name, file, file_path)
-            elif description[2] == imp.PY_COMPILED:
-                return self.get_module_from_pyc(name, file, file_path)
-        finally:
-            if file:
-                file.close()
-
-    def find_module(self, module_name, path=None):  # pylint: disable=W0613
-        """Returns self when the module registered is requested."""
-        self.module_name = module_name
-        if path:
-            path_component = path[0].split('/')[::-1]
-            module_component = module_name.split('.')
-            for i in xrange(min(len(module_component), len(path_component))):
-                if module_component[i] != path_component[i]:
-                    break
-            else:
-                i += 1
-            module_name = '.'.join(module_component[i:])
-        result = imp.find_module(module_name, path)
-        if result[2][2] in (imp.PKG_DIRECTORY, imp.PY_SOURCE, imp.PY_COMPILED):
-            self.result = result
-            return self
+    def get_module(self, spec):
+        if spec.kind == imp.PKG_DIRECTORY:
+            return self.get_module_from_package(spec.name, spec.origin)
+        elif spec.kind == imp.PY_SOURCE:
+            return self.get_module_from_source(spec.name, spec.origin)
+        elif spec.kind == imp.PY_COMPILED:
+            return self.get_module_from_pyc(spec.name, spec.origin)
+
+    def invalidate_caches(self):
+        """Forgets the cached directory listings of the finder."""
+        self.finder.invalidate_caches()
+
+    def find_module(self, module_name, path=None):
+        """Returns self if the module is found and should be patched."""
+        spec = self.finder.find_spec(module_name, path)
+        if spec is None or spec.kind not in finder.PYTHON_KINDS:
+            return None
+        if not self.policy.should_instrument(module_name, spec.origin):
+            return None
+        self.specs[module_name] = spec
+        return self
 
     def load_module(self, module_name):
-        """Loads the registered module."""
-        if self.module_name == module_name and self.result:
-            return self.get_module(module_name, *self.result)
-        else:
+        """Loads a module found by find_module."""
+        spec = self.specs.pop(module_name, None)
+        if spec is None:
             raise ImportError('Module not found')
+        return self.get_module(spec)
+
+
+class ModuleStats(object):
+    """Statistics of the instrumentation of a module.
+
+    cache is None when no cache is used, and otherwise 'hit' or 'miss'. The
+    code objects of a module loaded from the cache are not patched, so they
+    have no statistics. With lazy patching, functions are added as they get
+    patched.
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.module_name = None
+        self.cache = None
+        self.patch_time = 0.0
+        self.code_stats = []
+
+    def add(self, code_stats, patch_time):
+        """Adds the asm.CodeStats of a patch_code call and its duration."""
+        self.code_stats.extend(code_stats)
+        self.patch_time += patch_time
+
+    def to_dict(self):
+        sites = dict.fromkeys(asm.FAMILIES, 0)
+        for code_stats in self.code_stats:
+            for family, count in code_stats.sites.items():
+                sites[family] += count
+        return {
+            'module': self.module_name,
+            'file': self.file_path,
+            'cache': self.cache,
+            'patch_time': self.patch_time,
+            'sites': sites,
+            'original_size': sum(code_stats.original_size
+                                 for code_stats in self.code_stats),
+            'patched_size': sum(code_stats.patched_size
+                                for code_stats in self.code_stats),
+            'skipped': ['%s:%d' % (code_stats.name, code_stats.firstlineno)
+                        for code_stats in self.code_stats
+                        if code_stats.skipped],
+            'code_objects': [code_stats.to_dict()
+                             for code_stats in self.code_stats],
+        }
+
+
+def get_source_compiler(file_path):
+    """Returns a function compiling the source of the module in file_path."""
+    def compile_source(source):
+        return compile(ast.parse(source), file_path, 'exec')
+    return compile_source
 
 
 def get_package(module_name, is_package):
@@ -135,56 +357,198 @@ def get_package(module_name, is_package):
 
 ATTRIBUTE_ERROR_MESSAGE_PATTERN = r"(')?(?P<type>[a-zA-Z0-9_]*)(')? (.*) has no attribute '(?P<attribute>[a-zA-Z0-9_]*)'"
 ATTRIBUTE_ERROR_DELETE_MESSAGE_PATTERN = r"(?P<attribute>[a-zA-Z0-9_]*)"
-NAME_ERROR_MESSAGE_PATTERN = r"global name '(?P<name>[a-zA-Z0-9_]*)' is not defined"
+NAME_ERROR_MESSAGE_PATTERN = r"(global )?name '(?P<name>[a-zA-Z0-9_]*)' is not defined"
+ATTRIBUTE_ERROR_MESSAGE_RE = re.compile(ATTRIBUTE_ERROR_MESSAGE_PATTERN)
+ATTRIBUTE_ERROR_DELETE_MESSAGE_RE = re.compile(
+    ATTRIBUTE_ERROR_DELETE_MESSAGE_PATTERN)
+NAME_ERROR_MESSAGE_RE = re.compile(NAME_ERROR_MESSAGE_PATTERN)
 
 
 # TODO(skreft): Fix it for modules.
 def name_to_class(class_name):
-    matches = []
-    for m in sys.modules.values():
-        if hasattr(m, class_name):
-            class_type = getattr(m, class_name)
-            if isinstance(class_type, type):
-                matches.append(class_type)
-    if matches:
-        return matches[0]
+    return registry.TYPES.lookup(class_name)
 
 
 def is_similar_attribute(attribute, x):
     # N.B. foo and fox are not similar according to this
-    attribute = attribute.lower().replace('_', '')
-    x = x.lower().replace('_', '')
-    return difflib.SequenceMatcher(a=attribute, b=x).ratio() >= 0.75
+    return (suggest.ratio(suggest.normalize(attribute), suggest.normalize(x)) >=
+            suggest.THRESHOLD)
 
 
 def get_similar_attributes(type, attribute):
-    return itertools.ifilter(
-        lambda x: is_similar_attribute(attribute, x), dir(type))
+    return suggest.ATTRIBUTES.get_similar_attributes(type, attribute)
 
 
 def get_similar_variables(name, variables):
-    return itertools.ifilter(lambda x: is_similar_attribute(name, x), variables)
+    return suggest.SuggestionIndex(variables).suggest(name)
 
 
-def get_debug_vars(tb):
+def get_capture_namespaces(frame):
+    """Returns the namespaces of a frame where operands may be captured."""
+    if frame.f_locals is frame.f_globals:
+        return [frame.f_globals]
+    return [frame.f_locals, frame.f_globals]
+
+
+def pop_debug_vars(namespace):
+    """Returns the operands captured in namespace, removing them."""
     attr = None
     index = None
     attr_set = False
     index_set = False
+    if asm.ATTR_NAME in namespace:
+        attr = namespace.pop(asm.ATTR_NAME)
+        attr_set = True
+    if asm.INDEX_NAME in namespace:
+        index = namespace.pop(asm.INDEX_NAME)
+        index_set = True
+    return attr, index, attr_set, index_set
+
+
+def pop_thread_debug_vars():
+    """Returns the operands captured with asm.CAPTURE_THREAD, removing them."""
+    debug_vars = pop_debug_vars(asm.get_thread_operands())
+    pop_debug_vars(vars(asm.get_thread_state()))
+    return debug_vars
+
+
+def release_debug_vars(tb):
+    """Removes the operands captured in the frames of tb and the thread state.
+
+    The ring of asm.CAPTURE_RING of this thread is cleared as well.
+    """
+    while tb:
+        for namespace in get_capture_namespaces(tb.tb_frame):
+            pop_debug_vars(namespace)
+        tb = tb.tb_next
+    pop_thread_debug_vars()
+    asm.clear_ring_captures()
+
+
+def get_failure_captures(tb):
+    """Returns the captures of the ring of asm.CAPTURE_RING for a failure.
+
+    The patched code never cleans the ring, so its captures are only returned
+    if the last one was made by the capture of the operation failing in tb
+    (its site is the same object, see asm.get_ring_site), and otherwise the
+    list is empty.
+    """
+    tb = postmortem.get_failing_traceback(tb)
+    if tb is None:
+        return []
+    captures = asm.get_ring_captures()
+    if not captures:
+        return []
+    site = asm.get_ring_site(tb.tb_frame.f_code, tb.tb_lasti)
+    if site is None or captures[-1][0] is not site:
+        return []
+    return captures
+
+
+def get_ring_debug_vars(tb):
+    """Returns the operands of the failed operation captured in the ring."""
+    captures = get_failure_captures(tb)
+    if not captures:
+        return None, None, False, False
+    site, obj, key = captures[-1]
+    if site[2].endswith('_SUBSCR'):
+        return obj, key, True, True
+    return obj, None, True, False
+
+
+def get_debug_vars(tb):
+    """Returns the operands captured for the operation failing in tb.
+
+    The operands stored in the namespaces of all the frames of tb and in the
+    thread state are removed, even those left by operations which failed
+    before (and whose exceptions were caught), so no captured object outlives
+    the handling of the exception.
+    """
+    failed_tb = tb
+    debug_vars = None
     while tb:
-        if '_s_attr' in tb.tb_frame.f_globals:
-            attr = tb.tb_frame.f_globals['_s_attr']
-            attr_set = True
-            del tb.tb_frame.f_globals['_s_attr']
-        if '_s_index' in tb.tb_frame.f_globals:
-            index = tb.tb_frame.f_globals['_s_index']
-            index_set = True
-            tb.tb_frame.f_globals['_s_index']
-
-        if attr_set or index_set:
-            return attr, index, attr_set, index_set
+        for namespace in get_capture_namespaces(tb.tb_frame):
+            namespace_vars = pop_debug_vars(namespace)
+            if debug_vars is None and (namespace_vars[2] or namespace_vars[3]):
+                debug_vars = namespace_vars
         tb = tb.tb_next
-    return None, None, False, False
+    # Operands captured with asm.CAPTURE_THREAD. The exception is handled in
+    # the thread which raised it, so these are the ones of the failed operation.
+    thread_vars = pop_thread_debug_vars()
+    if debug_vars is not None:
+        return debug_vars
+    if thread_vars[2] or thread_vars[3]:
+        return thread_vars
+    return get_ring_debug_vars(failed_tb)
+
+
+def get_operand_history(captures):
+    """Returns the debug info of the captures of get_failure_captures.
+
+    Each capture is rendered as a dictionary with the site ('filename:lineno
+    opname'), the object and the key (the name for attribute opcodes).
+    """
+    history = []
+    for (filename, lineno, opname), obj, key in captures:
+        history.append({
+            'site': '%s:%d %s' % (filename, lineno, opname),
+            'object': render.render_repr(obj),
+            'key': key if opname.endswith('_ATTR') else render.render_repr(key),
+        })
+    return history
+
+
+def get_history_message(history):
+    lines = []
+    for capture in history:
+        if capture['site'].endswith('_ATTR'):
+            operation = '%s.%s' % (capture['object'], capture['key'])
+        else:
+            operation = '%s[%s]' % (capture['object'], capture['key'])
+        lines.append('\n\t%s: %s' % (capture['site'], operation))
+    return '\nOperand history:' + ''.join(lines)
+
+
+# Backends used to find the operands of the failed operation.
+# Operands captured by the code patched with asm.patch_code.
+INSTRUMENTED = 'instrumented'
+# Operands recovered from the traceback of unpatched code (see postmortem).
+POSTMORTEM = 'postmortem'
+BACKENDS = {
+    INSTRUMENTED: get_debug_vars,
+    POSTMORTEM: postmortem.get_debug_vars,
+}
+_backend = INSTRUMENTED
+
+
+def set_backend(backend):
+    """Selects the backend used by debug_exceptions (one of BACKENDS)."""
+    global _backend
+    if backend not in BACKENDS:
+        raise ValueError('Unknown backend: %r' % (backend,))
+    _backend = backend
+
+
+def is_patched_traceback(tb):
+    """Returns whether the operation failing in tb is in a patched module."""
+    tb = postmortem.get_failing_traceback(tb)
+    return tb is not None and isinstance(
+        tb.tb_frame.f_globals.get('__loader__'), ModuleImporter)
+
+
+def get_backend_debug_vars(tb):
+    debug_vars = BACKENDS[_backend](tb)
+    # Sites proven safe are not instrumented (see asm.get_safe_sites), so
+    # their operands are recovered from the frame.
+    if (_backend == INSTRUMENTED and not debug_vars[2] and
+            is_patched_traceback(tb)):
+        return postmortem.get_debug_vars(tb)
+    return debug_vars
+
+
+def get_operands(msg, tb):
+    """Returns the operands of the operation failing with msg in tb."""
+    return get_backend_debug_vars(tb)
 
 
 class KeyError_(KeyError):
@@ -195,57 +559,519 @@ class KeyError_(KeyError):
             return str(self.args[0])
 
 
+def get_type_name(obj):
+    """Returns the qualified name of the type of obj."""
+    cls = getattr(obj, '__class__', type(obj))
+    return '%s.%s' % (getattr(cls, '__module__', None), cls.__name__)
+
+
+def get_index_error_debug_info(msg, debug_vars):
+    attr, index, attr_set, index_set = debug_vars
+    if not (attr_set and index_set):
+        return {}
+    length = render.get_length(attr)
+    debug_info = {
+        'object': render.render_str(attr),
+        'object_type': get_type_name(attr),
+        'length': length,
+        'index': render.render_str(index),
+    }
+    if length > render.MAX_ITEMS:
+        debug_info['nearby_items'] = [
+            [i, render.render_repr(item)]
+            for i, item in render.get_nearby_items(attr, index)]
+    return debug_info
+
+
+def get_index_error_message(msg, debug_info):
+    if 'object' in debug_info:
+        msg = msg + "\nDebug info:\n\tObject: %s\n\tObject len: %s\n\tIndex: %s" % (debug_info['object'], debug_info['length'], debug_info['index'])
+        if 'nearby_items' in debug_info:
+            msg += "\n\tNearby items: %s" % ', '.join(
+                '[%d]: %s' % (i, item) for i, item in debug_info['nearby_items'])
+    return msg
+
+
+def get_key_error_debug_info(msg, debug_vars):
+    attr, index, attr_set, index_set = debug_vars
+    if not (attr_set and index_set):
+        return {}
+    return {
+        'object': render.render_str(attr),
+        'object_type': get_type_name(attr),
+        'length': render.get_length(attr),
+        'key': render.render_repr(index),
+        'similar_keys': [render.render_repr(key)
+                         for key in render.get_similar_keys(attr, index)],
+    }
+
+
+def get_key_error_message(msg, debug_info):
+    if 'object' in debug_info:
+        msg = msg + "\nDebug info:\n\tObject: %s\n\tKey: %s" % (debug_info['object'], debug_info['key'])
+        if debug_info['similar_keys']:
+            msg += "\n\tSimilar keys: %s" % ', '.join(
+                debug_info['similar_keys'])
+    return msg
+
+
+def get_attribute_error_debug_info(msg, debug_vars):
+    match = ATTRIBUTE_ERROR_MESSAGE_RE.match(msg)
+    field_type = None
+    if match:
+        field_type = name_to_class(match.group('type'))
+        attribute = match.group('attribute')
+    else:
+        attribute = ATTRIBUTE_ERROR_DELETE_MESSAGE_RE.match(msg).group(
+            'attribute')
+    attr, index, attr_set, index_set = debug_vars
+    debug_info = {'attribute': attribute}
+    if attr_set:
+        field_type = attr
+        debug_info['object'] = render.render_repr(attr)
+        debug_info['object_type'] = get_type_name(attr)
+        debug_info['type'] = str(type(attr))
+    elif field_type:
+        debug_info['type'] = str(field_type)
+    if 'type' in debug_info:
+        attributes = suggest.ATTRIBUTES.dir(field_type)
+        debug_info['attributes'] = attributes[:render.MAX_ATTRIBUTES]
+        debug_info['attributes_count'] = len(attributes)
+    debug_info['suggestions'] = list(get_similar_attributes(field_type,
+                                                            attribute))
+    return debug_info
+
+
+def get_attribute_error_message(msg, debug_info):
+    if debug_info['suggestions']:
+        msg += '. Did you mean %s?' % ', '.join(["'%s'" %a for a in debug_info['suggestions']])
+    if 'type' in debug_info:
+        attributes = render.render_attributes(debug_info['attributes'],
+                                              debug_info['attributes_count'])
+        if 'object' in debug_info:
+            msg += "\nDebug info:\n\tObject: %s\n\tType: %s\n\tAttributes: %s" % (debug_info['object'], debug_info['type'], attributes)
+        else:
+            msg += "\nDebug info:\n\tType: %s\n\tAttributes: %s" % (debug_info['type'], attributes)
+    return msg
+
+
+def get_name_error_data(msg, tb):
+    """Returns the names a NameError raised in tb may be a misspelling of.
+
+    They are taken when raising, so the frame is not kept alive. If the name
+    is in the suggestion table of the code of the innermost frame of tb (see
+    asm.add_suggestion_tables), the result is a dictionary with its
+    suggestions under 'suggestions'. Otherwise it has the names of the locals,
+    globals and builtins of the frame under 'names'.
+    """
+    frame = get_traceback_frame(tb)
+    match = NAME_ERROR_MESSAGE_RE.match(msg)
+    table = asm.find_suggestion_table(frame.f_code)
+    if match and table is not None and match.group('name') in table:
+        return {'suggestions': table[match.group('name')]}
+    return {
+        'names': (frame.f_locals.keys() + frame.f_globals.keys() +
+                  frame.f_builtins.keys()),
+    }
+
+
+def get_name_error_debug_info(msg, data):
+    """Returns the name of a NameError and the similar names.
+
+    They are the suggestions of data (see get_name_error_data) or, if it has
+    none, its names similar to the name.
+    """
+    match = NAME_ERROR_MESSAGE_RE.match(msg)
+    if not match:
+        return {}
+    name = match.group('name')
+    if 'suggestions' in data:
+        suggestions = data['suggestions']
+    else:
+        suggestions = get_similar_variables(name, data['names'])
+    return {
+        'name': name,
+        'suggestions': list(suggestions),
+    }
+
+
+def get_name_error_message(msg, debug_info):
+    if debug_info.get('suggestions'):
+        msg += '. Did you mean %s?' % ', '.join(["'%s'" %a for a in debug_info['suggestions']])
+    return msg
+
+
+def get_traceback_frame(tb):
+    """Returns the innermost frame of tb, where the exception was raised."""
+    while tb.tb_next:
+        tb = tb.tb_next
+    return tb.tb_frame
+
+
+class ExceptionHandler(object):
+    """Enrichment of the exceptions of a type.
+
+    Args:
+      get_debug_info: function(msg, data) returning a dictionary with the
+        debug info of an exception whose original message is msg. Its values
+        must be serializable as JSON.
+      get_message: function(msg, debug_info) returning the enriched message.
+      get_data: function(msg, tb) returning the data passed to get_debug_info.
+        It is called when the exception is raised, with the traceback starting
+        at the wrapped function. By default, the operands of the failed
+        operation.
+      base: the base type of the raised exception. By default, the type of the
+        original exception.
+    """
+    def __init__(self, get_debug_info, get_message, get_data=None, base=None):
+        self.get_debug_info = get_debug_info
+        self.get_message = get_message
+        # The operands are taken when raising, as the capture slots are reused.
+        self.get_data = get_data or get_operands
+        self.base = base
+
+
+class HandlerRegistry(object):
+    """ExceptionHandlers by exception type.
+
+    The handler of an exception is the one registered for the first class of
+    its MRO having one. Lookups are cached per type until a handler is
+    registered or unregistered.
+    """
+    def __init__(self):
+        self.handlers = {}
+        self.cache = weakref.WeakKeyDictionary()
+
+    def register(self, exception_type, handler):
+        self.handlers[exception_type] = handler
+        self.cache.clear()
+
+    def unregister(self, exception_type):
+        self.handlers.pop(exception_type, None)
+        self.cache.clear()
+
+    def lookup(self, exception_type):
+        """Returns the ExceptionHandler of exception_type, or None."""
+        try:
+            return self.cache[exception_type]
+        except KeyError:
+            pass
+        handler = None
+        for cls in inspect.getmro(exception_type):
+            if cls in self.handlers:
+                handler = self.handlers[cls]
+                break
+        self.cache[exception_type] = handler
+        return handler
+
+
+HANDLERS = HandlerRegistry()
+HANDLERS.register(IndexError, ExceptionHandler(get_index_error_debug_info,
+                                               get_index_error_message))
+HANDLERS.register(KeyError, ExceptionHandler(get_key_error_debug_info,
+                                             get_key_error_message,
+                                             base=KeyError_))
+HANDLERS.register(AttributeError, ExceptionHandler(
+    get_attribute_error_debug_info, get_attribute_error_message))
+HANDLERS.register(NameError, ExceptionHandler(get_name_error_debug_info,
+                                              get_name_error_message,
+                                              get_data=get_name_error_data))
+
+
+# How enriched exceptions keep the operands until their message is built.
+# Strong references, so the message is built lazily with all the details. This
+# is the default.
+RETAIN_STRONG = 'strong'
+# Weak references to the operands which support them. Otherwise the debug info
+# is built right away, as it only holds bounded summaries of the operands
+# (type, length, reprs), and the operands are released.
+RETAIN_WEAK = 'weak'
+RETENTIONS = (RETAIN_STRONG, RETAIN_WEAK)
+_retention = RETAIN_STRONG
+
+# Operands of these types are cheap to keep, so they are always referenced.
+SUMMARY_TYPES = (type(None), bool, int, long, float, basestring)
+
+
+def set_retention(retention):
+    """Selects how enriched exceptions keep the operands (one of RETENTIONS)."""
+    global _retention
+    if retention not in RETENTIONS:
+        raise ValueError('Unknown retention: %r' % (retention,))
+    _retention = retention
+
+
+def get_reference(obj):
+    """Returns a function returning obj, which references it weakly if possible.
+
+    Raises:
+      TypeError: if obj is not of SUMMARY_TYPES and has no weak references.
+    """
+    if isinstance(obj, SUMMARY_TYPES):
+        return lambda: obj
+    return weakref.ref(obj)
+
+
+class WeakDebugVars(object):
+    """Debug vars (see get_debug_vars) whose operands are weakly referenced.
+
+    get returns the debug vars, where the operands already collected are
+    unset. The constructor raises TypeError if some operand cannot be
+    referenced (see get_reference).
+    """
+    def __init__(self, debug_vars):
+        attr, index, attr_set, index_set = debug_vars
+        self.attr = get_reference(attr) if attr_set else None
+        self.index = get_reference(index) if index_set else None
+
+    @staticmethod
+    def dereference(reference):
+        if reference is None:
+            return None, False
+        obj = reference()
+        return obj, obj is not None or not isinstance(reference, weakref.ref)
+
+    def get(self):
+        attr, attr_set = self.dereference(self.attr)
+        index, index_set = self.dereference(self.index)
+        if not attr_set:
+            index, index_set = None, False
+        return attr, index, attr_set, index_set
+
+
+class LazyDebugMessage(object):
+    """Mixin for exceptions whose debug message is built on first use.
+
+    When raising, only the original message and the references needed to
+    enrich it are stored in _debug_context, as (handler, exception name, msg,
+    data, captures), where captures are the ones of the ring of
+    asm.CAPTURE_RING leading to the failure (see get_failure_captures). The
+    debug info and the message are built the first time the exception is
+    converted to a string (or its message, args or debug_info are read), and
+    then cached. Exceptions which are caught and discarded never pay for it.
+    With RETAIN_WEAK, the references to the operands are weak, or the message
+    is built right away (see release_operands).
+    """
+    _debug_context = None
+    _debug_info = None
+    _debug_message = None
+
+    def build_debug_message(self):
+        if self._debug_context is not None:
+            handler, name, msg, data, captures = self._debug_context
+            self._debug_context = None
+            if isinstance(data, WeakDebugVars):
+                data = data.get()
+            debug_info = handler.get_debug_info(msg, data)
+            debug_info['exception'] = name
+            debug_info['message'] = msg
+            self._debug_info = debug_info
+            self._debug_message = handler.get_message(msg, debug_info)
+            if captures:
+                debug_info['history'] = get_operand_history(captures)
+                self._debug_message += get_history_message(
+                    debug_info['history'])
+
+    def release_operands(self):
+        """Stops referencing the operands strongly (see RETAIN_WEAK)."""
+        handler, name, msg, data, captures = self._debug_context
+        if isinstance(data, tuple) and not captures:
+            try:
+                self._debug_context = (handler, name, msg,
+                                       WeakDebugVars(data), captures)
+                return
+            except TypeError:
+                pass
+        self.build_debug_message()
+
+    def get_debug_message(self):
+        self.build_debug_message()
+        return self._debug_message
+
+    @property
+    def debug_info(self):
+        """Dictionary with the debug info of the exception.
+
+        It always has the keys 'exception' (the name of the original type) and
+        'message' (the original message), and depending on the type 'object',
+        'object_type', 'length', 'index', 'key', 'attribute', 'name',
+        'suggestions', etc. With asm.CAPTURE_RING, 'history' has the operands
+        of the last operations run (see get_operand_history).
+        """
+        self.build_debug_message()
+        return self._debug_info
+
+    def __str__(self):
+        return self.get_debug_message()
+
+    def __repr__(self):
+        return '%s(%r,)' % (type(self).__name__, self.get_debug_message())
+
+    def __reduce__(self):
+        # Enriched types are created dynamically, so they are pickled as their
+        # base type with the message already built.
+        return type(self).__bases__[1], (self.get_debug_message(),)
+
+    @property
+    def message(self):
+        return self.get_debug_message()
+
+    @property
+    def args(self):
+        return (self.get_debug_message(),)
+
+
+_enriched_types = {}
+
+
+def get_enriched_type(base):
+    """Returns a subclass of base whose message is built lazily."""
+    if base not in _enriched_types:
+        _enriched_types[base] = type(base.__name__, (LazyDebugMessage, base),
+                                     {'__module__': base.__module__})
+    return _enriched_types[base]
+
+
+def enrich_exception(ei, tb):
+    """Returns an exception to raise instead of ei, or None to keep ei.
+
+    Args:
+      ei: the exception instance.
+      tb: the traceback starting at the frame of the wrapped function.
+    """
+    exception_type = ei.__class__
+    handler = HANDLERS.lookup(exception_type)
+    if handler is None:
+        release_debug_vars(tb)
+        return None
+    msg = str(ei)
+    exception = get_enriched_type(handler.base or exception_type)(msg)
+    exception._debug_context = (handler, exception_type.__name__, msg,
+                                handler.get_data(msg, tb),
+                                get_failure_captures(tb))
+    release_debug_vars(tb)
+    if _retention == RETAIN_WEAK:
+        exception.release_operands()
+    return exception
+
+
+def get_function_name(f):
+    """Returns the name of a function, with its module and class if any."""
+    name = getattr(f, '__name__', repr(f))
+    im_class = getattr(f, 'im_class', None)
+    if im_class is not None:
+        name = '%s.%s' % (im_class.__name__, name)
+    return '%s.%s' % (getattr(f, '__module__', None), name)
+
+
+class JsonLinesEmitter(object):
+    """Writes the debug info of enriched exceptions as JSON lines.
+
+    Each line is an object with the debug info of an exception (see
+    LazyDebugMessage.debug_info), the name of the function where it was
+    caught (for tests, their id), and the file and line where it was raised.
+    Each line is written with a single call and flushed, so several processes
+    can append to the same file.
+
+    Args:
+      stream: a file-like object.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def get_record(self, exception, function, tb):
+        record = dict(exception.debug_info)
+        record['function'] = get_function_name(function)
+        while tb.tb_next:
+            tb = tb.tb_next
+        record['filename'] = tb.tb_frame.f_code.co_filename
+        record['lineno'] = tb.tb_lineno
+        return record
+
+    def emit(self, exception, function, tb):
+        record = self.get_record(exception, function, tb)
+        try:
+            line = json.dumps(record, sort_keys=True, default=repr)
+        except UnicodeDecodeError:
+            line = json.dumps(record, sort_keys=True, default=repr,
+                              encoding='latin-1')
+        with self.lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+
+_emitter = None
+
+
+def set_emitter(emitter):
+    """Sets the JsonLinesEmitter of debug_exceptions, or None to disable it."""
+    global _emitter
+    _emitter = emitter
+
+
+def enrich_exc_info(exc_info, function=None):
+    """Returns exc_info with its exception replaced by the enriched one.
+
+    exc_info is returned unchanged if the exception has no handler or is
+    already enriched.
+
+    Args:
+      exc_info: a tuple (type, exception, traceback), as returned by
+        sys.exc_info.
+      function: if not None, the function which raised the exception, and
+        the enriched exception is emitted (see set_emitter).
+    """
+    et, ei, tb = exc_info
+    if isinstance(ei, LazyDebugMessage):
+        return exc_info
+    exception = enrich_exception(ei, tb)
+    if exception is None:
+        return exc_info
+    if _emitter is not None and function is not None:
+        _emitter.emit(exception, function, tb)
+    return type(exception), exception, tb
+
+
 def debug_exceptions(f):
     def wrapper(*args, **kwargs):
         try:
             return f(*args, **kwargs)
         except:
             et, ei, tb = sys.exc_info()
-            msg = str(ei)
-            if isinstance(ei, IndexError):
-                attr, index, attr_set, index_set = get_debug_vars(tb.tb_next)
-                if attr_set and index_set:
-                    msg = msg + "\nDebug info:\n\tObject: %s\n\tObject len: %s\n\tIndex: %s" % (attr, len(attr), index)
-            elif isinstance(ei, KeyError):
-                attr, index, attr_set, index_set = get_debug_vars(tb.tb_next)
-                if attr_set and index_set:
-                    msg = msg + "\nDebug info:\n\tObject: %s\n\tKey: %s" % (attr, repr(index))
-                et = KeyError_
-                ei = KeyError_(msg)
-            elif isinstance(ei, AttributeError):
-                match = re.match(ATTRIBUTE_ERROR_MESSAGE_PATTERN, msg)
-                field_type = None
-                if match:
-                    field_type = name_to_class(match.group('type'))
-                    attribute = match.group('attribute')
-                else:
-                    match = re.match(ATTRIBUTE_ERROR_DELETE_MESSAGE_PATTERN, msg)
-                    if match:
-                        attribute =  match.group('attribute')
-                attr, index, attr_set, index_set = get_debug_vars(tb.tb_next)
-                if attr_set:
-                    field_type = attr
-                    debug_info = "\nDebug info:\n\tObject: %s\n\tType: %s\n\tAttributes: %s" % (repr(field_type), type(field_type), dir(field_type))
-                elif field_type:
-                    debug_info = "\nDebug info:\n\tType: %s\n\tAttributes: %s" % (field_type, dir(field_type))
-                proposals = list(get_similar_attributes(field_type, attribute))
-                if proposals:
-                    msg += '. Did you mean %s?' % ', '.join(["'%s'" %a for a in proposals])
-                msg = msg + debug_info
-            elif isinstance(ei, NameError):
-                match = re.match(NAME_ERROR_MESSAGE_PATTERN, msg)
-                name = match.group('name')
-                proposals = list(get_similar_variables(name, tb.tb_next.tb_frame.f_locals.keys() + tb.tb_next.tb_frame.f_globals.keys()))
-                if proposals:
-                    msg += '. Did you mean %s?' % ', '.join(["'%s'" %a for a in proposals])
-            raise et(msg), None, tb.tb_next
+            try:
+                et, ei, tb = enrich_exc_info((et, ei, tb.tb_next), f)
+                raise et, ei, tb
+            finally:
+                # The traceback references this frame, and the cycle would
+                # keep the frames and their objects alive until collected.
+                del tb
+    wrapper.debug_exceptions = True
     return wrapper
 
 
+def install_excepthook():
+    """Enriches the uncaught exceptions of scripts.
+
+    They are then reported by the previous sys.excepthook.
+    """
+    previous = sys.excepthook
+    if getattr(previous, 'enriches_exceptions', False):
+        return
+
+    def excepthook(et, ei, tb):
+        previous(*enrich_exc_info((et, ei, tb)))
+    excepthook.enriches_exceptions = True
+    sys.excepthook = excepthook
+
+
 def decorate(f):
     def wrapper(*args, **kwargs):
         result = f(*args, **kwargs)
         for method in result:
-            setattr(args[1], method, debug_exceptions(getattr(args[1], method)))
+            test_method = getattr(args[1], method)
+            # The same class may be loaded several times.
+            if not getattr(test_method, 'debug_exceptions', False):
+                setattr(args[1], method, debug_exceptions(test_method))
         return result
     return wrapper
@@ -0,0 +1,130 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Lookup of modules in the path using cached directory listings.
+
+imp.find_module probes each entry of the path with several stat and open calls
+and returns an open file. Instead, PathFinder lists each directory once and
+looks up the candidate file names in the listing. A listing is read again only
+when the modification time of its directory changes. The result is a
+ModuleSpec, which only records where the module is, so no file is opened until
+the module is loaded.
+
+Modules are searched as imp.find_module does: in each entry of the path, a
+package directory with an __init__ file first, and then a file with each of the
+suffixes of imp.get_suffixes in order. Builtin and frozen modules are not
+found, and neither are modules of path entries which are not directories.
+"""
+import imp
+import os
+import sys
+
+
+# Kinds of modules that can be loaded from their source or bytecode.
+PYTHON_KINDS = (imp.PKG_DIRECTORY, imp.PY_SOURCE, imp.PY_COMPILED)
+
+PACKAGE_INIT_NAMES = ('__init__.py', '__init__.pyc')
+
+
+class ModuleSpec(object):
+    """Where a module was found.
+
+    Args:
+      name: the full name of the module.
+      origin: the path of the module file, or of the directory of a package.
+      kind: one of the module kinds of imp (imp.PY_SOURCE, imp.PKG_DIRECTORY,
+        etc).
+    """
+    def __init__(self, name, origin, kind):
+        self.name = name
+        self.origin = origin
+        self.kind = kind
+
+    @property
+    def is_package(self):
+        return self.kind == imp.PKG_DIRECTORY
+
+    def __repr__(self):
+        return 'ModuleSpec(%r, %r, %r)' % (self.name, self.origin, self.kind)
+
+
+class PathFinder(object):
+    """Finds modules in path entries whose listings are cached.
+
+    The cache maps each directory to its modification time and the names it
+    contains. As modification times may have a coarse resolution, files
+    created right after a listing was read may go unnoticed until
+    invalidate_caches is called.
+    """
+    def __init__(self):
+        self.listings = {}
+        self.suffixes = [(suffix, kind) for suffix, _, kind in imp.get_suffixes()]
+
+    def get_listing(self, directory):
+        """Returns the set of names in directory, empty if it cannot be read."""
+        directory = directory or os.curdir
+        key = os.path.abspath(directory)
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            self.listings.pop(key, None)
+            return frozenset()
+        cached = self.listings.get(key)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        try:
+            names = frozenset(os.listdir(directory))
+        except OSError:
+            names = frozenset()
+        self.listings[key] = (mtime, names)
+        return names
+
+    def invalidate_caches(self):
+        """Discards all the listings."""
+        self.listings.clear()
+
+    def find_in_directory(self, fullname, directory):
+        """Returns the ModuleSpec of a module in directory, or None."""
+        name = fullname.rpartition('.')[2]
+        names = self.get_listing(directory)
+        if name in names:
+            package = os.path.join(directory, name)
+            if any(init_name in self.get_listing(package)
+                   for init_name in PACKAGE_INIT_NAMES):
+                return ModuleSpec(fullname, package, imp.PKG_DIRECTORY)
+        for suffix, kind in self.suffixes:
+            if name + suffix in names:
+                return ModuleSpec(fullname, os.path.join(directory,
+                                                         name + suffix), kind)
+        return None
+
+    def find_spec(self, fullname, path=None):
+        """Returns the ModuleSpec of a module, or None if it is not found.
+
+        Args:
+          fullname: the full name of the module.
+          path: the directories where a submodule is searched, that is the
+            __path__ of its package. Top level modules are searched in
+            sys.path.
+        """
+        if path is None:
+            if imp.is_builtin(fullname) or imp.is_frozen(fullname):
+                return None
+            path = sys.path
+        for entry in path:
+            if not isinstance(entry, basestring):
+                continue
+            spec = self.find_in_directory(fullname, entry)
+            if spec is not None:
+                return spec
+        return None
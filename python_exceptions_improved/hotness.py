@@ -0,0 +1,89 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Call counts of a profiling run, to leave hot code uninstrumented.
+
+A Profile is loaded from a pstats dump (as written by cProfile with -o or
+Stats.dump_stats) or from a JSON file mapping function labels in the format
+of pstats ('filename:lineno(name)') to call counts. Code objects are looked up
+by their file, first line and name, so the profile must come from a run of
+the same sources loaded from the same paths.
+"""
+import json
+import os
+import pstats
+import re
+
+
+FUNCTION_LABEL_RE = re.compile(r'^(?P<filename>.*):(?P<lineno>\d+)'
+                               r'\((?P<name>.*)\)$')
+
+
+def normalize_filename(filename):
+    return os.path.normcase(os.path.abspath(filename))
+
+
+class Profile(object):
+    """Number of calls of each profiled function.
+
+    Args:
+      calls: a dictionary from (filename, lineno, name) to the number of
+        calls.
+    """
+    def __init__(self, calls):
+        self.files = {}
+        for (filename, lineno, name), count in calls.items():
+            functions = self.files.setdefault(normalize_filename(filename), {})
+            functions[(lineno, name)] = functions.get((lineno, name),
+                                                      0) + count
+
+    @classmethod
+    def from_pstats(cls, path):
+        """Loads a pstats dump. Recursive calls are counted."""
+        stats = pstats.Stats(path).stats
+        return cls(dict((function, value[1])
+                        for function, value in stats.items()))
+
+    @classmethod
+    def from_counts(cls, path):
+        """Loads a JSON file of call counts by pstats function label."""
+        with open(path) as f:
+            counts = json.load(f)
+        calls = {}
+        for label, count in counts.items():
+            match = FUNCTION_LABEL_RE.match(label)
+            if match is None:
+                raise ValueError('Invalid function label: %r' % (label,))
+            calls[(match.group('filename'), int(match.group('lineno')),
+                   match.group('name'))] = count
+        return cls(calls)
+
+    def get_calls(self, filename, lineno, name):
+        """Returns the number of calls of a function, 0 if not profiled."""
+        return self.files.get(normalize_filename(filename), {}).get(
+            (lineno, name), 0)
+
+    def get_hot_functions(self, filename, max_calls):
+        """Returns the sorted (lineno, name) of the hot functions of a file.
+
+        These are the ones called more than max_calls times.
+        """
+        return sorted(function for function, count in self.files.get(
+            normalize_filename(filename), {}).items() if count > max_calls)
+
+
+def load_profile(path):
+    """Returns the Profile of a .json call count file or a pstats dump."""
+    if path.endswith('.json'):
+        return Profile.from_counts(path)
+    return Profile.from_pstats(path)
@@ -0,0 +1,151 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import functools
+import inspect
+import opcode
+import types
+import weakref
+
+
+CO_OPTIMIZED = 0x0001
+CO_NEWLOCALS = 0x0002
+CO_VARARGS = 0x0004
+CO_VARKEYWORDS = 0x0008
+CO_NOFREE = 0x0040
+
+
+def iter_functions(namespace):
+    """Yields the functions defined in the module with the given namespace.
+
+    Besides the functions stored in the namespace, it looks into the classes
+    (including static and class methods and properties) and into the closures
+    of functions, so functions hidden by decorators are found too. Only the
+    functions whose globals are the namespace are yielded.
+    """
+    seen = set()
+    pending = list(namespace.values())
+    while pending:
+        value = pending.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+
+        if isinstance(value, types.FunctionType):
+            if value.func_globals is namespace:
+                yield value
+            for cell in value.func_closure or ():
+                try:
+                    pending.append(cell.cell_contents)
+                except ValueError:
+                    pass
+        elif isinstance(value, (staticmethod, classmethod)):
+            pending.append(value.__func__)
+        elif isinstance(value, property):
+            pending.extend([value.fget, value.fset, value.fdel])
+        elif inspect.isclass(value):
+            if getattr(value, '__module__', None) == namespace.get('__name__'):
+                pending.extend(vars(value).values())
+
+
+def make_trampoline(code, activate):
+    """Returns a code object that activates a function before calling it.
+
+    The returned code has the same signature, free variables and metadata as
+    code. When executed it calls activate(), which must return the function
+    to call, and then calls it with the received arguments. It is meant to be
+    set as the func_code of a function, with activate replacing it with the
+    real code.
+
+    Args:
+      code: the types.CodeType of the function.
+      activate: a callable with no arguments.
+
+    Returns:
+      a types.CodeType object.
+    """
+    varargs = bool(code.co_flags & CO_VARARGS)
+    varkwargs = bool(code.co_flags & CO_VARKEYWORDS)
+    varnames = code.co_varnames[:code.co_argcount + varargs + varkwargs]
+
+    def emit(name, arg=None):
+        instructions.append(opcode.opmap[name])
+        if arg is not None:
+            instructions.extend([arg & 0xFF, arg >> 8])
+
+    instructions = []
+    emit('LOAD_CONST', 1)
+    emit('CALL_FUNCTION', 0)
+    for i in xrange(code.co_argcount):
+        emit('LOAD_FAST', i)
+    if varargs:
+        emit('LOAD_FAST', code.co_argcount)
+    if varkwargs:
+        emit('LOAD_FAST', len(varnames) - 1)
+    if varargs and varkwargs:
+        emit('CALL_FUNCTION_VAR_KW', code.co_argcount)
+    elif varargs:
+        emit('CALL_FUNCTION_VAR', code.co_argcount)
+    elif varkwargs:
+        emit('CALL_FUNCTION_KW', code.co_argcount)
+    else:
+        emit('CALL_FUNCTION', code.co_argcount)
+    emit('RETURN_VALUE')
+
+    flags = CO_OPTIMIZED | CO_NEWLOCALS
+    if varargs:
+        flags |= CO_VARARGS
+    if varkwargs:
+        flags |= CO_VARKEYWORDS
+    if not code.co_freevars:
+        flags |= CO_NOFREE
+
+    return types.CodeType(
+        code.co_argcount, len(varnames), code.co_argcount + 3, flags,
+        ''.join(map(chr, instructions)), (None, activate), (), varnames,
+        code.co_filename, code.co_name, code.co_firstlineno, '',
+        code.co_freevars, ())
+
+
+class LazyPatcher(object):
+    """Patches the functions of a module the first time they are called.
+
+    Each function gets a trampoline code (see make_trampoline), which replaces
+    the function code with its patched version and then runs it. Patched code
+    objects are memoized, so functions sharing code are patched only once.
+
+    Args:
+      patch: a function receiving a code object and returning the patched one.
+    """
+    def __init__(self, patch):
+        self.patch = patch
+        self.patched_code = weakref.WeakKeyDictionary()
+
+    def install(self, namespace):
+        """Installs trampolines in the functions of the module namespace."""
+        for function in iter_functions(namespace):
+            function.func_code = make_trampoline(
+                function.func_code,
+                functools.partial(self.activate, function, function.func_code))
+
+    def get_patched_code(self, code):
+        """Returns the memoized patched version of code."""
+        patched = self.patched_code.get(code)
+        if patched is None:
+            patched = self.patched_code[code] = self.patch(code)
+        return patched
+
+    def activate(self, function, code):
+        """Replaces the code of function by its patched version."""
+        function.func_code = self.get_patched_code(code)
+        return function
@@ -0,0 +1,135 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import fnmatch
+import os
+
+import asm
+import hotness
+
+
+INCLUDE_ENVIRONMENT_VARIABLE = 'EXCEPTIONS_IMPROVED_INCLUDE'
+EXCLUDE_ENVIRONMENT_VARIABLE = 'EXCEPTIONS_IMPROVED_EXCLUDE'
+PATHS_ENVIRONMENT_VARIABLE = 'EXCEPTIONS_IMPROVED_PATHS'
+OPCODES_ENVIRONMENT_VARIABLE = 'EXCEPTIONS_IMPROVED_OPCODES'
+PROFILE_ENVIRONMENT_VARIABLE = 'EXCEPTIONS_IMPROVED_PROFILE'
+MAX_CALLS_ENVIRONMENT_VARIABLE = 'EXCEPTIONS_IMPROVED_MAX_CALLS'
+
+# Functions called more times than this in the profile are not instrumented.
+DEFAULT_MAX_CALLS = 10000
+
+
+def matches_module(module_name, patterns):
+    """Returns whether the module or one of its packages matches a pattern.
+
+    Patterns are fnmatch globs over the dotted module name, so 'foo' matches
+    both the package foo and the module foo.bar.
+    """
+    for pattern in patterns:
+        if (fnmatch.fnmatchcase(module_name, pattern) or
+                fnmatch.fnmatchcase(module_name, pattern + '.*')):
+            return True
+    return False
+
+
+def split_list(value, separator=','):
+    """Splits a string into a list, dropping empty elements."""
+    return [item.strip() for item in value.split(separator) if item.strip()]
+
+
+class InstrumentationPolicy(object):
+    """Decides which modules get patched and which opcodes are instrumented.
+
+    A module is patched when its name matches one of the include patterns (or
+    there are none), it does not match any exclude pattern and its file lies
+    under one of the path prefixes (or there are none). Within patched
+    modules, the code objects of the functions called more than max_calls
+    times in the profile are left uninstrumented (see should_skip_code).
+
+    Args:
+      include: a list of module patterns (see matches_module).
+      exclude: a list of module patterns (see matches_module).
+      paths: a list of directories.
+      families: a sequence of elements of asm.FAMILIES.
+      profile: a hotness.Profile or None.
+      max_calls: the hotness threshold.
+    """
+    def __init__(self, include=None, exclude=None, paths=None,
+                 families=asm.FAMILIES, profile=None,
+                 max_calls=DEFAULT_MAX_CALLS):
+        for family in families:
+            if family not in asm.FAMILIES:
+                raise ValueError('Unknown opcode family: %r' % (family,))
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        self.paths = [os.path.join(os.path.abspath(path), '')
+                      for path in paths or []]
+        self.families = tuple(families)
+        self.profile = profile
+        self.max_calls = max_calls
+
+    @classmethod
+    def from_environment(cls, environ=None):
+        """Builds a policy from the EXCEPTIONS_IMPROVED_* variables.
+
+        INCLUDE, EXCLUDE and OPCODES are comma separated lists, PATHS is
+        separated by os.pathsep, PROFILE is the path of a profile (see
+        hotness.load_profile) and MAX_CALLS an integer.
+        """
+        if environ is None:
+            environ = os.environ
+        families = split_list(environ.get(OPCODES_ENVIRONMENT_VARIABLE, ''))
+        profile = None
+        if environ.get(PROFILE_ENVIRONMENT_VARIABLE):
+            profile = hotness.load_profile(
+                environ[PROFILE_ENVIRONMENT_VARIABLE])
+        return cls(
+            include=split_list(environ.get(INCLUDE_ENVIRONMENT_VARIABLE, '')),
+            exclude=split_list(environ.get(EXCLUDE_ENVIRONMENT_VARIABLE, '')),
+            paths=split_list(environ.get(PATHS_ENVIRONMENT_VARIABLE, ''),
+                             os.pathsep),
+            families=families or asm.FAMILIES,
+            profile=profile,
+            max_calls=int(environ.get(MAX_CALLS_ENVIRONMENT_VARIABLE,
+                                      DEFAULT_MAX_CALLS)))
+
+    def should_instrument(self, module_name, file_path):
+        """Returns whether the module stored in file_path should be patched."""
+        if self.include and not matches_module(module_name, self.include):
+            return False
+        if matches_module(module_name, self.exclude):
+            return False
+        if self.paths:
+            file_path = os.path.abspath(file_path)
+            return any(os.path.join(file_path, '').startswith(path)
+                       for path in self.paths)
+        return True
+
+    def should_skip_code(self, f_code):
+        """Returns whether the rewriter.Code object is hot in the profile."""
+        return self.profile is not None and self.profile.get_calls(
+            f_code.filename, f_code.firstlineno, f_code.name) > self.max_calls
+
+    def get_options(self):
+        """Returns a tuple with the options affecting the patched code."""
+        return self.families
+
+    def get_file_options(self, file_path):
+        """Returns a tuple with the options affecting the code of a file.
+
+        These are the functions of the file left uninstrumented.
+        """
+        if self.profile is None:
+            return ()
+        return tuple(self.profile.get_hot_functions(file_path,
+                                                    self.max_calls))
@@ -0,0 +1,212 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Recovery of the operands of a failed operation from a traceback.
+
+Instead of patching the code, the failing instruction of a frame (tb_lasti) is
+analyzed after the exception was raised. The instructions of its basic block
+are symbolically executed to find out which expressions produced the operands,
+and these are evaluated again against the locals and globals of the frame.
+
+Only side-effect-free expressions are evaluated: names, constants, attribute
+chains and subscripts of builtin containers. Operands produced in any other way
+(e.g. by a call) are not recovered.
+"""
+import dis
+
+import bytecode
+
+
+SUBSCRIPT_OPCODES = (bytecode.BINARY_SUBSCR, bytecode.STORE_SUBSCR,
+                     bytecode.DELETE_SUBSCR)
+ATTRIBUTE_OPCODES = (bytecode.LOAD_ATTR, bytecode.STORE_ATTR,
+                     bytecode.DELETE_ATTR)
+
+# Containers whose subscripts are evaluated again.
+SUBSCRIPTABLE_TYPES = (dict, list, tuple, str, unicode)
+
+# Expressions are represented as tuples whose first element is its kind.
+UNKNOWN = ('unknown',)
+
+
+class RecoveryError(Exception):
+    """Raised when an expression cannot be evaluated again."""
+
+
+def get_block_start(code, lasti):
+    """Returns the offset where the basic block containing lasti starts.
+
+    The block is also cut at the beginning of the line, so the analysis never
+    looks further than the current statement.
+    """
+    start = 0
+    for offset, _ in dis.findlinestarts(code):
+        if offset <= lasti:
+            start = max(start, offset)
+    for offset in dis.findlabels(code.co_code):
+        if offset <= lasti:
+            start = max(start, offset)
+    for offset, op, arg in bytecode.iter_instructions(code.co_code):
+        if offset >= lasti:
+            break
+        if op in bytecode.JUMP_OPCODES:
+            start = max(start, offset + 3)
+    return start
+
+
+def get_operand_expressions(code, lasti):
+    """Returns the expressions on the stack before the instruction at lasti.
+
+    Returns:
+      a list of expressions, the last one being the top of the stack, or None
+      if the block contains instructions that cannot be analyzed. Elements
+      below the start of the block are never returned, so the list may be
+      shorter than the real stack.
+    """
+    start = get_block_start(code, lasti)
+    cell_names = code.co_cellvars + code.co_freevars
+    stack = []
+
+    def pop():
+        return stack.pop() if stack else UNKNOWN
+
+    for offset, op, arg in bytecode.iter_instructions(code.co_code):
+        if offset < start:
+            continue
+        if offset >= lasti:
+            break
+
+        if op == bytecode.LOAD_FAST:
+            stack.append(('local', code.co_varnames[arg]))
+        elif op == bytecode.LOAD_DEREF:
+            stack.append(('local', cell_names[arg]))
+        elif op == bytecode.LOAD_GLOBAL:
+            stack.append(('global', code.co_names[arg]))
+        elif op == bytecode.LOAD_NAME:
+            stack.append(('name', code.co_names[arg]))
+        elif op == bytecode.LOAD_CONST:
+            stack.append(('const', code.co_consts[arg]))
+        elif op == bytecode.LOAD_ATTR:
+            stack.append(('attr', pop(), code.co_names[arg]))
+        elif op == bytecode.BINARY_SUBSCR:
+            key = pop()
+            stack.append(('subscr', pop(), key))
+        elif op == bytecode.DUP_TOP:
+            stack.append(stack[-1] if stack else UNKNOWN)
+        elif op == bytecode.DUP_TOPX:
+            top = [pop() for _ in xrange(arg)][::-1]
+            stack.extend(top + top)
+        elif op in (bytecode.ROT_TWO, bytecode.ROT_THREE, bytecode.ROT_FOUR):
+            depth = {bytecode.ROT_TWO: 2, bytecode.ROT_THREE: 3,
+                     bytecode.ROT_FOUR: 4}[op]
+            items = [pop() for _ in xrange(depth)][::-1]
+            stack.extend(items[-1:] + items[:-1])
+        else:
+            effect = bytecode.get_stack_effect(op, arg)
+            if effect is None:
+                return None
+            popped, pushed = effect
+            for _ in xrange(popped):
+                pop()
+            stack.extend([UNKNOWN] * pushed)
+    return stack
+
+
+def evaluate(expression, frame):
+    """Evaluates an expression in the context of frame.
+
+    Raises:
+      RecoveryError: if the expression cannot be evaluated.
+    """
+    kind = expression[0]
+    if kind == 'const':
+        return expression[1]
+    if kind in ('local', 'global', 'name'):
+        name = expression[1]
+        namespaces = {
+            'local': [frame.f_locals],
+            'global': [frame.f_globals, frame.f_builtins],
+            'name': [frame.f_locals, frame.f_globals, frame.f_builtins],
+        }[kind]
+        for namespace in namespaces:
+            if name in namespace:
+                return namespace[name]
+        raise RecoveryError(name)
+    if kind == 'attr':
+        try:
+            return getattr(evaluate(expression[1], frame), expression[2])
+        except Exception:
+            raise RecoveryError(expression[2])
+    if kind == 'subscr':
+        container = evaluate(expression[1], frame)
+        if type(container) not in SUBSCRIPTABLE_TYPES:
+            raise RecoveryError('subscript')
+        try:
+            return container[evaluate(expression[2], frame)]
+        except Exception:
+            raise RecoveryError('subscript')
+    raise RecoveryError(kind)
+
+
+def get_failing_traceback(tb):
+    """Returns the innermost traceback entry failing in an operation.
+
+    The operation is an attribute access or subscript, or None if no entry of
+    the traceback failed in such an operation.
+    """
+    result = None
+    while tb:
+        code = tb.tb_frame.f_code
+        if ord(code.co_code[tb.tb_lasti]) in (SUBSCRIPT_OPCODES +
+                                              ATTRIBUTE_OPCODES):
+            result = tb
+        tb = tb.tb_next
+    return result
+
+
+def get_debug_vars(tb):
+    """Recovers the operands of the operation that raised the exception.
+
+    It has the same interface as debug_exception.get_debug_vars.
+    """
+    tb = get_failing_traceback(tb)
+    if tb is None:
+        return None, None, False, False
+
+    frame = tb.tb_frame
+    op = ord(frame.f_code.co_code[tb.tb_lasti])
+    stack = get_operand_expressions(frame.f_code, tb.tb_lasti)
+    if not stack:
+        return None, None, False, False
+
+    if op in ATTRIBUTE_OPCODES:
+        object_expression, key_expression = stack[-1], None
+    elif len(stack) >= 2:
+        object_expression, key_expression = stack[-2], stack[-1]
+    else:
+        object_expression, key_expression = UNKNOWN, stack[-1]
+
+    attr = index = None
+    attr_set = index_set = False
+    try:
+        attr = evaluate(object_expression, frame)
+        attr_set = True
+    except RecoveryError:
+        pass
+    if key_expression is not None:
+        try:
+            index = evaluate(key_expression, frame)
+            index_set = True
+        except RecoveryError:
+            pass
+    return attr, index, attr_set, index_set
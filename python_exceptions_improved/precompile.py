@@ -0,0 +1,195 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Ahead of time instrumentation of source trees.
+
+compile_paths patches the modules under some directories in a pool of worker
+processes and stores the patched code in a cache.CodeCache. A
+debug_exception.ModuleImporter using the same cache and options then loads it
+directly, without parsing nor patching the modules.
+
+Each directory is handled as an entry of sys.path: its source files are top
+level modules and its subdirectories with an __init__.py file are packages.
+Entries of the cache are keyed by the path of the module, so the directories
+must be given as they appear in sys.path when the tests run (for example
+absolute). Modules whose entry is already in the cache are up to date and are
+not compiled again.
+"""
+import multiprocessing
+import os
+import time
+
+import asm
+import debug_exception
+
+
+COMPILED = 'compiled'
+UP_TO_DATE = 'up to date'
+# Rejected by the instrumentation policy.
+SKIPPED = 'skipped'
+FAILED = 'failed'
+STATUSES = (COMPILED, UP_TO_DATE, SKIPPED, FAILED)
+
+
+def iter_modules(directory, package=''):
+    """Yields (module name, file path) for the source modules in directory.
+
+    Args:
+      directory: an entry of sys.path, or the directory of a package.
+      package: the name of the package of directory followed by a dot, or the
+        empty string for an entry of sys.path.
+    """
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(directory, name)
+        if name.endswith('.py'):
+            module_name = name[:-len('.py')]
+            if module_name == '__init__':
+                if package:
+                    yield package[:-1], path
+            elif '.' not in module_name:
+                yield package + module_name, path
+        elif '.' not in name and os.path.isfile(os.path.join(path,
+                                                             '__init__.py')):
+            for module in iter_modules(path, package + name + '.'):
+                yield module
+
+
+def iter_paths(paths):
+    """Yields (module name, file path) for the modules of files or directories.
+
+    Files are taken as top level modules.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for module in iter_modules(path):
+                yield module
+        else:
+            yield os.path.splitext(os.path.basename(path))[0], path
+
+
+_importer = None
+
+
+def init_worker(code_cache, capture=asm.CAPTURE_GLOBALS, policy=None,
+                lazy=False, switchable=False):
+    """Creates the importer patching the modules in this process."""
+    global _importer
+    _importer = debug_exception.ModuleImporter(
+        cache=code_cache, capture=capture, policy=policy, lazy=lazy,
+        switchable=switchable)
+    _importer.uninstall()
+
+
+def compile_module(module):
+    """Patches a module and stores it in the cache, unless it is up to date.
+
+    Args:
+      module: a pair (module name, file path).
+
+    Returns:
+      a tuple (file path, one of STATUSES, error message or None).
+    """
+    module_name, file_path = module
+    if not _importer.policy.should_instrument(module_name, file_path):
+        return file_path, SKIPPED, None
+    try:
+        with open(file_path, 'U') as f:
+            source = f.read()
+        key = _importer.get_cache_key(source, file_path)
+        if os.path.exists(_importer.cache.get_path(key)):
+            return file_path, UP_TO_DATE, None
+        _importer.get_patched_code(
+            source, file_path, debug_exception.get_source_compiler(file_path))
+    except Exception as e:
+        return file_path, FAILED, '%s: %s' % (type(e).__name__, e)
+    return file_path, COMPILED, None
+
+
+class PrecompileReport(object):
+    """Outcome of compile_paths.
+
+    counts maps each of STATUSES to the number of modules with it, failures
+    is a list of (file path, error message) and elapsed is in seconds.
+    """
+    def __init__(self):
+        self.counts = dict.fromkeys(STATUSES, 0)
+        self.failures = []
+        self.elapsed = 0.0
+
+    def add(self, result, callback=None):
+        file_path, status, error = result
+        self.counts[status] += 1
+        if status == FAILED:
+            self.failures.append((file_path, error))
+        if callback is not None:
+            callback(result)
+
+    @property
+    def files(self):
+        return sum(self.counts.values())
+
+    def get_files_per_second(self):
+        if not self.elapsed:
+            return 0.0
+        return self.files / self.elapsed
+
+    def get_summary(self):
+        """Returns a line with the counts and the files per second."""
+        return '%d files (%s) in %.3fs, %.1f files/s' % (
+            self.files,
+            ', '.join('%d %s' % (self.counts[status], status)
+                      for status in STATUSES),
+            self.elapsed, self.get_files_per_second())
+
+
+def compile_paths(paths, code_cache, capture=asm.CAPTURE_GLOBALS, policy=None,
+                  lazy=False, switchable=False, jobs=1, callback=None):
+    """Patches the modules under paths and stores them in code_cache.
+
+    Args:
+      paths: a list of directories (see the module docstring) or files.
+      code_cache: a cache.CodeCache.
+      capture, policy, lazy, switchable: the options of the
+        debug_exception.ModuleImporter which will load the modules.
+      jobs: the number of worker processes. With 1, modules are compiled in
+        this process.
+      callback: if not None, a function called with the result of each
+        module, as returned by compile_module.
+
+    Returns:
+      a PrecompileReport.
+    """
+    init_args = (code_cache, capture, policy, lazy, switchable)
+    modules = list(iter_paths(paths))
+    report = PrecompileReport()
+    start = time.time()
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, init_worker, init_args)
+        try:
+            results = pool.imap_unordered(compile_module, modules,
+                                          chunksize=8)
+            for result in results:
+                report.add(result, callback)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        init_worker(*init_args)
+        for module in modules:
+            report.add(compile_module(module), callback)
+    report.elapsed = time.time() - start
+    return report
@@ -0,0 +1,131 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sys
+
+
+BUILTIN_MODULES = ('__builtin__', 'exceptions')
+
+
+class TypeRegistry(object):
+    """Index from class names to the types defined in the loaded modules.
+
+    Modules are indexed by reading their __dict__, so no attribute of the
+    module is ever looked up and no lazy module is triggered. The index is
+    refreshed only when the number of loaded modules changes, or when a name
+    cannot be found (in case a module got new classes after being indexed).
+    Names which still cannot be found are remembered as missing until the
+    number of loaded modules changes, so repeated misses do not rescan every
+    module. The modules of the candidates of a name are checked to be still
+    loaded.
+    Modules can also be explicitly added with add_module.
+
+    When several types have the same name they are resolved in the following
+    order: builtins first, then types found in the module defining them, then
+    by module name.
+
+    Args:
+      modules: the dictionary of loaded modules, sys.modules by default.
+    """
+    def __init__(self, modules=None):
+        self.modules = sys.modules if modules is None else modules
+        # name -> {module name: type}
+        self.index = {}
+        # module name -> (module, size of its dict, names of its types)
+        self.indexed = {}
+        self.indexed_count = None
+        # names not found since the number of loaded modules last changed
+        self.missing = set()
+
+    def add_module(self, module_name, module):
+        """Indexes (again) the types of a module."""
+        self.remove_module(module_name)
+        namespace = getattr(module, '__dict__', None)
+        if namespace is None:
+            return
+        names = set()
+        for value in namespace.values():
+            if isinstance(value, type):
+                name = value.__name__
+                self.index.setdefault(name, {})[module_name] = value
+                names.add(name)
+        self.indexed[module_name] = (module, len(namespace), names)
+
+    def remove_module(self, module_name):
+        """Removes the types of a module from the index."""
+        if module_name not in self.indexed:
+            return
+        for name in self.indexed.pop(module_name)[2]:
+            candidates = self.index[name]
+            candidates.pop(module_name, None)
+            if not candidates:
+                del self.index[name]
+
+    def refresh(self, full=False):
+        """Indexes the modules which were loaded or replaced since last time.
+
+        If full is true, modules whose namespace changed size are also
+        indexed again.
+        """
+        if not full and len(self.modules) == self.indexed_count:
+            return
+        for module_name, module in self.modules.items():
+            if module is None:
+                continue
+            indexed = self.indexed.get(module_name)
+            if (indexed is None or indexed[0] is not module or
+                    (full and len(getattr(module, '__dict__', ())) !=
+                     indexed[1])):
+                self.add_module(module_name, module)
+        for module_name in set(self.indexed) - set(self.modules):
+            self.remove_module(module_name)
+        self.indexed_count = len(self.modules)
+        self.missing.clear()
+
+    def get_candidates(self, class_name):
+        """Returns the types named class_name in resolution order.
+
+        Types of modules which are no longer loaded are dropped.
+        """
+        candidates = self.index.get(class_name, {})
+        for module_name in list(candidates):
+            module = self.indexed[module_name][0]
+            if self.modules.get(module_name) is not module:
+                self.remove_module(module_name)
+
+        def resolution_key(item):
+            module_name, class_type = item
+            return (module_name not in BUILTIN_MODULES,
+                    class_type.__module__ != module_name,
+                    module_name)
+        types = []
+        for _, class_type in sorted(candidates.items(), key=resolution_key):
+            if class_type not in types:
+                types.append(class_type)
+        return types
+
+    def lookup(self, class_name):
+        """Returns the type named class_name or None if there is none."""
+        self.refresh()
+        if class_name in self.missing:
+            return None
+        candidates = self.get_candidates(class_name)
+        if not candidates:
+            self.refresh(full=True)
+            candidates = self.get_candidates(class_name)
+        if candidates:
+            return candidates[0]
+        self.missing.add(class_name)
+
+
+TYPES = TypeRegistry()
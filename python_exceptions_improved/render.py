@@ -0,0 +1,279 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Rendering of captured objects with bounded size and cost.
+
+Containers are rendered with at most a few elements per level and a few
+levels, strings and other reprs are truncated, and the scans looking for keys
+similar to a missing one stop after MAX_SCANNED_KEYS keys or TIME_BUDGET
+seconds. Only the builtin reprs of SCALAR_TYPES are called, so subclasses are
+rendered as their builtin base. Other objects with a length are rendered as
+containers, and the rest as with object.__repr__. So the cost of the debug
+info does not depend on the size of the objects involved. Small builtin
+objects are rendered as with str/repr.
+"""
+import datetime
+import heapq
+import itertools
+import numbers
+import repr as reprlib
+import time
+import types
+
+import suggest
+
+
+MAX_ATTRIBUTES = 100
+MAX_ITEMS = 10
+MAX_PREVIEW = 5
+MAX_SCANNED_KEYS = 10000
+TIME_BUDGET = 0.05
+
+# Types whose repr does not grow with the size of their instances.
+SCALAR_TYPES = (types.NoneType, numbers.Number, basestring, datetime.date,
+                datetime.time, datetime.timedelta, types.ModuleType,
+                types.FunctionType, types.BuiltinFunctionType,
+                types.MethodType, type, types.ClassType)
+
+# Type of the __repr__ of the types implemented in C.
+BUILTIN_REPR_TYPE = type(object.__repr__)
+
+
+class BoundedRepr(reprlib.Repr):
+    """reprlib.Repr which never sorts nor fully iterates containers.
+
+    Subclasses of the builtin containers are rendered as their base, and the
+    attribute truncated tells whether some part of the last object rendered was
+    left out.
+    """
+    def __init__(self):
+        reprlib.Repr.__init__(self)
+        self.maxlevel = 3
+        self.maxtuple = self.maxlist = MAX_ITEMS
+        self.maxset = self.maxfrozenset = MAX_ITEMS
+        self.maxdeque = self.maxarray = self.maxdict = MAX_ITEMS
+        self.maxstring = 80
+        self.maxlong = 80
+        self.maxother = 200
+        self.truncated = False
+
+    def repr(self, x):
+        self.truncated = False
+        return self.repr1(x, self.maxlevel)
+
+    def repr1(self, x, level):
+        for base in (dict, list, tuple, set, frozenset):
+            if isinstance(x, base) and type(x) is not base:
+                return '%s(%s)' % (type(x).__name__,
+                                   getattr(self, 'repr_' + base.__name__)(
+                                       x, level))
+        typename = '_'.join(type(x).__name__.split())
+        if not hasattr(self, 'repr_' + typename):
+            # reprlib.Repr would call the full repr of x.
+            return self.repr_instance(x, level)
+        result = reprlib.Repr.repr1(self, x, level)
+        if isinstance(x, basestring) and len(x) > self.maxstring:
+            self.truncated = True
+        return result
+
+    def repr_instance(self, x, level):
+        if isinstance(x, SCALAR_TYPES):
+            try:
+                result = get_builtin_repr(type(x))(x)
+            except Exception:
+                return get_default_repr(x)
+            if len(result) > self.maxother:
+                self.truncated = True
+                half = max(0, (self.maxother - 3) // 2)
+                result = result[:half] + '...' + result[len(result) - half:]
+            return result
+        # Other reprs may render the whole object, so only containers are
+        # rendered, with their first items.
+        try:
+            length = len(x)
+            if length and level > 0:
+                iterator = iter(x)
+                if iterator is x:
+                    return get_default_repr(x)
+                items = list(itertools.islice(iterator, MAX_ITEMS))
+        except Exception:
+            return get_default_repr(x)
+        if not length:
+            pieces = []
+        elif level <= 0:
+            self.truncated = True
+            pieces = ['...']
+        else:
+            pieces = [self.repr1(item, level - 1) for item in items]
+            if length > len(items):
+                self.truncated = True
+                pieces.append('...')
+        return '%s([%s])' % (get_type(x).__name__, ', '.join(pieces))
+
+    def _repr_items(self, items, level, maxiter, render):
+        if not items:
+            return ''
+        if level <= 0:
+            self.truncated = True
+            return '...'
+        pieces = [render(item, level - 1)
+                  for item in itertools.islice(items, maxiter)]
+        if len(items) > maxiter:
+            self.truncated = True
+            pieces.append('...')
+        return ', '.join(pieces)
+
+    def repr_tuple(self, x, level):
+        if len(x) == 1:
+            return '(%s,)' % self._repr_items(x, level, self.maxtuple,
+                                              self.repr1)
+        return '(%s)' % self._repr_items(x, level, self.maxtuple, self.repr1)
+
+    def repr_list(self, x, level):
+        return '[%s]' % self._repr_items(x, level, self.maxlist, self.repr1)
+
+    def repr_dict(self, x, level):
+        if not x:
+            return '{}'
+
+        def render(key, level):
+            return '%s: %s' % (self.repr1(key, level),
+                               self.repr1(x[key], level))
+        return '{%s}' % self._repr_items(x, level, self.maxdict, render)
+
+    def repr_set(self, x, level):
+        if not x:
+            return 'set([])'
+        return 'set([%s])' % self._repr_items(x, level, self.maxset,
+                                              self.repr1)
+
+    def repr_frozenset(self, x, level):
+        if not x:
+            return 'frozenset([])'
+        return 'frozenset([%s])' % self._repr_items(
+            x, level, self.maxfrozenset, self.repr1)
+
+
+def get_type(obj):
+    """Returns the class of obj, without running any code of obj."""
+    if isinstance(obj, types.InstanceType):
+        return obj.__class__
+    return type(obj)
+
+
+def get_builtin_repr(cls):
+    """Returns the first __repr__ implemented in C in the MRO of cls."""
+    for base in cls.__mro__:
+        method = vars(base).get('__repr__')
+        if isinstance(method, BUILTIN_REPR_TYPE):
+            return method
+    return object.__repr__
+
+
+def get_default_repr(obj):
+    """Returns the repr of obj given by object.__repr__."""
+    cls = get_type(obj)
+    return '<%s.%s object at %#x>' % (cls.__module__, cls.__name__, id(obj))
+
+
+def get_length(obj):
+    try:
+        return len(obj)
+    except Exception:
+        return None
+
+
+def render_repr(obj):
+    """Returns a bounded repr of obj, with its length if it was truncated."""
+    bounded_repr = BoundedRepr()
+    result = bounded_repr.repr(obj)
+    length = get_length(obj)
+    if bounded_repr.truncated and length is not None:
+        result += ' (%d items)' % length
+    return result
+
+
+def render_str(obj):
+    """Like render_repr, but strings are rendered as with str."""
+    if isinstance(obj, basestring):
+        if len(obj) <= BoundedRepr().maxstring:
+            return obj
+        return '%s... (%d items)' % (obj[:BoundedRepr().maxstring], len(obj))
+    return render_repr(obj)
+
+
+def render_attributes(attributes, count=None):
+    """Returns the list of attributes with at most MAX_ATTRIBUTES elements.
+
+    count is the total number of attributes, if attributes was already
+    truncated.
+    """
+    if count is None:
+        count = len(attributes)
+    if count <= MAX_ATTRIBUTES:
+        return str(attributes)
+    return '%s (%d more)' % (attributes[:MAX_ATTRIBUTES],
+                             count - MAX_ATTRIBUTES)
+
+
+def scan_keys(container):
+    """Yields the keys of container within the scan limits."""
+    deadline = time.time() + TIME_BUDGET
+    for i, key in enumerate(itertools.islice(container, MAX_SCANNED_KEYS)):
+        if i % 1000 == 999 and time.time() > deadline:
+            return
+        yield key
+
+
+def get_similar_keys(container, key):
+    """Returns up to MAX_PREVIEW keys of a mapping close to the missing key.
+
+    String keys are compared by similarity and numbers by distance. Only the
+    keys within the scan limits are considered.
+    """
+    if not isinstance(container, dict) and not hasattr(container, 'keys'):
+        return []
+    try:
+        if isinstance(key, basestring):
+            candidates = [k for k in scan_keys(container)
+                          if isinstance(k, basestring)]
+            return suggest.SuggestionIndex(candidates).suggest(
+                key)[:MAX_PREVIEW]
+        if isinstance(key, numbers.Real) and not isinstance(key, bool):
+            candidates = [k for k in scan_keys(container)
+                          if isinstance(k, numbers.Real) and
+                          not isinstance(k, bool)]
+            return heapq.nsmallest(MAX_PREVIEW, candidates,
+                                   key=lambda k: abs(k - key))
+    except Exception:
+        pass
+    return []
+
+
+def get_nearby_items(sequence, index):
+    """Returns up to MAX_PREVIEW (index, item) pairs closest to index.
+
+    The index is assumed to be out of range, so the last items are returned
+    for positive indexes and the first ones for negative indexes.
+    """
+    length = get_length(sequence)
+    if not length or not isinstance(index, (int, long)):
+        return []
+    if index >= 0:
+        start, end = max(0, length - MAX_PREVIEW), length
+    else:
+        start, end = 0, min(length, MAX_PREVIEW)
+    try:
+        return [(i, sequence[i]) for i in xrange(start, end)]
+    except Exception:
+        return []
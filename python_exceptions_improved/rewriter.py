@@ -0,0 +1,508 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Disassembly and assembly of code objects.
+
+A code object is decoded into a Code object, whose attribute code is a list of
+(opcode, argument) pairs where jumps point to Label markers, line starts are
+SetLineno markers and the arguments are resolved to constants, names and
+labels. asm patches that list, and Code.to_code assembles it again.
+
+The representation and the assembled code objects are the same as those of
+byteplay 0.2: constants, names and variables are numbered in order of first
+use, the line number table, flags and stack size are computed the same way, and
+nested code objects are decoded and assembled recursively. So patching gives
+the same bytecode as with byteplay, except that EXTENDED_ARG prefixes, which
+byteplay cannot decode, are supported. Constants and names are numbered with
+dictionaries instead of list searches, so each step is linear in the size of
+the code.
+"""
+import opcode
+import types
+
+import bytecode
+
+
+HASCONST = frozenset(opcode.hasconst)
+HASNAME = frozenset(opcode.hasname)
+HASJREL = frozenset(opcode.hasjrel)
+HASJABS = frozenset(opcode.hasjabs)
+HASJUMP = HASJREL | HASJABS
+HASLOCAL = frozenset(opcode.haslocal)
+HASCOMPARE = frozenset(opcode.hascompare)
+HASFREE = frozenset(opcode.hasfree)
+HASCODE = frozenset([bytecode.MAKE_FUNCTION, bytecode.MAKE_CLOSURE])
+CMP_OP_INDEXES = dict((name, index)
+                      for index, name in enumerate(opcode.cmp_op))
+
+# Opcodes after which the execution does not continue with the next one.
+TERMINAL_OPCODES = frozenset([bytecode.STOP_CODE, bytecode.RETURN_VALUE,
+                              bytecode.RAISE_VARARGS, bytecode.BREAK_LOOP])
+
+CO_OPTIMIZED = 0x0001
+CO_NEWLOCALS = 0x0002
+CO_VARARGS = 0x0004
+CO_VARKEYWORDS = 0x0008
+CO_GENERATOR = 0x0020
+CO_NOFREE = 0x0040
+
+
+# Net stack effect of the opcodes with a fixed one.
+NET_STACK_EFFECTS = dict(
+    (op, pushed - popped)
+    for op, (popped, pushed) in bytecode.FIXED_STACK_EFFECTS.items())
+NET_STACK_EFFECTS.update({bytecode.DUP_TOP: 1, bytecode.ROT_TWO: 0,
+                          bytecode.ROT_THREE: 0, bytecode.ROT_FOUR: 0})
+
+# Opcodes which jump, end the execution or change the blocks.
+FLOW_OPCODES = TERMINAL_OPCODES | HASJUMP | frozenset([
+    bytecode.POP_BLOCK, bytecode.END_FINALLY, bytecode.WITH_CLEANUP])
+
+
+class Label(object):
+    """Target of jumps, placed just before the instruction it points to."""
+
+
+class SetLinenoType(object):
+    def __repr__(self):
+        return 'SetLineno'
+
+
+# Marker of the start of a line. Its argument is the line number.
+SetLineno = SetLinenoType()
+
+
+def isopcode(op):
+    """Returns whether op is an opcode and not a Label or SetLineno."""
+    return isinstance(op, int)
+
+
+def find_line_starts(code):
+    """Yields the (offset, line number) pairs of the lines of a code object.
+
+    Unlike dis.findlinestarts, an offset is yielded whenever the offset
+    increment of an entry of co_lnotab is not zero, even if the line number
+    does not change.
+    """
+    lnotab = code.co_lnotab
+    lineno = code.co_firstlineno
+    offset = 0
+    for i in xrange(0, len(lnotab), 2):
+        offset_increment = ord(lnotab[i])
+        if offset_increment:
+            yield offset, lineno
+            offset += offset_increment
+        lineno += ord(lnotab[i + 1])
+    yield offset, lineno
+
+
+def find_labels(co_code):
+    """Returns a dictionary from the jump targets of co_code to new Labels."""
+    labels = {}
+    for offset, op, arg in bytecode.iter_instructions(co_code):
+        if op in HASJREL:
+            labels[offset + 3 + arg] = Label()
+        elif op in HASJABS:
+            labels[arg] = Label()
+    return labels
+
+
+def grow(stack, n):
+    """Returns stack with n more objects in its last block."""
+    if stack[-1] + n < 0:
+        raise ValueError('Popped a non-existing element')
+    return stack[:-1] + (stack[-1] + n,)
+
+
+def get_next_stacks(code, label_positions, position, stack):
+    """Returns the (position, stack) pairs reached from a flow instruction.
+
+    The stack is the state before the instruction (see Code.get_stacksize).
+    """
+    op, arg = code[position]
+    if op in TERMINAL_OPCODES:
+        return []
+    if op in (bytecode.JUMP_FORWARD, bytecode.JUMP_ABSOLUTE):
+        return [(label_positions[arg], stack)]
+    if op in (bytecode.POP_JUMP_IF_FALSE, bytecode.POP_JUMP_IF_TRUE):
+        return [(label_positions[arg], grow(stack, -1)),
+                (position + 1, grow(stack, -1))]
+    if op in (bytecode.JUMP_IF_TRUE_OR_POP, bytecode.JUMP_IF_FALSE_OR_POP):
+        return [(label_positions[arg], stack),
+                (position + 1, grow(stack, -1))]
+    if op == bytecode.FOR_ITER:
+        return [(label_positions[arg], grow(stack, -1)),
+                (position + 1, grow(stack, 1))]
+    if op == bytecode.CONTINUE_LOOP:
+        return [(label_positions[arg], stack[:-1])] * 2
+    if op == bytecode.SETUP_LOOP:
+        return [(label_positions[arg], stack), (position + 1, stack + (0,))]
+    if op == bytecode.SETUP_EXCEPT:
+        return [(label_positions[arg], grow(stack, 3)),
+                (position + 1, stack + (0,))]
+    if op == bytecode.SETUP_FINALLY:
+        return [(label_positions[arg], grow(stack, 1)),
+                (position + 1, stack + (0,))]
+    if op == bytecode.SETUP_WITH:
+        return [(label_positions[arg], stack),
+                (position + 1, grow(stack, -1) + (1,))]
+    if op == bytecode.POP_BLOCK:
+        return [(position + 1, stack[:-1])]
+    if op == bytecode.END_FINALLY:
+        return [(position + 1, grow(stack, -3))]
+    if op == bytecode.WITH_CLEANUP:
+        return [(position + 1, grow(stack, 2))]
+    raise ValueError('Unhandled opcode: %s' % opcode.opname[op])
+
+
+class Code(object):
+    """Editable representation of a code object.
+
+    Args:
+      code: list of (opcode, argument) pairs. The opcode may also be a Label
+        or SetLineno, with None and the line number as argument respectively.
+      freevars: names of the free variables.
+      args: names of the arguments, including *args and **kwargs.
+      varargs: whether args includes a *args argument.
+      varkwargs: whether args includes a **kwargs argument.
+      newlocals: whether the code runs in a new namespace (functions).
+      name, filename, firstlineno: as in code objects.
+      docstring: first constant of the code if it is a string, else None.
+    """
+    def __init__(self, code, freevars, args, varargs, varkwargs, newlocals,
+                 name, filename, firstlineno, docstring):
+        self.code = code
+        self.freevars = freevars
+        self.args = args
+        self.varargs = varargs
+        self.varkwargs = varkwargs
+        self.newlocals = newlocals
+        self.name = name
+        self.filename = filename
+        self.firstlineno = firstlineno
+        self.docstring = docstring
+
+    @classmethod
+    def from_code(cls, co):
+        """Decodes a code object and the code objects of its functions."""
+        co_code = co.co_code
+        consts, names, varnames = co.co_consts, co.co_names, co.co_varnames
+        cellfree = co.co_cellvars + co.co_freevars
+        labels = find_labels(co_code)
+        line_starts = dict(find_line_starts(co))
+
+        code = []
+        append = code.append
+        n = len(co_code)
+        i = 0
+        extended_arg = 0
+        while i < n:
+            op = ord(co_code[i])
+            if i in labels:
+                append((labels[i], None))
+            if i in line_starts:
+                append((SetLineno, line_starts[i]))
+            i += 1
+            if op in HASCODE:
+                previous_op, previous_arg = code[-1]
+                if previous_op != bytecode.LOAD_CONST:
+                    raise ValueError('%s should be preceded by LOAD_CONST' %
+                                     opcode.opname[op])
+                code[-1] = (previous_op, cls.from_code(previous_arg))
+            if op < opcode.HAVE_ARGUMENT:
+                append((op, None))
+                continue
+            arg = ord(co_code[i]) + ord(co_code[i + 1]) * 256 + extended_arg
+            extended_arg = 0
+            i += 2
+            if op == bytecode.EXTENDED_ARG:
+                extended_arg = arg << 16
+            elif op in HASCONST:
+                append((op, consts[arg]))
+            elif op in HASNAME:
+                append((op, names[arg]))
+            elif op in HASJABS:
+                append((op, labels[arg]))
+            elif op in HASJREL:
+                append((op, labels[i + arg]))
+            elif op in HASLOCAL:
+                append((op, varnames[arg]))
+            elif op in HASCOMPARE:
+                append((op, opcode.cmp_op[arg]))
+            elif op in HASFREE:
+                append((op, cellfree[arg]))
+            else:
+                append((op, arg))
+
+        varargs = bool(co.co_flags & CO_VARARGS)
+        varkwargs = bool(co.co_flags & CO_VARKEYWORDS)
+        if consts and isinstance(consts[0], basestring):
+            docstring = consts[0]
+        else:
+            docstring = None
+        return cls(code=code,
+                   freevars=co.co_freevars,
+                   args=varnames[:co.co_argcount + varargs + varkwargs],
+                   varargs=varargs,
+                   varkwargs=varkwargs,
+                   newlocals=bool(co.co_flags & CO_NEWLOCALS),
+                   name=co.co_name,
+                   filename=co.co_filename,
+                   firstlineno=co.co_firstlineno,
+                   docstring=docstring)
+
+    def get_flags(self):
+        """Returns co_flags. Flags of __future__ statements are not kept."""
+        opcodes = set(op for op, _ in self.code if isopcode(op))
+        flags = 0
+        if not opcodes.intersection((bytecode.STORE_NAME, bytecode.LOAD_NAME,
+                                     bytecode.DELETE_NAME)):
+            flags |= CO_OPTIMIZED
+        if self.newlocals:
+            flags |= CO_NEWLOCALS
+        if self.varargs:
+            flags |= CO_VARARGS
+        if self.varkwargs:
+            flags |= CO_VARKEYWORDS
+        if bytecode.YIELD_VALUE in opcodes:
+            flags |= CO_GENERATOR
+        if not opcodes.intersection(HASFREE):
+            flags |= CO_NOFREE
+        return flags
+
+    def get_stacksize(self):
+        """Returns the maximum stack size, exploring every path of the code.
+
+        The stack state at each instruction is a tuple with the number of
+        objects pushed in each block. It is recorded at labels, so each label
+        is explored once.
+
+        Raises:
+          ValueError: if a label is reached with different stack states, or if
+            an instruction pops more objects than there are.
+        """
+        code = self.code
+        label_positions = dict((op, position)
+                               for position, (op, _) in enumerate(code)
+                               if isinstance(op, Label))
+        # An exception in a finally block pushes 3 objects, while a return or
+        # continue pushes 2 and a POP_BLOCK 1. The targets are recorded as if
+        # 3 objects were pushed and entered as if only 1 was.
+        finally_targets = set(label_positions[arg] for op, arg in code
+                              if op == bytecode.SETUP_FINALLY)
+        stacks = [None] * len(code)
+
+        maxsize = 0
+        pending = [(0, (0,))]
+        while pending:
+            position, stack = pending.pop()
+            outer, top = stack[:-1], stack[-1]
+            outer_size = sum(outer)
+            # Instructions which only continue to the next one are explored
+            # right away, without building a new stack state.
+            while True:
+                if outer_size + top > maxsize:
+                    maxsize = outer_size + top
+                op, arg = code[position]
+                if op.__class__ is Label:
+                    if position in finally_targets:
+                        top += 2
+                    stack = outer + (top,)
+                    if stacks[position] is None:
+                        stacks[position] = stack
+                    elif stacks[position] != stack:
+                        raise ValueError('Inconsistent code')
+                    else:
+                        break
+                    position += 1
+                    continue
+                if op is SetLineno:
+                    position += 1
+                    continue
+                effect = NET_STACK_EFFECTS.get(op)
+                if effect is None and op not in FLOW_OPCODES:
+                    effect = bytecode.get_stack_effect(op, arg)
+                    if effect is None:
+                        raise ValueError('Unhandled opcode: %s' %
+                                         opcode.opname[op])
+                    effect = effect[1] - effect[0]
+                if effect is not None:
+                    top += effect
+                    if top < 0:
+                        raise ValueError('Popped a non-existing element')
+                    position += 1
+                    continue
+                pending.extend(get_next_stacks(code, label_positions,
+                                               position, outer + (top,)))
+                break
+        return maxsize
+
+    def to_code(self):
+        """Assembles a code object, and those of its functions."""
+        code = self.code
+        freevars = tuple(self.freevars)
+        freevar_indexes = {}
+        for index, name in enumerate(freevars):
+            freevar_indexes.setdefault(name, index)
+        cellvars = set(arg for op, arg in code
+                       if op in HASFREE and arg not in freevar_indexes)
+
+        co_consts = [self.docstring]
+        const_indexes = {id(self.docstring): 0}
+        co_names = []
+        name_indexes = {}
+        co_varnames = list(self.args)
+        varname_indexes = {}
+        for index, name in enumerate(co_varnames):
+            varname_indexes.setdefault(name, index)
+        co_cellvars = [name for name in self.args if name in cellvars]
+        cellvar_indexes = {}
+        for index, name in enumerate(co_cellvars):
+            cellvar_indexes.setdefault(name, index)
+
+        def get_index(sequence, indexes, key, item):
+            index = indexes.get(key)
+            if index is None:
+                index = indexes[key] = len(sequence)
+                sequence.append(item)
+            return index
+
+        instructions = []
+        last = len(code) - 1
+        for i, (op, arg) in enumerate(code):
+            if isinstance(op, Label) or op is SetLineno:
+                instructions.append((op, arg))
+                continue
+            if op == bytecode.EXTENDED_ARG:
+                raise ValueError('EXTENDED_ARG not supported in Code objects')
+            if op < opcode.HAVE_ARGUMENT:
+                instructions.append((op, None))
+                continue
+
+            if op in HASCONST:
+                if (isinstance(arg, Code) and i < last and
+                        code[i + 1][0] in HASCODE):
+                    arg = arg.to_code()
+                arg = get_index(co_consts, const_indexes, id(arg), arg)
+            elif op in HASNAME:
+                arg = get_index(co_names, name_indexes, arg, arg)
+            elif op in HASLOCAL:
+                arg = get_index(co_varnames, varname_indexes, arg, arg)
+            elif op in HASCOMPARE:
+                arg = CMP_OP_INDEXES[arg]
+            elif op in HASFREE:
+                if arg in freevar_indexes:
+                    arg = freevar_indexes[arg] + len(cellvars)
+                else:
+                    arg = get_index(co_cellvars, cellvar_indexes, arg, arg)
+            instructions.append((op, arg))
+
+        # Prefixing a jump with EXTENDED_ARG moves the code after it, which
+        # may push other targets beyond 16 bits, so the code is laid out again
+        # until no other jump needs it.
+        extended_jumps = set()
+        while True:
+            co_code, co_lnotab, overflows = assemble(
+                instructions, self.firstlineno, extended_jumps)
+            if not overflows:
+                break
+            extended_jumps.update(overflows)
+
+        return types.CodeType(
+            len(self.args) - self.varargs - self.varkwargs,
+            len(co_varnames), self.get_stacksize(), self.get_flags(),
+            str(co_code), tuple(co_consts), tuple(co_names),
+            tuple(co_varnames), self.filename, self.name, self.firstlineno,
+            str(co_lnotab), freevars, tuple(co_cellvars))
+
+
+def assemble(instructions, firstlineno, extended_jumps):
+    """Lays out instructions whose arguments are already indexes.
+
+    Args:
+      instructions: a list of (op, arg), as in Code.code, where the arguments
+        of jumps are Labels and the others are indexes.
+      firstlineno: the first line number of the code.
+      extended_jumps: positions in instructions of the jumps prefixed with
+        EXTENDED_ARG.
+
+    Returns:
+      a tuple (co_code, co_lnotab, positions of the jumps not in
+      extended_jumps whose target does not fit in 16 bits).
+    """
+    jumps = []
+    label_offsets = {}
+    last_lineno = firstlineno
+    last_line_offset = 0
+    co_code = bytearray()
+    co_lnotab = bytearray()
+    for position, (op, arg) in enumerate(instructions):
+        if isinstance(op, Label):
+            label_offsets[op] = len(co_code)
+            continue
+        if op is SetLineno:
+            lineno_increment = arg - last_lineno
+            offset_increment = len(co_code) - last_line_offset
+            last_lineno = arg
+            last_line_offset = len(co_code)
+            if lineno_increment == 0 and offset_increment == 0:
+                co_lnotab.extend((0, 0))
+                continue
+            while offset_increment > 255:
+                co_lnotab.extend((255, 0))
+                offset_increment -= 255
+            while lineno_increment > 255:
+                co_lnotab.extend((offset_increment, 255))
+                offset_increment = 0
+                lineno_increment -= 255
+            if offset_increment or lineno_increment:
+                co_lnotab.extend((offset_increment, lineno_increment))
+            continue
+        if op < opcode.HAVE_ARGUMENT:
+            co_code.append(op)
+            continue
+        if op in HASJUMP:
+            if position in extended_jumps:
+                co_code.extend((bytecode.EXTENDED_ARG, 0, 0))
+            jumps.append((position, len(co_code), arg))
+            arg = 0
+        elif arg > 0xFFFF:
+            co_code.extend((bytecode.EXTENDED_ARG, (arg >> 16) & 0xFF,
+                            (arg >> 24) & 0xFF))
+        co_code.extend((op, arg & 0xFF, (arg >> 8) & 0xFF))
+
+    overflows = []
+    for position, offset, label in jumps:
+        target = label_offsets[label]
+        if co_code[offset] in HASJREL:
+            target -= offset + 3
+        if target > 0xFFFF:
+            if position not in extended_jumps:
+                overflows.append(position)
+                continue
+            co_code[offset - 2] = (target >> 16) & 0xFF
+            co_code[offset - 1] = (target >> 24) & 0xFF
+        co_code[offset + 1] = target & 0xFF
+        co_code[offset + 2] = (target >> 8) & 0xFF
+    return co_code, co_lnotab, overflows
+
+
+def count_instructions(code):
+    """Returns the number of instructions of a code object and its functions."""
+    count = 0
+    for _, op, arg in bytecode.iter_instructions(code.co_code):
+        count += 1
+        if op == bytecode.LOAD_CONST and isinstance(code.co_consts[arg],
+                                                    types.CodeType):
+            count += count_instructions(code.co_consts[arg])
+    return count
@@ -0,0 +1,343 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Execution of unittest tests with improved exceptions.
+
+The exceptions of failed tests are enriched by EnrichingResultMixin when the
+failure is recorded, so passing tests run unchanged.
+
+Tests can also be run in parallel (see run_parallel). They are grouped by
+test case class, so class fixtures run once per group, and the groups are run
+by a pool of worker processes. Each worker installs the instrumentation itself
+(see install) before importing any test module, and sends back the outcome of
+each test together with its formatted traceback, which already contains the
+enriched message. The parent process never imports the tests, it only
+aggregates and reports the outcomes. The tests of a group whose worker dies,
+or which runs longer than the timeout, are reported as errors.
+"""
+import collections
+import multiprocessing
+import multiprocessing.queues
+import os
+import sys
+import time
+import unittest
+
+import asm
+import debug_exception
+
+
+SUCCESS = 'success'
+FAILURE = 'failure'
+ERROR = 'error'
+SKIP = 'skip'
+EXPECTED_FAILURE = 'expected failure'
+UNEXPECTED_SUCCESS = 'unexpected success'
+
+# Progress shown for each outcome, with verbosity 1 and 2.
+DOTS = {
+    SUCCESS: '.',
+    FAILURE: 'F',
+    ERROR: 'E',
+    SKIP: 's',
+    EXPECTED_FAILURE: 'x',
+    UNEXPECTED_SUCCESS: 'u',
+}
+WORDS = {
+    SUCCESS: 'ok',
+    FAILURE: 'FAIL',
+    ERROR: 'ERROR',
+    SKIP: 'skipped',
+    EXPECTED_FAILURE: 'expected failure',
+    UNEXPECTED_SUCCESS: 'unexpected success',
+}
+
+# Seconds between the checks of the groups running in the workers.
+POLL_INTERVAL = 0.05
+
+
+def install(code_cache=None, capture=asm.CAPTURE_GLOBALS, policy=None,
+            lazy=False, postmortem=False, switchable=False, failures=None,
+            retention=debug_exception.RETAIN_STRONG):
+    """Installs the instrumentation and the enrichment of uncaught exceptions.
+
+    Failed tests are enriched by the test result (see EnrichingResultMixin).
+
+    Args:
+      code_cache: a cache.CodeCache or None.
+      capture: one of asm.CAPTURE_MODES.
+      policy: a policy.InstrumentationPolicy or None.
+      lazy: whether functions are patched when first called.
+      postmortem: if true, no module is patched and the operands are recovered
+        from the tracebacks instead.
+      switchable: whether the instrumentation can be turned on and off at
+        runtime (see switch).
+      failures: if not None, the path of a file where the debug info of the
+        enriched exceptions is appended as JSON lines.
+      retention: how enriched exceptions keep the operands, one of
+        debug_exception.RETENTIONS.
+
+    Returns:
+      the installed debug_exception.ModuleImporter, or None if postmortem.
+    """
+    importer = None
+    debug_exception.set_retention(retention)
+    if postmortem:
+        debug_exception.set_backend(debug_exception.POSTMORTEM)
+    else:
+        importer = debug_exception.ModuleImporter(
+            cache=code_cache, capture=capture, policy=policy, lazy=lazy,
+            switchable=switchable)
+    if failures:
+        debug_exception.set_emitter(
+            debug_exception.JsonLinesEmitter(open(failures, 'a')))
+    debug_exception.install_excepthook()
+    return importer
+
+
+def iter_tests(suite):
+    """Yields the test cases of a (nested) test suite."""
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for inner_test in iter_tests(test):
+                yield inner_test
+        else:
+            yield test
+
+
+def list_test_groups(names):
+    """Returns the ids of the tests given by names, grouped by class."""
+    suite = unittest.defaultTestLoader.loadTestsFromNames(names)
+    groups = collections.OrderedDict()
+    for test in iter_tests(suite):
+        groups.setdefault(type(test), []).append(test.id())
+    return groups.values()
+
+
+class EnrichingResultMixin(object):
+    """Mixin for unittest.TestResult enriching the exceptions of errors.
+
+    It must come before the TestResult class in the bases. The exception is
+    enriched when the error or failure is recorded, right after the test
+    raised it, and it is emitted as raised by the test method (see
+    debug_exception.set_emitter). The captures of the ring of
+    asm.CAPTURE_RING are cleared after each test, so they do not keep its
+    objects alive.
+    """
+    def enrich(self, test, err):
+        return debug_exception.enrich_exc_info(
+            err, getattr(test, getattr(test, '_testMethodName', ''), None))
+
+    def addError(self, test, err):
+        super(EnrichingResultMixin, self).addError(test,
+                                                   self.enrich(test, err))
+
+    def addFailure(self, test, err):
+        super(EnrichingResultMixin, self).addFailure(test,
+                                                     self.enrich(test, err))
+
+    def stopTest(self, test):
+        asm.clear_ring_captures()
+        super(EnrichingResultMixin, self).stopTest(test)
+
+
+class EnrichingTextTestResult(EnrichingResultMixin, unittest.TextTestResult):
+    pass
+
+
+class EnrichingTextTestRunner(unittest.TextTestRunner):
+    """unittest.TextTestRunner reporting the enriched exceptions."""
+    resultclass = EnrichingTextTestResult
+
+
+class CollectingResult(EnrichingResultMixin, unittest.TestResult):
+    """TestResult keeping the outcomes as picklable tuples.
+
+    Each outcome is (kind, test id, test description, text), where text is the
+    formatted traceback of failures and errors or the reason of skips.
+    """
+    def __init__(self):
+        unittest.TestResult.__init__(self)
+        self.outcomes = []
+
+    def add_outcome(self, kind, test, text=''):
+        self.outcomes.append((kind, test.id(), str(test), text))
+
+    def addSuccess(self, test):
+        unittest.TestResult.addSuccess(self, test)
+        self.add_outcome(SUCCESS, test)
+
+    def addFailure(self, test, err):
+        super(CollectingResult, self).addFailure(test, err)
+        self.add_outcome(FAILURE, test, self.failures[-1][1])
+
+    def addError(self, test, err):
+        super(CollectingResult, self).addError(test, err)
+        self.add_outcome(ERROR, test, self.errors[-1][1])
+
+    def addSkip(self, test, reason):
+        unittest.TestResult.addSkip(self, test, reason)
+        self.add_outcome(SKIP, test, reason)
+
+    def addExpectedFailure(self, test, err):
+        unittest.TestResult.addExpectedFailure(self, test, err)
+        self.add_outcome(EXPECTED_FAILURE, test, self.expectedFailures[-1][1])
+
+    def addUnexpectedSuccess(self, test):
+        unittest.TestResult.addUnexpectedSuccess(self, test)
+        self.add_outcome(UNEXPECTED_SUCCESS, test)
+
+
+def run_tests(test_ids):
+    """Runs the given tests and returns (tests run, outcomes)."""
+    loader = unittest.defaultTestLoader
+    suite = unittest.TestSuite()
+    for test_id in test_ids:
+        for test in iter_tests(loader.loadTestsFromName(test_id)):
+            suite.addTest(test)
+    result = CollectingResult()
+    suite.run(result)
+    return result.testsRun, result.outcomes
+
+
+# Where the workers report which group they start, see run_group.
+_started = None
+
+
+def init_worker(started, install_args):
+    """Installs the instrumentation in a worker reporting to started."""
+    global _started
+    _started = started
+    install(*install_args)
+
+
+def run_group(index, test_ids):
+    """Runs a group of tests, reporting first that this worker runs it."""
+    _started.put((index, os.getpid()))
+    return run_tests(test_ids)
+
+
+def get_errored_outcomes(test_ids, reason):
+    """Returns (tests run, outcomes) with the given tests as errors."""
+    return len(test_ids), [(ERROR, test_id, test_id, reason)
+                           for test_id in test_ids]
+
+
+class ParallelReport(object):
+    """Aggregates the outcomes of the workers in the format of unittest."""
+    separator1 = '=' * 70
+    separator2 = '-' * 70
+
+    def __init__(self, stream, verbosity=1):
+        self.stream = stream
+        self.verbosity = verbosity
+        self.tests_run = 0
+        self.outcomes = collections.defaultdict(list)
+
+    def add(self, tests_run, outcomes):
+        self.tests_run += tests_run
+        for kind, _, description, text in outcomes:
+            self.outcomes[kind].append((description, text))
+            if self.verbosity > 1:
+                word = WORDS[kind]
+                if kind == SKIP:
+                    word += ' %r' % (text,)
+                self.stream.write('%s ... %s\n' % (description, word))
+            elif self.verbosity == 1:
+                self.stream.write(DOTS[kind])
+            self.stream.flush()
+
+    def was_successful(self):
+        return not (self.outcomes[FAILURE] or self.outcomes[ERROR])
+
+    def print_summary(self, elapsed):
+        if self.verbosity:
+            self.stream.write('\n')
+        for flavour, kind in (('ERROR', ERROR), ('FAIL', FAILURE)):
+            for description, text in self.outcomes[kind]:
+                self.stream.write('%s\n%s: %s\n%s\n%s\n' % (
+                    self.separator1, flavour, description, self.separator2,
+                    text))
+        self.stream.write('%s\nRan %d test%s in %.3fs\n\n' % (
+            self.separator2, self.tests_run, self.tests_run != 1 and 's' or '',
+            elapsed))
+        infos = []
+        for name, kind in (('failures', FAILURE), ('errors', ERROR),
+                           ('skipped', SKIP),
+                           ('expected failures', EXPECTED_FAILURE),
+                           ('unexpected successes', UNEXPECTED_SUCCESS)):
+            if self.outcomes[kind]:
+                infos.append('%s=%d' % (name, len(self.outcomes[kind])))
+        self.stream.write('OK' if self.was_successful() else 'FAILED')
+        if infos:
+            self.stream.write(' (%s)' % ', '.join(infos))
+        self.stream.write('\n')
+
+
+def run_parallel(names, jobs, install_args=(), verbosity=1, stream=None,
+                 timeout=None):
+    """Runs the tests given by names in jobs worker processes.
+
+    Args:
+      names: names of modules, classes or methods, as accepted by
+        unittest.TestLoader.loadTestsFromNames.
+      jobs: number of worker processes.
+      install_args: arguments of install, called in each worker.
+      verbosity: 0, 1 or 2, as in unittest.TextTestRunner.
+      stream: where the report is written, sys.stderr by default.
+      timeout: if not None, the seconds a group of tests may run before its
+        tests are reported as errors.
+
+    Returns:
+      whether all the tests were successful.
+    """
+    report = ParallelReport(stream or sys.stderr, verbosity)
+    # Written without a feeder thread, so a worker dying right after
+    # reporting a group does not lose the report.
+    started = multiprocessing.queues.SimpleQueue()
+    pool = multiprocessing.Pool(jobs, init_worker, (started, install_args))
+    try:
+        groups = pool.apply(list_test_groups, (names,))
+        start = time.time()
+        pending = dict((index, pool.apply_async(run_group, (index, group)))
+                       for index, group in enumerate(groups))
+        # index -> (pid of the worker, time it started the group)
+        running = {}
+        while pending:
+            while not started.empty():
+                index, pid = started.get()
+                running[index] = (pid, time.time())
+            alive = set(process.pid for process in pool._pool
+                        if process.is_alive())
+            for index, result in pending.items():
+                if result.ready():
+                    report.add(*result.get())
+                elif index not in running:
+                    continue
+                elif running[index][0] not in alive:
+                    report.add(*get_errored_outcomes(
+                        groups[index], 'Worker process died'))
+                elif (timeout is not None and
+                      time.time() - running[index][1] > timeout):
+                    report.add(*get_errored_outcomes(
+                        groups[index], 'Timed out after %ss' % timeout))
+                else:
+                    continue
+                del pending[index]
+            if pending:
+                time.sleep(POLL_INTERVAL)
+        report.print_summary(time.time() - start)
+    finally:
+        pool.terminate()
+        pool.join()
+    return report.was_successful()
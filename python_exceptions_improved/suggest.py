@@ -0,0 +1,272 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Fast search of names similar to a misspelled one.
+
+Two names are similar when the difflib.SequenceMatcher ratio of their
+normalized forms (lowercase, without underscores) is at least THRESHOLD. As the
+ratio is 2 * M / T, where M is the number of matching characters and T the
+total number of characters, and M is never larger than the longest common
+subsequence, most candidates can be discarded with cheaper exact bounds before
+computing the ratio:
+  - by length: M <= min(len(a), len(b));
+  - by indel distance (insertions plus deletions, len(a) + len(b) - 2 * LCS),
+    computed in a band and stopping as soon as the bound is exceeded.
+"""
+import collections
+import difflib
+import inspect
+import math
+import types
+import weakref
+
+
+THRESHOLD = 0.75
+# Tolerance for the floating point comparisons of the bounds.
+EPSILON = 1e-9
+
+
+def normalize(name):
+    return name.lower().replace('_', '')
+
+
+def ratio(a, b):
+    """Returns the similarity of two normalized names."""
+    return difflib.SequenceMatcher(a=a, b=b).ratio()
+
+
+def get_max_distance(total, threshold=THRESHOLD):
+    """Returns the largest indel distance of similar names of given total size."""
+    return int(math.floor((1 - threshold) * total + EPSILON))
+
+
+def bounded_indel_distance(a, b, max_distance):
+    """Returns the indel distance of a and b if at most max_distance.
+
+    Otherwise returns max_distance + 1. Only the cells of the dynamic
+    programming matrix within max_distance of the diagonal are computed, and
+    the computation stops as soon as a whole row exceeds the bound.
+    """
+    n, m = len(a), len(b)
+    if abs(n - m) > max_distance:
+        return max_distance + 1
+    too_far = max_distance + 1
+    previous = [j if j <= max_distance else too_far for j in xrange(m + 1)]
+    for i in xrange(1, n + 1):
+        current = [too_far] * (m + 1)
+        if i <= max_distance:
+            current[0] = i
+        low = max(1, i - max_distance)
+        high = min(m, i + max_distance)
+        row_min = current[0]
+        char = a[i - 1]
+        for j in xrange(low, high + 1):
+            if char == b[j - 1]:
+                value = previous[j - 1]
+            else:
+                value = min(previous[j], current[j - 1]) + 1
+            if value > too_far:
+                value = too_far
+            current[j] = value
+            if value < row_min:
+                row_min = value
+        if row_min > max_distance:
+            return too_far
+        previous = current
+    return previous[m]
+
+
+class SuggestionIndex(object):
+    """Reusable index of candidate names grouped by normalized length.
+
+    Args:
+      names: an iterable of candidate names. Suggestions are returned in the
+        order of this iterable, without duplicates.
+      threshold: minimum similarity ratio of the suggestions.
+    """
+    def __init__(self, names, threshold=THRESHOLD):
+        self.threshold = threshold
+        self.by_length = {}
+        seen = set()
+        for position, name in enumerate(names):
+            if name in seen:
+                continue
+            seen.add(name)
+            normalized = normalize(name)
+            self.by_length.setdefault(len(normalized), []).append(
+                (position, name, normalized))
+
+    def get_lengths(self, length):
+        """Returns the candidate lengths which may be similar to length."""
+        threshold = self.threshold
+        for candidate_length in self.by_length:
+            total = length + candidate_length
+            if (total == 0 or 2 * min(length, candidate_length) >=
+                    threshold * total - EPSILON):
+                yield candidate_length
+
+    def suggest(self, name):
+        """Returns the names of the index similar to name."""
+        target = normalize(name)
+        matches = []
+        for length in self.get_lengths(len(target)):
+            max_distance = get_max_distance(len(target) + length,
+                                            self.threshold)
+            for position, candidate, normalized in self.by_length[length]:
+                if (bounded_indel_distance(target, normalized, max_distance) <=
+                        max_distance and
+                        ratio(target, normalized) >= self.threshold):
+                    matches.append((position, candidate))
+        return [candidate for _, candidate in sorted(matches)]
+
+
+class LRUCache(object):
+    """Bounded mapping discarding the least recently used entries.
+
+    The number of hits and misses of get is recorded.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+        }
+
+
+def get_class_signature(cls):
+    """Returns a value which changes when cls or a base gains or loses names."""
+    return tuple((id(klass), len(vars(klass))) for klass in inspect.getmro(cls))
+
+
+def get_cacheable_parts(obj):
+    """Splits the attributes of obj into a class and a list of own names.
+
+    Returns:
+      (cls, names) such that dir(obj) is the sorted union of dir(cls) and
+      names, or None if dir(obj) cannot be computed that way (modules, objects
+      defining __dir__, proxies, etc).
+    """
+    cls = type(obj)
+    if isinstance(obj, (type, types.ClassType)):
+        if hasattr(cls, '__dir__'):
+            return None
+        return obj, []
+    if (isinstance(obj, types.ModuleType) or cls is types.InstanceType or
+            getattr(obj, '__class__', None) is not cls or
+            hasattr(cls, '__dir__') or hasattr(obj, '__members__') or
+            hasattr(obj, '__methods__')):
+        return None
+    namespace = getattr(obj, '__dict__', {})
+    if not isinstance(namespace, dict):
+        return None
+    return cls, [name for name in namespace if isinstance(name, basestring)]
+
+
+class AttributeSuggestions(object):
+    """Memoizes dir() listings and attribute suggestions.
+
+    Listings are cached per class and suggestions per (class, attribute), in
+    LRU caches of bounded size. Entries are discarded when the class or any of
+    its bases gains or loses attributes. For instances, the cached results of
+    their class are merged with the names in their __dict__.
+
+    Args:
+      maxsize: maximum number of classes whose listing is cached. Up to four
+        times as many suggestions are cached.
+    """
+    def __init__(self, maxsize=256):
+        self.listings = LRUCache(maxsize)
+        self.suggestions = LRUCache(4 * maxsize)
+
+    def get_cached(self, cache, key, cls, compute):
+        signature = get_class_signature(cls)
+        entry = cache.get((id(cls),) + key)
+        if entry is not None:
+            ref, entry_signature, value = entry
+            if ref() is cls and entry_signature == signature:
+                return value
+        value = compute()
+        cache.put((id(cls),) + key, (weakref.ref(cls), signature, value))
+        return value
+
+    def get_class_listing(self, cls):
+        def compute():
+            names = dir(cls)
+            return names, SuggestionIndex(names)
+        return self.get_cached(self.listings, (), cls, compute)
+
+    def dir(self, obj):
+        """Returns dir(obj)."""
+        parts = get_cacheable_parts(obj)
+        if parts is None:
+            return dir(obj)
+        cls, names = parts
+        listing = self.get_class_listing(cls)[0]
+        if not names:
+            return list(listing)
+        return sorted(set(listing).union(names))
+
+    def get_similar_attributes(self, obj, attribute):
+        """Returns the attributes of obj similar to attribute, sorted."""
+        parts = get_cacheable_parts(obj)
+        if parts is None:
+            return SuggestionIndex(dir(obj)).suggest(attribute)
+        cls, names = parts
+        suggestions = self.get_cached(
+            self.suggestions, (attribute,), cls,
+            lambda: self.get_class_listing(cls)[1].suggest(attribute))
+        if not names:
+            return list(suggestions)
+        return sorted(set(suggestions).union(
+            SuggestionIndex(names).suggest(attribute)))
+
+    def clear(self):
+        self.listings.clear()
+        self.suggestions.clear()
+
+    def get_stats(self):
+        """Returns the statistics of the listing and suggestion caches."""
+        return {
+            'listings': self.listings.get_stats(),
+            'suggestions': self.suggestions.get_stats(),
+        }
+
+
+ATTRIBUTES = AttributeSuggestions()
@@ -0,0 +1,141 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Process-wide switch between the original and the patched code of functions.
+
+Functions are registered with both versions of their code, and enable or
+disable swaps the func_code of all of them at once. So a long running process
+can run at native speed and turn on the instrumentation only while
+investigating a problem, either through the API, the EXCEPTIONS_IMPROVED_ENABLED
+environment variable (read at startup) or a signal (see
+install_signal_handler).
+
+Frames already running and functions created from the code of a running frame
+(closures) keep the version they started with.
+"""
+import os
+import signal
+import threading
+import weakref
+
+import lazy
+
+
+ENABLED_ENVIRONMENT_VARIABLE = 'EXCEPTIONS_IMPROVED_ENABLED'
+FALSE_VALUES = ('0', 'false', 'no', 'off')
+
+
+def is_enabled_in_environment(environ=None):
+    """Returns whether EXCEPTIONS_IMPROVED_ENABLED is unset or not false."""
+    if environ is None:
+        environ = os.environ
+    value = environ.get(ENABLED_ENVIRONMENT_VARIABLE, '')
+    return value.strip().lower() not in FALSE_VALUES
+
+
+class CodeSwitch(object):
+    """Registry of functions with an original and a patched code.
+
+    Functions are weakly referenced, so registering them does not keep them
+    alive.
+
+    Args:
+      enabled: whether registered functions run their patched code.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.functions = weakref.WeakKeyDictionary()
+        # Reentrant, as the signal handler may run while the main thread holds
+        # it.
+        self.lock = threading.RLock()
+
+    def register(self, function, patched_code):
+        """Registers a function, whose current code is the original one."""
+        with self.lock:
+            self.functions[function] = (function.func_code, patched_code)
+            if self.enabled:
+                function.func_code = patched_code
+
+    def register_namespace(self, namespace, patch):
+        """Registers the functions of a module (see lazy.iter_functions).
+
+        Args:
+          namespace: the dictionary of the module.
+          patch: a function receiving a code object and returning the patched
+            one. Shared code objects are patched only once.
+        """
+        patched_codes = {}
+        for function in lazy.iter_functions(namespace):
+            code = function.func_code
+            if code not in patched_codes:
+                patched_codes[code] = patch(code)
+            self.register(function, patched_codes[code])
+
+    def set_enabled(self, enabled):
+        """Installs the patched (or original) code in all the functions.
+
+        The signal handler may toggle the switch in the middle of the loop,
+        in the same thread, so the functions are updated again until
+        self.enabled no longer changes.
+        """
+        with self.lock:
+            self.enabled = enabled
+            installed = None
+            while installed != self.enabled:
+                installed = self.enabled
+                for function, (original_code, patched_code) in (
+                        self.functions.items()):
+                    function.func_code = (patched_code if installed
+                                          else original_code)
+
+    def enable(self):
+        self.set_enabled(True)
+
+    def disable(self):
+        self.set_enabled(False)
+
+    def toggle(self):
+        self.set_enabled(not self.enabled)
+
+    def __len__(self):
+        return len(self.functions)
+
+
+SWITCH = CodeSwitch(is_enabled_in_environment())
+
+
+def enable():
+    """Makes all the registered functions run their patched code."""
+    SWITCH.enable()
+
+
+def disable():
+    """Makes all the registered functions run their original code."""
+    SWITCH.disable()
+
+
+def is_enabled():
+    return SWITCH.enabled
+
+
+def install_signal_handler(signum=signal.SIGUSR1, code_switch=None):
+    """Toggles the switch whenever the process receives signum.
+
+    It must be called from the main thread. The previous handler is returned.
+    """
+    if code_switch is None:
+        code_switch = SWITCH
+
+    def handler(signum, frame):  # pylint: disable=W0613
+        code_switch.toggle()
+    return signal.signal(signum, handler)
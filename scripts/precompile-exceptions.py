@@ -0,0 +1,112 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import multiprocessing
+import sys
+
+import python_exceptions_improved.asm as asm
+import python_exceptions_improved.cache as cache
+import python_exceptions_improved.hotness as hotness
+import python_exceptions_improved.policy as policy
+import python_exceptions_improved.precompile as precompile
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Patches the modules of source trees ahead of time and '
+                    'stores them in the cache of test-exceptions-wrapper.py. '
+                    'Use the same options when running the tests.')
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help='entry of sys.path (as it will be when running '
+                             'the tests) or module file')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory where patched code is cached '
+                             '(defaults to $%s if set)' %
+                             cache.CACHE_DIR_ENVIRONMENT_VARIABLE)
+    parser.add_argument('--capture', choices=asm.CAPTURE_MODES,
+                        default=asm.CAPTURE_GLOBALS,
+                        help='where the patched code stores the operands')
+    parser.add_argument('--lazy', action='store_true',
+                        help='patch functions the first time they are called')
+    parser.add_argument('--switchable', action='store_true',
+                        help='keep the original code of functions')
+    parser.add_argument('--include', action='append', default=[],
+                        metavar='PATTERN',
+                        help='only patch modules matching this glob '
+                             '(defaults to $%s)' %
+                             policy.INCLUDE_ENVIRONMENT_VARIABLE)
+    parser.add_argument('--exclude', action='append', default=[],
+                        metavar='PATTERN',
+                        help='do not patch modules matching this glob '
+                             '(defaults to $%s)' %
+                             policy.EXCLUDE_ENVIRONMENT_VARIABLE)
+    parser.add_argument('--path', action='append', default=[], dest='prefixes',
+                        help='only patch modules under this directory '
+                             '(defaults to $%s)' %
+                             policy.PATHS_ENVIRONMENT_VARIABLE)
+    parser.add_argument('--opcodes', type=policy.split_list, default=None,
+                        help='comma separated opcode families to instrument, '
+                             'among %s (defaults to $%s)' %
+                             (', '.join(asm.FAMILIES),
+                              policy.OPCODES_ENVIRONMENT_VARIABLE))
+    parser.add_argument('--profile', default=None, metavar='FILE',
+                        help='pstats dump, or JSON call counts (.json), of a '
+                             'profiling run (defaults to $%s)' %
+                             policy.PROFILE_ENVIRONMENT_VARIABLE)
+    parser.add_argument('--max-calls', type=int, default=None,
+                        help='do not instrument functions called more times '
+                             'than this in the profile (defaults to $%s or '
+                             '%d)' % (policy.MAX_CALLS_ENVIRONMENT_VARIABLE,
+                                      policy.DEFAULT_MAX_CALLS))
+    parser.add_argument('--jobs', '-j', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='number of worker processes (defaults to the '
+                             'number of CPUs)')
+    parser.add_argument('--quiet', '-q', action='store_true',
+                        help='only print failures and the summary')
+    args = parser.parse_args(argv)
+    if args.lazy and args.switchable:
+        parser.error('--lazy cannot be used with --switchable')
+    return args
+
+
+def get_policy(args):
+    """Returns the policy given by the environment and the arguments."""
+    default = policy.InstrumentationPolicy.from_environment()
+    return policy.InstrumentationPolicy(
+        include=args.include or default.include,
+        exclude=args.exclude or default.exclude,
+        paths=args.prefixes or default.paths,
+        families=args.opcodes or default.families,
+        profile=(hotness.load_profile(args.profile) if args.profile
+                 else default.profile),
+        max_calls=(default.max_calls if args.max_calls is None
+                   else args.max_calls))
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+
+    def print_result(result):
+        file_path, status, error = result
+        if status == precompile.FAILED:
+            sys.stderr.write('%s: %s\n' % (file_path, error))
+        elif status == precompile.COMPILED and not args.quiet:
+            sys.stdout.write('Compiling %s\n' % file_path)
+
+    report = precompile.compile_paths(
+        args.paths, cache.CodeCache(args.cache_dir), args.capture,
+        get_policy(args), args.lazy, args.switchable, args.jobs, print_result)
+    sys.stdout.write(report.get_summary() + '\n')
+    sys.exit(1 if report.failures else 0)
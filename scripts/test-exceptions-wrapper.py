@@ -11,18 +11,171 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import argparse
+import atexit
 import importlib
+import json
 import os
 import sys
 import unittest
 
+import python_exceptions_improved.asm as asm
+import python_exceptions_improved.cache as cache
 import python_exceptions_improved.debug_exception as debug_exception
+import python_exceptions_improved.hotness as hotness
+import python_exceptions_improved.policy as policy
+import python_exceptions_improved.runner as runner
+import python_exceptions_improved.switch as switch
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Runs the tests of a module with improved exceptions. '
+                    'Unknown options are passed to unittest.')
+    parser.add_argument('module', help='module containing the tests')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory where patched code is cached '
+                             '(defaults to $%s if set)' %
+                             cache.CACHE_DIR_ENVIRONMENT_VARIABLE)
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not cache patched code')
+    parser.add_argument('--capture', choices=asm.CAPTURE_MODES,
+                        default=asm.CAPTURE_GLOBALS,
+                        help='where the patched code stores the operands')
+    parser.add_argument('--postmortem', action='store_true',
+                        help='do not patch any module and recover the '
+                             'operands from the traceback instead')
+    parser.add_argument('--lazy', action='store_true',
+                        help='patch functions the first time they are called')
+    parser.add_argument('--switchable', action='store_true',
+                        help='keep the original code of functions, and '
+                             'toggle the instrumentation on SIGUSR1 (it '
+                             'starts disabled if $%s is false)' %
+                             switch.ENABLED_ENVIRONMENT_VARIABLE)
+    parser.add_argument('--include', action='append', default=[],
+                        metavar='PATTERN',
+                        help='only patch modules matching this glob '
+                             '(defaults to $%s)' %
+                             policy.INCLUDE_ENVIRONMENT_VARIABLE)
+    parser.add_argument('--exclude', action='append', default=[],
+                        metavar='PATTERN',
+                        help='do not patch modules matching this glob '
+                             '(defaults to $%s)' %
+                             policy.EXCLUDE_ENVIRONMENT_VARIABLE)
+    parser.add_argument('--path', action='append', default=[], dest='paths',
+                        help='only patch modules under this directory '
+                             '(defaults to $%s)' %
+                             policy.PATHS_ENVIRONMENT_VARIABLE)
+    parser.add_argument('--opcodes', type=policy.split_list, default=None,
+                        help='comma separated opcode families to instrument, '
+                             'among %s (defaults to $%s)' %
+                             (', '.join(asm.FAMILIES),
+                              policy.OPCODES_ENVIRONMENT_VARIABLE))
+    parser.add_argument('--profile', default=None, metavar='FILE',
+                        help='pstats dump, or JSON call counts (.json), of a '
+                             'profiling run (defaults to $%s)' %
+                             policy.PROFILE_ENVIRONMENT_VARIABLE)
+    parser.add_argument('--max-calls', type=int, default=None,
+                        help='do not instrument functions called more times '
+                             'than this in the profile (defaults to $%s or '
+                             '%d)' % (policy.MAX_CALLS_ENVIRONMENT_VARIABLE,
+                                      policy.DEFAULT_MAX_CALLS))
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='run the tests in this many processes')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='with --jobs, report the tests of a class as '
+                             'errors if they run longer than this many '
+                             'seconds')
+    parser.add_argument('--stats', default=None, metavar='FILE',
+                        help='write the instrumentation statistics as JSON '
+                             'to this file (- for stderr) when exiting')
+    parser.add_argument('--retention', choices=debug_exception.RETENTIONS,
+                        default=debug_exception.RETAIN_STRONG,
+                        help='how enriched exceptions keep the operands: '
+                             'weak releases them, building the message at '
+                             'once if they have no weak references')
+    parser.add_argument('--failures', default=None, metavar='FILE',
+                        help='write the debug info of each enriched '
+                             'exception as a JSON line to this file')
+    args, unittest_args = parser.parse_known_args(argv)
+    if args.stats and args.jobs > 1:
+        parser.error('--stats cannot be used with --jobs')
+    if args.lazy and args.switchable:
+        parser.error('--lazy cannot be used with --switchable')
+    return args, unittest_args
+
+
+def get_policy(args):
+    """Returns the policy given by the environment and the arguments."""
+    default = policy.InstrumentationPolicy.from_environment()
+    return policy.InstrumentationPolicy(
+        include=args.include or default.include,
+        exclude=args.exclude or default.exclude,
+        paths=args.paths or default.paths,
+        families=args.opcodes or default.families,
+        profile=(hotness.load_profile(args.profile) if args.profile
+                 else default.profile),
+        max_calls=(default.max_calls if args.max_calls is None
+                   else args.max_calls))
+
+
+def write_stats(importer, path):
+    """Writes the statistics of importer as JSON to path."""
+    stats = json.dumps(importer.get_stats() if importer else {}, indent=2,
+                       sort_keys=True)
+    if path == '-':
+        sys.stderr.write(stats + '\n')
+    else:
+        with open(path, 'w') as f:
+            f.write(stats + '\n')
+
+
+def write_skipped(importer):
+    """Writes to stderr the code objects left uninstrumented as hot."""
+    modules = importer.get_stats()['modules']
+    skipped = ['%s:%s' % (module_stats['file'], name)
+               for module_stats in modules
+               for name in module_stats['skipped']]
+    sys.stderr.write('%d hot code objects left uninstrumented\n' %
+                     len(skipped))
+    for name in sorted(skipped):
+        sys.stderr.write('  %s\n' % name)
 
 
 if __name__ == '__main__':
+    args, unittest_args = parse_args(sys.argv[1:])
     sys.path.append(os.getcwd())
-    debug_exception.ModuleImporter()
-    module_name = sys.argv[1]
+    code_cache = None
+    if not args.no_cache and (
+            args.cache_dir or
+            os.environ.get(cache.CACHE_DIR_ENVIRONMENT_VARIABLE)):
+        code_cache = cache.CodeCache(args.cache_dir)
+    if args.failures:
+        # Each process appends to it.
+        open(args.failures, 'w').close()
+    install_args = (code_cache, args.capture, get_policy(args), args.lazy,
+                    args.postmortem, args.switchable, args.failures,
+                    args.retention)
+    if args.switchable:
+        switch.install_signal_handler()
+    module_name = args.module
+    test_names = [arg for arg in unittest_args if not arg.startswith('-')]
+    if args.jobs > 1:
+        verbosity = 1
+        if set(unittest_args) & set(['-v', '--verbose']):
+            verbosity = 2
+        elif set(unittest_args) & set(['-q', '--quiet']):
+            verbosity = 0
+        sys.exit(not runner.run_parallel(test_names or [module_name],
+                                         args.jobs, install_args, verbosity,
+                                         timeout=args.timeout))
+    importer = runner.install(*install_args)
+    if args.stats:
+        atexit.register(write_stats, importer, args.stats)
+    if importer and importer.policy.profile is not None:
+        atexit.register(write_skipped, importer)
     locals()[module_name] = importlib.import_module(module_name)
-    unittest.TestLoader.getTestCaseNames = debug_exception.decorate(unittest.TestLoader.getTestCaseNames)
-    unittest.main()
+    if not test_names:
+        unittest_args.append(module_name)
+    unittest.main(argv=[sys.argv[0]] + unittest_args,
+                  testRunner=runner.EnrichingTextTestRunner)
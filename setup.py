@@ -24,9 +24,9 @@ setup(
     packages=find_packages(exclude=['test']),
     scripts=[
         'scripts/test-exceptions-wrapper.py',
+        'scripts/precompile-exceptions.py',
     ],
-    install_requires=['byteplay'],
-    tests_require=['nose', 'coverage'],
+    tests_require=['nose', 'coverage', 'byteplay'],
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Environment :: Console',
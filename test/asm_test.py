@@ -12,14 +12,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import new
+import sys
+import threading
 import unittest
 
 import python_exceptions_improved.asm as asm
+import python_exceptions_improved.bytecode as bytecode
+import python_exceptions_improved.rewriter as rewriter
 
 
-def patch(f):
-    return new.function(asm.patch_code(f.func_code), f.func_globals, f.func_name,
-                        f.func_defaults, f.func_closure)
+def patch(f, capture=asm.CAPTURE_GLOBALS):
+    return new.function(asm.patch_code(f.func_code, capture), f.func_globals,
+                        f.func_name, f.func_defaults, f.func_closure)
+
+
+def get_failing_frame_locals(f):
+    try:
+        f()
+    except Exception:
+        tb = sys.exc_info()[2]
+        while tb.tb_next:
+            tb = tb.tb_next
+        return tb.tb_frame.f_locals
 
 
 class Foo(object):
@@ -180,5 +194,359 @@ class AsmTest(unittest.TestCase):
         self.assertNotIn('_s_index', globals())
 
 
+class AsmStatsTest(unittest.TestCase):
+    def testStats(self):
+        code = compile('a = {}\na[1] = 2\ndef f(x):\n    return x.y[0]\n',
+                       'stats.py', 'exec')
+        stats = []
+        patched = asm.patch_code(code, stats=stats)
+
+        self.assertEqual(['<module>', 'f'], [s.name for s in stats])
+        self.assertEqual({asm.ATTRIBUTES: 0, asm.SUBSCRIPTS: 1},
+                         stats[0].sites)
+        self.assertEqual({asm.ATTRIBUTES: 1, asm.SUBSCRIPTS: 1},
+                         stats[1].sites)
+        self.assertEqual(3, stats[1].firstlineno)
+        self.assertEqual(len(code.co_code), stats[0].original_size)
+        self.assertEqual(len(patched.co_code), stats[0].patched_size)
+
+    def testStatsFamilies(self):
+        stats = []
+        asm.patch_code(compile('a.b[0]', 'stats.py', 'exec'),
+                       families=[asm.SUBSCRIPTS], stats=stats)
+        self.assertEqual({asm.ATTRIBUTES: 0, asm.SUBSCRIPTS: 1},
+                         stats[0].sites)
+
+    def testSkip(self):
+        code = compile('a = {}\na[1] = 2\ndef f(x):\n    return x.y[0]\n',
+                       'stats.py', 'exec')
+        stats = []
+        patched = asm.patch_code(code, stats=stats,
+                                 skip=lambda f_code: f_code.name == '<module>')
+
+        self.assertEqual([True, False], [s.skipped for s in stats])
+        self.assertEqual(0, count_ops(patched, bytecode.DUP_TOPX))
+        self.assertEqual(stats[0].original_size, stats[0].patched_size)
+        self.assertEqual({asm.ATTRIBUTES: 1, asm.SUBSCRIPTS: 1},
+                         stats[1].sites)
+
+
+def get_stats(source):
+    stats = []
+    asm.patch_code(compile(source, 'safe.py', 'exec'), stats=stats)
+    return stats
+
+
+def count_ops(code, op):
+    return sum(1 for other, _ in rewriter.Code.from_code(code).code
+               if other == op)
+
+
+class AsmSafeSitesTest(unittest.TestCase):
+    def testModuleAttribute(self):
+        stats = get_stats('import os\nos.path\ndef f():\n    return os.sep\n')
+        self.assertEqual([1, 1], [s.elided[asm.ATTRIBUTES] for s in stats])
+        self.assertEqual([0, 0], [s.sites[asm.ATTRIBUTES] for s in stats])
+
+    def testRebindedModuleName(self):
+        for source in ('import os\nos = None\nos.path\n',
+                       'import os\ndel os\nos.path\n',
+                       'try:\n    import os\nexcept ImportError:\n'
+                       '    os = None\nos.path\n',
+                       'from os import path\npath.join\n',
+                       'import os\ndef f():\n    global os\n    os = 1\n'
+                       'os.path\n',
+                       'import os\nfrom sys import *\nos.path\n'):
+            self.assertEqual(1, get_stats(source)[0].sites[asm.ATTRIBUTES],
+                             source)
+
+    def testLocalModule(self):
+        stats = get_stats('def f():\n    import os\n    return os.path\n'
+                          'def g(os):\n    return os.path\n')
+        self.assertEqual([0, 1, 0], [s.elided[asm.ATTRIBUTES] for s in stats])
+
+    def testFunctionCode(self):
+        # Without the module code, globals cannot be proven to be modules.
+        stats = []
+        asm.patch_code(get_stats.func_code, stats=stats)
+        self.assertEqual(0, stats[0].elided[asm.ATTRIBUTES])
+
+    def testConstantSubscript(self):
+        stats = get_stats('def f():\n    a = (1, 2)\n    a[1]\n    a[-2]\n'
+                          '    a[2]\n    b = "ab"\n    b[0]\n'
+                          '    c = [1, 2]\n    c[0]\n'
+                          'def g(i):\n    a = (1, 2)\n    a[i]\n'
+                          'def h(a):\n    a = (1, 2)\n    a[0]\n'
+                          'def k():\n    a = (1, 2)\n    a = "a"\n    a[1]\n')
+        self.assertEqual([3, 0, 0, 0],
+                         [s.elided[asm.SUBSCRIPTS] for s in stats[1:]])
+        self.assertEqual([2, 1, 1, 1],
+                         [s.sites[asm.SUBSCRIPTS] for s in stats[1:]])
+
+    def testRepeatedAttribute(self):
+        stats = get_stats('def f(x):\n    return (x.a, x.a, x.b)\n'
+                          'def g(x):\n    return (x.a, h(), x.a)\n'
+                          'def h(x):\n    a = x.a\n    x = 1\n    x.a\n')
+        self.assertEqual([1, 0, 0],
+                         [s.elided[asm.ATTRIBUTES] for s in stats[1:]])
+        self.assertEqual([2, 2, 2],
+                         [s.sites[asm.ATTRIBUTES] for s in stats[1:]])
+
+    def testCoalescedCleanups(self):
+        def f(x):
+            return x.a.b
+        code = asm.patch_code(f.func_code)
+        self.assertEqual(2, count_ops(code, bytecode.STORE_GLOBAL))
+        self.assertEqual(1, count_ops(code, bytecode.DELETE_GLOBAL))
+
+        def g(x):
+            return x.a[0]
+        code = asm.patch_code(g.func_code)
+        self.assertEqual(3, count_ops(code, bytecode.STORE_GLOBAL))
+        self.assertEqual(2, count_ops(code, bytecode.DELETE_GLOBAL))
+
+    def testCoalescedCleanupsCapture(self):
+        globals().pop('_s_attr', None)
+        class A(object):
+            pass
+        a = A()
+        a.a = A()
+        def f():
+            return a.a.b
+        with self.assertRaises(AttributeError):
+            patch(f)()
+        self.assertIs(a.a, globals()['_s_attr'])
+
+        def g():
+            return a.b.a
+        with self.assertRaises(AttributeError):
+            patch(g)()
+        self.assertIs(a, globals()['_s_attr'])
+
+        a.a.b = 1
+        self.assertEqual(1, patch(f)())
+        self.assertNotIn('_s_attr', globals())
+
+    def testUnboundLocalBetweenSites(self):
+        globals().pop('_s_attr', None)
+        def f(x):
+            y = x
+            del y
+            return x.real, y.real
+        with self.assertRaises(UnboundLocalError):
+            patch(f)(1)
+        self.assertNotIn('_s_attr', globals())
+
+
+class AsmLocalsCaptureTest(unittest.TestCase):
+    def testSubscrBinary(self):
+        def f():
+            a = [1, 2]
+            return a[1]
+        patched = patch(f, asm.CAPTURE_LOCALS)
+        self.assertEqual(f(), patched())
+        self.assertIn('_s_attr', patched.func_code.co_varnames)
+        self.assertIn('_s_index', patched.func_code.co_varnames)
+        self.assertNotIn('_s_attr', patched.func_code.co_names)
+
+    def testSubscrBinaryWithException(self):
+        globals().pop('_s_attr', None)
+        globals().pop('_s_index', None)
+        def f():
+            {'1': 1}[0]
+        f_locals = get_failing_frame_locals(patch(f, asm.CAPTURE_LOCALS))
+
+        self.assertEqual({'1': 1}, f_locals['_s_attr'])
+        self.assertEqual(0, f_locals['_s_index'])
+        self.assertNotIn('_s_attr', globals())
+        self.assertNotIn('_s_index', globals())
+
+    def testAttrLoadWithException(self):
+        globals().pop('_s_attr', None)
+        o = Foo()
+        def f():
+            return o.names
+        f_locals = get_failing_frame_locals(patch(f, asm.CAPTURE_LOCALS))
+
+        self.assertEqual(o, f_locals['_s_attr'])
+        self.assertNotIn('_s_index', f_locals)
+        self.assertNotIn('_s_attr', globals())
+
+    def testAttrLoadSuccessCleansLocals(self):
+        def f():
+            o = Foo()
+            o.name
+            return locals()
+        self.assertEqual(['o'], patch(f, asm.CAPTURE_LOCALS)().keys())
+
+    def testUnknownCaptureMode(self):
+        with self.assertRaises(ValueError):
+            asm.patch_code(Foo.__init__.func_code, 'unknown')
+
+
+class AsmThreadCaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.state = asm.get_thread_state()
+        vars(self.state).clear()
+
+    def testSubscrBinary(self):
+        globals().pop('_s_attr', None)
+        def f():
+            a = [1, 2]
+            return a[1]
+        self.assertEqual(f(), patch(f, asm.CAPTURE_THREAD)())
+        self.assertEqual({}, asm.get_thread_operands())
+        self.assertNotIn('_s_attr', globals())
+
+    def testSubscrBinaryWithException(self):
+        globals().pop('_s_attr', None)
+        def f():
+            {'1': 1}[0]
+        with self.assertRaises(KeyError):
+            patch(f, asm.CAPTURE_THREAD)()
+
+        self.assertEqual({'_s_attr': {'1': 1}, '_s_index': 0},
+                         asm.get_thread_operands())
+        self.assertNotIn('_s_attr', globals())
+
+    def testAttrLoadWithException(self):
+        o = Foo()
+        def f():
+            return o.names
+        with self.assertRaises(AttributeError):
+            patch(f, asm.CAPTURE_THREAD)()
+
+        self.assertEqual({'_s_attr': o}, asm.get_thread_operands())
+
+    def testThreadsDoNotShareOperands(self):
+        def f(a, i):
+            return a[i]
+        patched = patch(f, asm.CAPTURE_THREAD)
+        results = {}
+
+        def run(n):
+            for _ in xrange(1000):
+                patched([n], 0)
+            try:
+                patched([n], 1)
+            except IndexError:
+                results[n] = asm.get_thread_operands()
+
+        threads = [threading.Thread(target=run, args=(n,)) for n in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for n in xrange(4):
+            self.assertEqual({'_s_attr': [n], '_s_index': 1}, results[n])
+        self.assertEqual({}, asm.get_thread_operands())
+
+
+class AsmRingCaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.state = asm.get_ring_state()
+        self.state.clear()
+
+    def tearDown(self):
+        self.state.clear()
+
+    def get_site(self, f, line, opname):
+        code = f.func_code
+        return code.co_filename, code.co_firstlineno + line, opname
+
+    def testSubscrBinary(self):
+        def f(a, i):
+            return a[i]
+        self.assertEqual(2, patch(f, asm.CAPTURE_RING)([1, 2], 1))
+        self.assertEqual([(self.get_site(f, 1, 'BINARY_SUBSCR'), [1, 2], 1)],
+                         self.state.get_captures())
+
+    def testStoreAndDeleteSubscr(self):
+        def f(d):
+            d['a'] = 1
+            del d['b']
+            return d
+        self.assertEqual({'a': 1}, patch(f, asm.CAPTURE_RING)({'b': 2}))
+        self.assertEqual(
+            ['STORE_SUBSCR', 'DELETE_SUBSCR'],
+            [site[2] for site, _, _ in self.state.get_captures()])
+
+    def testAttrLoadWithException(self):
+        o = Foo()
+        def f():
+            return o.names
+        with self.assertRaises(AttributeError):
+            patch(f, asm.CAPTURE_RING)()
+        self.assertEqual((self.get_site(f, 1, 'LOAD_ATTR'), o, 'names'),
+                         self.state.get_captures()[-1])
+        self.assertNotIn('_s_attr', globals())
+
+    def testRingKeepsLastCaptures(self):
+        def f(a):
+            for i in xrange(len(a)):
+                a[i]
+        patch(f, asm.CAPTURE_RING)(range(100))
+        self.assertEqual(3 * asm.RING_SIZE, len(self.state.ring))
+        self.assertEqual(range(100 - asm.RING_SIZE, 100),
+                         [key for _, _, key in self.state.get_captures()])
+
+    def testThreadsDoNotShareCaptures(self):
+        def f(a, i):
+            return a[i]
+        patched = patch(f, asm.CAPTURE_RING)
+        results = {}
+
+        def run(n):
+            for _ in xrange(1000):
+                patched([n], 0)
+            results[n] = asm.get_ring_state().get_captures()
+
+        threads = [threading.Thread(target=run, args=(n,)) for n in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for n in xrange(4):
+            self.assertEqual(asm.RING_SIZE, len(results[n]))
+            self.assertEqual(set([n]), set(obj[0] for _, obj, _ in results[n]))
+        self.assertEqual([], self.state.get_captures())
+
+
+def get_suggestion_tables(source):
+    code = asm.patch_code(compile(source, 'names.py', 'exec'))
+    return [asm.find_suggestion_table(nested_code.to_code())
+            for nested_code in asm.iter_codes(rewriter.Code.from_code(code))]
+
+
+class AsmSuggestionTableTest(unittest.TestCase):
+    def testTable(self):
+        tables = get_suggestion_tables(
+            'import os\nvalue = sroted(os)\n'
+            'def f(argument):\n    local = 1\n    return argumnet, vlue\n')
+        self.assertEqual([{'sroted': ('sorted',)},
+                          {'argumnet': ('argument',), 'vlue': ('value',)}],
+                         tables)
+
+    def testKnownNames(self):
+        self.assertEqual([None, None], get_suggestion_tables(
+            'import os\ndef f():\n    global x\n    x = len(os.sep)\n'
+            'x\n__name__\n'))
+
+    def testUnknownGlobalNames(self):
+        self.assertEqual([None], get_suggestion_tables(
+            'from os import *\nlne\n'))
+        self.assertIsNone(asm.find_suggestion_table(
+            asm.patch_code(get_stats.func_code)))
+
+    def testTableIsNotRun(self):
+        namespace = {}
+        exec asm.patch_code(compile('def f():\n    return valeu\nvalue = 1\n'
+                                    'valeu = 2\n', 'names.py', 'exec'),
+                            capture=asm.CAPTURE_RING) in namespace
+        self.assertEqual(2, namespace['f']())
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,60 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import exceptions
+import json
+import sys
+import unittest
+
+import python_exceptions_improved.asm as asm
+import python_exceptions_improved.benchmark as benchmark
+import python_exceptions_improved.debug_exception as debug_exception
+
+
+class BenchmarkTest(unittest.TestCase):
+    def testPatchedWorkloadsGiveSameResults(self):
+        for workload in benchmark.WORKLOADS:
+            for capture in asm.CAPTURE_MODES:
+                self.assertEqual(
+                    workload(10),
+                    benchmark.patch_function(workload, capture)(10))
+
+    def testEnrichmentCasesRaise(self):
+        for exception, function, args in benchmark.get_enrichment_cases(3):
+            with self.assertRaises(getattr(exceptions, exception)):
+                function(*args)
+
+    def testRun(self):
+        results = json.loads(json.dumps(benchmark.run(quick=True, repeat=1)))
+        self.assertEqual(len(benchmark.WORKLOADS) * len(asm.CAPTURE_MODES),
+                         len(results['runtime']))
+        self.assertEqual(['plain', 'instrumented', 'cached', 'lazy'],
+                         [result['mode'] for result in results['import']])
+        self.assertEqual(8, len(results['enrichment']))
+        for result in results['enrichment']:
+            self.assertGreater(result['message'], 0)
+        self.assertEqual(['patch', 'roundtrip'],
+                         [result['operation'] for result in
+                          results['rewriter']][:2])
+        for result in results['rewriter']:
+            self.assertGreater(result['instructions_per_second'], 0)
+
+        self.assertFalse([name for name in sys.modules
+                          if name.startswith('exceptions_improved_benchmark')])
+        self.assertFalse([importer for importer in sys.meta_path
+                          if isinstance(importer,
+                                        debug_exception.ModuleImporter)])
+
+
+if __name__ == '__main__':
+    unittest.main()
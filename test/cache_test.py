@@ -0,0 +1,146 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import py_compile
+import shutil
+import sys
+import tempfile
+import unittest
+
+import python_exceptions_improved.cache as cache
+import python_exceptions_improved.debug_exception as debug_exception
+import python_exceptions_improved.hotness as hotness
+import python_exceptions_improved.policy as policy
+
+
+FOO_DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'foo_data.py')
+
+
+class CodeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = cache.CodeCache(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testKey(self):
+        key = self.cache.get_key('a = 1', 'a.py')
+        self.assertEqual(key, self.cache.get_key('a = 1', 'a.py'))
+        self.assertNotEqual(key, self.cache.get_key('a = 2', 'a.py'))
+        self.assertNotEqual(key, self.cache.get_key('a = 1', 'b.py'))
+        self.assertNotEqual(key, self.cache.get_key('a = 1', 'a.py', ('x',)))
+
+    def testStoreAndLoad(self):
+        key = self.cache.get_key('a = 1', 'a.py')
+        self.assertIsNone(self.cache.load(key))
+        code = compile('a = 1', 'a.py', 'exec')
+        self.cache.store(key, code)
+        self.assertEqual(code, self.cache.load(key))
+        self.assertEqual({'hits': 1, 'misses': 1}, self.cache.get_stats())
+
+    def testLoadCorrupted(self):
+        key = self.cache.get_key('a = 1', 'a.py')
+        self.cache.store(key, compile('a = 1', 'a.py', 'exec'))
+        with open(self.cache.get_path(key), 'wb') as f:
+            f.write('garbage')
+        self.assertIsNone(self.cache.load(key))
+        self.assertEqual(1, self.cache.misses)
+
+
+class ModuleImporterCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = cache.CodeCache(self.directory)
+        self.importer = debug_exception.ModuleImporter(cache=self.cache)
+        self.importer.uninstall()
+
+    def tearDown(self):
+        sys.modules.pop('foo_data_cached', None)
+        shutil.rmtree(self.directory)
+
+    def testWarmImport(self):
+        self.importer.get_module_from_source(
+            'foo_data_cached', FOO_DATA_PATH)
+        self.assertEqual({'hits': 0, 'misses': 1}, self.cache.get_stats())
+
+        del sys.modules['foo_data_cached']
+        mod = self.importer.get_module_from_source(
+            'foo_data_cached', FOO_DATA_PATH)
+        self.assertEqual({'hits': 1, 'misses': 1}, self.cache.get_stats())
+
+        with self.assertRaises(IndexError) as ctx:
+            debug_exception.debug_exceptions(mod.subscr_binary)()
+        self.assertIn('Debug info:\n\tObject: []\n\tObject len: 0\n\tIndex: 0',
+                      str(ctx.exception))
+
+    def testImporterStats(self):
+        self.importer.get_module_from_source(
+            'foo_data_cached', FOO_DATA_PATH)
+        stats = self.importer.get_stats()
+        self.assertEqual('miss', stats['modules'][0]['cache'])
+        self.assertEqual(7, sum(stats['modules'][0]['sites'].values()))
+
+        del sys.modules['foo_data_cached']
+        self.importer.get_module_from_source(
+            'foo_data_cached', FOO_DATA_PATH)
+        stats = self.importer.get_stats()
+        self.assertEqual('hit', stats['modules'][0]['cache'])
+        self.assertEqual({'cache_hits': 1, 'cache_misses': 0},
+                         {'cache_hits': stats['totals']['cache_hits'],
+                          'cache_misses': stats['totals']['cache_misses']})
+
+    def testPycImporterStats(self):
+        source_path = os.path.join(self.directory, 'pyc_data.py')
+        with open(source_path, 'w') as f:
+            f.write('x = {}\n\ndef f(a):\n    return a[0]\n')
+        py_compile.compile(source_path)
+        os.remove(source_path)
+
+        self.importer.get_module_from_pyc('foo_data_cached',
+                                          source_path + 'c')
+        stats = self.importer.get_stats()
+        self.assertEqual(1, stats['totals']['modules'])
+        self.assertEqual('foo_data_cached', stats['modules'][0]['module'])
+        self.assertEqual('miss', stats['modules'][0]['cache'])
+        self.assertEqual(1, sum(stats['modules'][0]['sites'].values()))
+
+    def testPycProfileChange(self):
+        source_path = os.path.join(self.directory, 'hot_pyc_data.py')
+        with open(source_path, 'w') as f:
+            f.write('x = {}\n\ndef f(a):\n    return a[0]\n')
+        py_compile.compile(source_path)
+        os.remove(source_path)
+
+        self.importer.get_module_from_pyc('foo_data_cached',
+                                          source_path + 'c')
+        self.assertEqual(
+            [], self.importer.get_stats()['modules'][0]['skipped'])
+
+        del sys.modules['foo_data_cached']
+        profile = hotness.Profile({(source_path, 3, 'f'): 50})
+        importer = debug_exception.ModuleImporter(
+            cache=self.cache,
+            policy=policy.InstrumentationPolicy(profile=profile,
+                                                max_calls=10))
+        importer.uninstall()
+        importer.get_module_from_pyc('foo_data_cached', source_path + 'c')
+        self.assertEqual({'hits': 0, 'misses': 2}, self.cache.get_stats())
+        self.assertEqual(['f:3'],
+                         importer.get_stats()['modules'][0]['skipped'])
+
+
+if __name__ == '__main__':
+    unittest.main()
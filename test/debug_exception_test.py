@@ -11,9 +11,15 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import StringIO
 import importlib
+import json
+import pickle
+import sys
 import unittest
+import weakref
 
+import python_exceptions_improved.asm as asm
 import python_exceptions_improved.debug_exception as debug_exception
 
 
@@ -78,6 +84,36 @@ class DebugExceptionsTest(unittest.TestCase):
 
         self.assertIn('Debug info:\n\tObject: {}\n\tKey: \'bla\'', ctx.exception.message)
 
+    def testKeyErrorLargeDict(self):
+        @debug_exception.debug_exceptions
+        def f():
+            a['fooo']
+
+        a = dict(('key%d' % i, i) for i in xrange(5000))
+        a['foo'] = 1
+        globals()['_s_attr'] = a
+        globals()['_s_index'] = 'fooo'
+        with self.assertRaises(KeyError) as ctx:
+            f()
+
+        self.assertIn('...} (5001 items)\n\tKey: \'fooo\'', ctx.exception.message)
+        self.assertIn('\n\tSimilar keys: \'foo\'', ctx.exception.message)
+        self.assertLess(len(ctx.exception.message), 1000)
+
+    def testIndexErrorLargeList(self):
+        @debug_exception.debug_exceptions
+        def f():
+            a[1000]
+
+        a = range(1000)
+        globals()['_s_attr'] = a
+        globals()['_s_index'] = 1000
+        with self.assertRaises(IndexError) as ctx:
+            f()
+
+        self.assertIn('...] (1000 items)\n\tObject len: 1000\n\tIndex: 1000', str(ctx.exception))
+        self.assertIn('\n\tNearby items: [995]: 995, [996]: 996', str(ctx.exception))
+
     def testKeyErrorNoGlobals(self):
         @debug_exception.debug_exceptions
         def f():
@@ -123,9 +159,13 @@ class DebugExceptionsTest(unittest.TestCase):
 class ModuleImporterTest(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        debug_exception.ModuleImporter()
+        cls.importer = debug_exception.ModuleImporter()
         cls.foo = importlib.import_module('foo_data')
 
+    @classmethod
+    def tearDownClass(cls):
+        cls.importer.uninstall()
+
     def testSubscrBinary(self):
         with self.assertRaises(IndexError) as ctx:
             debug_exception.debug_exceptions(self.foo.subscr_binary)()
@@ -162,5 +202,492 @@ class ModuleImporterTest(unittest.TestCase):
         self.assertIn('\n\tObject: ', str(ctx.exception))
         self.assertIn('\n\tType: <type \'object\'>\n\tAttributes: ', str(ctx.exception))
 
+
+class ModuleImporterStatsTest(unittest.TestCase):
+    def testStats(self):
+        importer = debug_exception.ModuleImporter()
+        importer.uninstall()
+        code = compile('import os\nos.path\ndef f(a):\n    return a[0]\n',
+                       'stats_data.py', 'exec')
+        importer.get_module_from_code('stats_data', code)
+        del sys.modules['stats_data']
+
+        stats = importer.get_stats()
+        self.assertEqual(1, len(stats['modules']))
+        module_stats = stats['modules'][0]
+        self.assertEqual('stats_data', module_stats['module'])
+        self.assertEqual('stats_data.py', module_stats['file'])
+        self.assertIsNone(module_stats['cache'])
+        self.assertEqual({asm.ATTRIBUTES: 0, asm.SUBSCRIPTS: 1},
+                         module_stats['sites'])
+        self.assertEqual(['<module>', 'f'],
+                         [c['name'] for c in module_stats['code_objects']])
+        self.assertGreater(module_stats['patched_size'],
+                           module_stats['original_size'])
+        self.assertEqual(module_stats['sites'], stats['totals']['sites'])
+        self.assertEqual(1, stats['totals']['modules'])
+
+    def testLazyStats(self):
+        importer = debug_exception.ModuleImporter(lazy=True)
+        importer.uninstall()
+        code = compile('def f(a):\n    return a[0]\n', 'lazy_stats_data.py',
+                       'exec')
+        mod = importer.get_module_from_code('lazy_stats_data', code)
+        del sys.modules['lazy_stats_data']
+        self.assertEqual([], importer.get_stats()['modules'])
+
+        mod.f([1])
+        module_stats = importer.get_stats()['modules'][0]
+        self.assertEqual(['f'], [c['name'] for c in module_stats['code_objects']])
+
+
+class SafeSitesTest(unittest.TestCase):
+    def testModuleAttribute(self):
+        importer = debug_exception.ModuleImporter()
+        importer.uninstall()
+        code = compile('import os\ndef f():\n    return os.pathh\n',
+                       'safe_data.py', 'exec')
+        mod = importer.get_module_from_code('safe_data', code)
+        del sys.modules['safe_data']
+
+        with self.assertRaises(AttributeError) as ctx:
+            debug_exception.debug_exceptions(mod.f)()
+        self.assertIn('Did you mean \'path\'', str(ctx.exception))
+        self.assertIn('Debug info:\n\tObject: <module \'os\'', str(ctx.exception))
+
+
+class LazyMessageTest(unittest.TestCase):
+    def raise_key_error(self):
+        @debug_exception.debug_exceptions
+        def f():
+            a['bla']
+
+        a = {'blah': 1}
+        globals()['_s_attr'] = a
+        globals()['_s_index'] = 'bla'
+        try:
+            f()
+        except KeyError as e:
+            return e
+
+    def testMessageBuiltOnFirstUse(self):
+        exception = self.raise_key_error()
+        self.assertIsNone(exception._debug_message)
+        message = str(exception)
+        self.assertIn('Debug info:\n\tObject: {\'blah\': 1}', message)
+        self.assertIn('\n\tSimilar keys: \'blah\'', message)
+        self.assertIs(message, exception._debug_message)
+        self.assertIsNone(exception._debug_context)
+        self.assertIs(message, exception.message)
+        self.assertEqual((message,), exception.args)
+
+    def testType(self):
+        exception = self.raise_key_error()
+        self.assertIsInstance(exception, debug_exception.KeyError_)
+        self.assertEqual('KeyError_', type(exception).__name__)
+        self.assertIs(type(exception), type(self.raise_key_error()))
+
+    def testRepr(self):
+        exception = self.raise_key_error()
+        self.assertEqual('KeyError_(%r,)' % str(exception), repr(exception))
+
+    def testPickle(self):
+        exception = pickle.loads(pickle.dumps(self.raise_key_error()))
+        self.assertIs(debug_exception.KeyError_, type(exception))
+        self.assertIn('Similar keys', str(exception))
+
+    def testOtherExceptionsUnchanged(self):
+        error = ValueError('value')
+
+        @debug_exception.debug_exceptions
+        def f():
+            raise error
+
+        with self.assertRaises(ValueError) as ctx:
+            f()
+        self.assertIs(error, ctx.exception)
+
+
+class Operand(object):
+    pass
+
+
+class RetentionTest(unittest.TestCase):
+    def tearDown(self):
+        debug_exception.set_retention(debug_exception.RETAIN_STRONG)
+        globals().pop('_s_attr', None)
+        globals().pop('_s_index', None)
+
+    def raise_error(self, attr, index, f):
+        globals()['_s_attr'] = attr
+        if index is not None:
+            globals()['_s_index'] = index
+        try:
+            debug_exception.debug_exceptions(f)()
+        except LookupError as e:
+            return e
+        except AttributeError as e:
+            return e
+
+    def testSlotsAreReleased(self):
+        def f():
+            {}[0]
+        self.raise_error({}, 0, f)
+        self.assertNotIn('_s_attr', globals())
+        self.assertNotIn('_s_index', globals())
+
+    def testSlotsAreReleasedWithoutHandler(self):
+        @debug_exception.debug_exceptions
+        def f():
+            raise ValueError()
+        globals()['_s_attr'] = {}
+        globals()['_s_index'] = 0
+        self.assertRaises(ValueError, f)
+        self.assertNotIn('_s_attr', globals())
+        self.assertNotIn('_s_index', globals())
+
+    def testWeakReferenceKeepsMessageLazy(self):
+        debug_exception.set_retention(debug_exception.RETAIN_WEAK)
+        operand = Operand()
+
+        def f():
+            operand.missing
+        exception = self.raise_error(operand, None, f)
+        self.assertIsNone(exception._debug_message)
+        self.assertIn('Object: <', str(exception))
+
+    def testOperandIsNotKeptAlive(self):
+        debug_exception.set_retention(debug_exception.RETAIN_WEAK)
+        operand = Operand()
+        reference = weakref.ref(operand)
+
+        def f():
+            Operand().missing
+        exception = self.raise_error(operand, None, f)
+        del operand
+        self.assertIsNone(reference())
+        self.assertIn("has no attribute 'missing'", str(exception))
+        self.assertNotIn('Object:', str(exception))
+
+    def testSummaryOfObjectsWithoutWeakReferences(self):
+        debug_exception.set_retention(debug_exception.RETAIN_WEAK)
+
+        def f():
+            [1, 2][5]
+        exception = self.raise_error([1, 2], 5, f)
+        self.assertIsNone(exception._debug_context)
+        self.assertIn('Object: [1, 2]\n\tObject len: 2\n\tIndex: 5',
+                      str(exception))
+
+    def testRingIsReleased(self):
+        debug_exception.set_retention(debug_exception.RETAIN_WEAK)
+        importer = debug_exception.ModuleImporter(capture=asm.CAPTURE_RING)
+        importer.uninstall()
+        code = compile('def f(a, b):\n    a[0]\n    return b.missing\n',
+                       'ring_retention.py', 'exec')
+        mod = importer.get_module_from_code('ring_retention', code)
+        del sys.modules['ring_retention']
+        operand = Operand()
+        reference = weakref.ref(operand)
+        try:
+            debug_exception.debug_exceptions(mod.f)([1], operand)
+        except AttributeError as e:
+            exception = e
+        # The traceback of the last exception keeps the frame of f alive.
+        sys.exc_clear()
+        del operand
+        self.assertIsNone(reference())
+        self.assertEqual([], asm.get_ring_captures())
+        self.assertIn('ring_retention.py:2 BINARY_SUBSCR: [1][0]',
+                      str(exception))
+
+    def testNameErrorDoesNotKeepFrame(self):
+        @debug_exception.debug_exceptions
+        def f(operand):
+            return operan
+
+        operand = Operand()
+        reference = weakref.ref(operand)
+        try:
+            f(operand)
+        except NameError as e:
+            exception = e
+        sys.exc_clear()
+        del operand
+        self.assertIsNone(reference())
+        self.assertIn("Did you mean 'operand'", str(exception))
+
+    def testUnknownRetention(self):
+        self.assertRaises(ValueError, debug_exception.set_retention, 'soft')
+
+
+class ExceptHookTest(unittest.TestCase):
+    def setUp(self):
+        self.excepthook = sys.excepthook
+        self.reported = []
+        sys.excepthook = lambda *exc_info: self.reported.append(exc_info)
+
+    def tearDown(self):
+        sys.excepthook = self.excepthook
+
+    def testUncaughtExceptionIsEnriched(self):
+        debug_exception.install_excepthook()
+        debug_exception.install_excepthook()
+        try:
+            {}.itmes
+        except AttributeError:
+            sys.excepthook(*sys.exc_info())
+        self.assertEqual(1, len(self.reported))
+        et, ei, tb = self.reported[0]
+        self.assertIsInstance(ei, debug_exception.LazyDebugMessage)
+        self.assertIs(et, type(ei))
+        self.assertIn("Did you mean 'items'?", str(ei))
+        self.assertIsNotNone(tb)
+
+
+class ThreadCaptureTest(unittest.TestCase):
+    def testSubscrBinary(self):
+        importer = debug_exception.ModuleImporter(capture=asm.CAPTURE_THREAD)
+        importer.uninstall()
+        code = compile('def f():\n    a = []\n    a[0]\n', 'thread_data.py',
+                       'exec')
+        mod = importer.get_module_from_code('thread_data', code)
+        del sys.modules['thread_data']
+
+        with self.assertRaises(IndexError) as ctx:
+            debug_exception.debug_exceptions(mod.f)()
+        self.assertIn('Debug info:\n\tObject: []\n\tObject len: 0\n\tIndex: 0', str(ctx.exception))
+        self.assertNotIn('_s_attr', vars(mod))
+        self.assertNotIn('_s_attr', vars(asm.get_thread_state()))
+
+    def testNestedSites(self):
+        importer = debug_exception.ModuleImporter(capture=asm.CAPTURE_THREAD)
+        importer.uninstall()
+        box = importer.get_module_from_code('thread_box', compile(
+            'class Box(object):\n'
+            '    def __init__(self, items):\n        self.items = items\n'
+            '    @property\n    def first(self):\n'
+            '        return self.items[0]\n'
+            '    def __getitem__(self, i):\n        return self.items[i]\n',
+            'thread_box.py', 'exec'))
+        users = importer.get_module_from_code('thread_users', compile(
+            'def get_first(box):\n    return box.first\n'
+            'def get_item(box, i):\n    return box[i]\n',
+            'thread_users.py', 'exec'))
+        del sys.modules['thread_box']
+        del sys.modules['thread_users']
+
+        self.assertEqual(1, users.get_first(box.Box([1, 2])))
+        self.assertEqual(2, users.get_item(box.Box([1, 2]), 1))
+        with self.assertRaises(IndexError) as ctx:
+            debug_exception.debug_exceptions(users.get_item)(box.Box([]), 0)
+        self.assertIn('Debug info:\n\tObject: []\n\tObject len: 0\n'
+                      '\tIndex: 0', str(ctx.exception))
+
+
+class LocalsCaptureTest(unittest.TestCase):
+    def testSubscrBinary(self):
+        importer = debug_exception.ModuleImporter(capture=asm.CAPTURE_LOCALS)
+        importer.uninstall()
+        code = compile('def f():\n    a = []\n    a[0]\n', 'locals_data.py',
+                       'exec')
+        mod = importer.get_module_from_code('locals_data', code)
+        del sys.modules['locals_data']
+
+        with self.assertRaises(IndexError) as ctx:
+            debug_exception.debug_exceptions(mod.f)()
+        self.assertIn('Debug info:\n\tObject: []\n\tObject len: 0\n\tIndex: 0', str(ctx.exception))
+        self.assertNotIn('_s_attr', vars(mod))
+
+
+class RingCaptureTest(unittest.TestCase):
+    def setUp(self):
+        importer = debug_exception.ModuleImporter(capture=asm.CAPTURE_RING)
+        importer.uninstall()
+        code = compile('def f(a, n):\n    for i in range(n):\n        a[i]\n'
+                       'def g():\n    return {}.a\n',
+                       'ring_data.py', 'exec')
+        self.mod = importer.get_module_from_code('ring_data', code)
+        del sys.modules['ring_data']
+        asm.get_ring_state().clear()
+
+    def tearDown(self):
+        asm.get_ring_state().clear()
+
+    def testSubscrBinaryWithHistory(self):
+        with self.assertRaises(IndexError) as ctx:
+            debug_exception.debug_exceptions(self.mod.f)([5, 6], 3)
+        self.assertIn('Debug info:\n\tObject: [5, 6]\n\tObject len: 2\n\tIndex: 2', str(ctx.exception))
+        self.assertIn('Operand history:\n'
+                      '\tring_data.py:3 BINARY_SUBSCR: [5, 6][0]\n'
+                      '\tring_data.py:3 BINARY_SUBSCR: [5, 6][1]\n'
+                      '\tring_data.py:3 BINARY_SUBSCR: [5, 6][2]',
+                      str(ctx.exception))
+        self.assertEqual(
+            {'site': 'ring_data.py:3 BINARY_SUBSCR', 'object': '[5, 6]',
+             'key': '2'},
+            ctx.exception.debug_info['history'][-1])
+
+    def testStaleCaptureIsNotUsed(self):
+        self.mod.f([5, 6], 2)
+
+        @debug_exception.debug_exceptions
+        def h():
+            return [][0]
+
+        with self.assertRaises(IndexError) as ctx:
+            h()
+        self.assertNotIn('Debug info:', str(ctx.exception))
+        self.assertNotIn('history', ctx.exception.debug_info)
+
+    def testElidedSiteOnTheSameLine(self):
+        importer = debug_exception.ModuleImporter(capture=asm.CAPTURE_RING)
+        importer.uninstall()
+        mod = importer.get_module_from_code('ring_elided', compile(
+            'import os\ndef f(x):\n    return x.real + os.nope\n',
+            'ring_elided.py', 'exec'))
+        del sys.modules['ring_elided']
+        with self.assertRaises(AttributeError) as ctx:
+            debug_exception.debug_exceptions(mod.f)(5)
+        self.assertIn("Did you mean 'open'", str(ctx.exception))
+        self.assertIn("\tObject: <module 'os'", str(ctx.exception))
+        self.assertNotIn('history', ctx.exception.debug_info)
+
+    def testAttrLoad(self):
+        with self.assertRaises(AttributeError) as ctx:
+            debug_exception.debug_exceptions(self.mod.g)()
+        self.assertIn('\tObject: {}', str(ctx.exception))
+        self.assertIn('\tring_data.py:5 LOAD_ATTR: {}.a', str(ctx.exception))
+
+
+class HandlerRegistryTest(unittest.TestCase):
+    def testLookupFollowsMro(self):
+        handlers = debug_exception.HandlerRegistry()
+        handler = object()
+        handlers.register(LookupError, handler)
+        self.assertIs(handler, handlers.lookup(KeyError))
+        self.assertIsNone(handlers.lookup(ValueError))
+
+        key_handler = object()
+        handlers.register(KeyError, key_handler)
+        self.assertIs(key_handler, handlers.lookup(KeyError))
+        self.assertIs(handler, handlers.lookup(IndexError))
+        handlers.unregister(KeyError)
+        self.assertIs(handler, handlers.lookup(KeyError))
+
+    def testDefaultHandlers(self):
+        class CustomKeyError(KeyError):
+            pass
+        self.assertIs(debug_exception.HANDLERS.lookup(KeyError),
+                      debug_exception.HANDLERS.lookup(CustomKeyError))
+        self.assertIsNone(debug_exception.HANDLERS.lookup(ValueError))
+
+
+class DebugInfoTest(unittest.TestCase):
+    def testKeyError(self):
+        @debug_exception.debug_exceptions
+        def f():
+            a['bla']
+
+        a = {'blah': 1}
+        globals()['_s_attr'] = a
+        globals()['_s_index'] = 'bla'
+        with self.assertRaises(KeyError) as ctx:
+            f()
+        self.assertEqual({
+            'exception': 'KeyError',
+            'message': "'bla'",
+            'object': "{'blah': 1}",
+            'object_type': '__builtin__.dict',
+            'length': 1,
+            'key': "'bla'",
+            'similar_keys': ["'blah'"],
+        }, ctx.exception.debug_info)
+
+    def testAttributeError(self):
+        @debug_exception.debug_exceptions
+        def f():
+            return {}.itmes
+
+        with self.assertRaises(AttributeError) as ctx:
+            f()
+        debug_info = ctx.exception.debug_info
+        self.assertEqual('itmes', debug_info['attribute'])
+        self.assertEqual(['items'], debug_info['suggestions'])
+        self.assertEqual(str(dict), debug_info['type'])
+        self.assertEqual(len(dir(dict)), debug_info['attributes_count'])
+
+    def testNameErrorOutsideFunctions(self):
+        namespace = {'variable': 1}
+        with self.assertRaises(NameError) as ctx:
+            debug_exception.debug_exceptions(
+                lambda: eval('variables', namespace))()
+        self.assertEqual('variables', ctx.exception.debug_info['name'])
+        self.assertIn("Did you mean 'variable'", str(ctx.exception))
+
+    def testNameErrorBuiltins(self):
+        @debug_exception.debug_exceptions
+        def f():
+            return sroted([])
+
+        with self.assertRaises(NameError) as ctx:
+            f()
+        self.assertEqual(['sorted'], ctx.exception.debug_info['suggestions'])
+
+    def testNameErrorSuggestionTable(self):
+        namespace = {}
+        exec asm.patch_code(compile('value = 1\ndef f():\n    return valeu\n',
+                                    'table.py', 'exec')) in namespace
+        # Bound after patching, so it is not in the table of f.
+        namespace['valeus'] = 2
+        with self.assertRaises(NameError) as ctx:
+            debug_exception.debug_exceptions(namespace['f'])()
+        self.assertEqual(['value'], ctx.exception.debug_info['suggestions'])
+
+    def testNameErrorSuggestionTableHit(self):
+        namespace = {}
+        exec asm.patch_code(compile('value = 1\ndef f():\n    return valeu\n',
+                                    'table.py', 'exec')) in namespace
+        try:
+            debug_exception.debug_exceptions(namespace['f'])()
+        except NameError as e:
+            exception = e
+        # The namespaces of the frame are not read.
+        self.assertEqual({'suggestions': ('value',)},
+                         exception._debug_context[3])
+
+    def testUnboundLocalError(self):
+        @debug_exception.debug_exceptions
+        def f():
+            x += 1
+
+        with self.assertRaises(UnboundLocalError) as ctx:
+            f()
+        self.assertEqual('UnboundLocalError',
+                         ctx.exception.debug_info['exception'])
+        self.assertNotIn('Did you mean', str(ctx.exception))
+
+
+class JsonLinesEmitterTest(unittest.TestCase):
+    def tearDown(self):
+        debug_exception.set_emitter(None)
+
+    def testEmit(self):
+        stream = StringIO.StringIO()
+        debug_exception.set_emitter(debug_exception.JsonLinesEmitter(stream))
+
+        def f():
+            return [1][1]
+
+        with self.assertRaises(IndexError):
+            debug_exception.debug_exceptions(f)()
+        with self.assertRaises(ValueError):
+            debug_exception.debug_exceptions(int)('a')
+        record = json.loads(stream.getvalue())
+        self.assertEqual('IndexError', record['exception'])
+        self.assertEqual(__name__ + '.f', record['function'])
+        self.assertEqual(f.func_code.co_firstlineno + 1, record['lineno'])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,126 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import python_exceptions_improved.debug_exception as debug_exception
+import python_exceptions_improved.finder as finder
+
+
+def touch(path, mtime=None):
+    with open(path, 'w') as f:
+        f.write('value = %r\n' % os.path.basename(path))
+    if mtime is not None:
+        os.utime(os.path.dirname(path), (mtime, mtime))
+
+
+class PathFinderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.finder = finder.PathFinder()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def find(self, name):
+        return self.finder.find_spec(name, [self.directory])
+
+    def testSource(self):
+        touch(os.path.join(self.directory, 'mod.py'))
+        spec = self.find('mod')
+        self.assertEqual(os.path.join(self.directory, 'mod.py'), spec.origin)
+        self.assertEqual(imp.PY_SOURCE, spec.kind)
+        self.assertFalse(spec.is_package)
+
+    def testSourceBeforeBytecode(self):
+        touch(os.path.join(self.directory, 'mod.pyc'))
+        self.assertEqual(imp.PY_COMPILED, self.find('mod').kind)
+        touch(os.path.join(self.directory, 'mod.py'))
+        self.finder.invalidate_caches()
+        self.assertEqual(imp.PY_SOURCE, self.find('mod').kind)
+
+    def testPackage(self):
+        os.mkdir(os.path.join(self.directory, 'pkg'))
+        touch(os.path.join(self.directory, 'pkg.py'))
+        self.assertEqual(imp.PY_SOURCE, self.find('pkg').kind)
+        touch(os.path.join(self.directory, 'pkg', '__init__.py'))
+        spec = self.find('pkg')
+        self.assertTrue(spec.is_package)
+        self.assertEqual(os.path.join(self.directory, 'pkg'), spec.origin)
+
+    def testSubmodule(self):
+        touch(os.path.join(self.directory, 'mod.py'))
+        spec = self.find('pkg.sub.mod')
+        self.assertEqual('pkg.sub.mod', spec.name)
+        self.assertEqual(os.path.join(self.directory, 'mod.py'), spec.origin)
+
+    def testCaseSensitive(self):
+        touch(os.path.join(self.directory, 'Mod.py'))
+        self.assertIsNone(self.find('mod'))
+
+    def testNotFound(self):
+        self.assertIsNone(self.find('missing'))
+        self.assertIsNone(self.finder.find_spec(
+            'mod', [os.path.join(self.directory, 'missing'), None]))
+
+    def testBuiltin(self):
+        self.assertIsNone(self.finder.find_spec('sys'))
+        self.assertIsNotNone(self.finder.find_spec('os'))
+
+    def testListingIsCached(self):
+        # Whole seconds, as os.utime may round fractions.
+        mtime = 1000000000
+        touch(os.path.join(self.directory, 'a.py'), mtime)
+        self.assertIsNone(self.find('b'))
+        touch(os.path.join(self.directory, 'b.py'), mtime)
+        self.assertIsNone(self.find('b'))
+
+        os.utime(self.directory, (mtime + 10, mtime + 10))
+        self.assertIsNotNone(self.find('b'))
+
+
+class ModuleImporterFinderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.importer = debug_exception.ModuleImporter()
+        self.importer.uninstall()
+        os.mkdir(os.path.join(self.directory, 'finder_pkg'))
+        touch(os.path.join(self.directory, 'finder_pkg', '__init__.py'))
+        touch(os.path.join(self.directory, 'finder_pkg', 'finder_mod.py'))
+
+    def tearDown(self):
+        for name in ('finder_pkg', 'finder_pkg.finder_mod'):
+            sys.modules.pop(name, None)
+        shutil.rmtree(self.directory)
+
+    def testLoadPackageAndSubmodule(self):
+        path = [self.directory]
+        self.assertIs(self.importer,
+                      self.importer.find_module('finder_pkg', path))
+        package = self.importer.load_module('finder_pkg')
+        self.assertEqual('__init__.py', package.value)
+        self.assertIs(self.importer, self.importer.find_module(
+            'finder_pkg.finder_mod', package.__path__))
+        module = self.importer.load_module('finder_pkg.finder_mod')
+        self.assertEqual('finder_mod.py', module.value)
+        self.assertEqual({}, self.importer.specs)
+
+    def testNotFound(self):
+        self.assertIsNone(self.importer.find_module('missing',
+                                                    [self.directory]))
+        self.assertRaises(ImportError, self.importer.load_module, 'missing')
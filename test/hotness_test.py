@@ -0,0 +1,75 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import cProfile
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import python_exceptions_improved.hotness as hotness
+
+
+def hot(n):
+    return n
+
+
+def run():
+    for i in xrange(20):
+        hot(i)
+
+
+class ProfileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testFromPstats(self):
+        path = os.path.join(self.directory, 'run.prof')
+        profiler = cProfile.Profile()
+        profiler.runcall(run)
+        profiler.dump_stats(path)
+
+        profile = hotness.load_profile(path)
+        code = hot.func_code
+        self.assertEqual(20, profile.get_calls(
+            code.co_filename, code.co_firstlineno, 'hot'))
+        self.assertEqual(1, profile.get_calls(
+            code.co_filename, run.func_code.co_firstlineno, 'run'))
+        self.assertEqual([(code.co_firstlineno, 'hot')],
+                         profile.get_hot_functions(code.co_filename, 1))
+
+    def testFromCounts(self):
+        path = os.path.join(self.directory, 'counts.json')
+        with open(path, 'w') as f:
+            json.dump({'/src/a.py:3(f)': 7, '/src/a.py:10(<lambda>)': 2}, f)
+
+        profile = hotness.load_profile(path)
+        self.assertEqual(7, profile.get_calls('/src/a.py', 3, 'f'))
+        self.assertEqual(2, profile.get_calls('/src/../src/a.py', 10,
+                                              '<lambda>'))
+        self.assertEqual(0, profile.get_calls('/src/a.py', 4, 'f'))
+        self.assertEqual([(3, 'f')], profile.get_hot_functions('/src/a.py', 2))
+
+    def testInvalidLabel(self):
+        path = os.path.join(self.directory, 'counts.json')
+        with open(path, 'w') as f:
+            json.dump({'f': 1}, f)
+        self.assertRaises(ValueError, hotness.load_profile, path)
+
+
+if __name__ == '__main__':
+    unittest.main()
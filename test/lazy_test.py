@@ -0,0 +1,160 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sys
+import unittest
+
+import python_exceptions_improved.debug_exception as debug_exception
+import python_exceptions_improved.lazy as lazy
+
+
+LAZY_DATA = '''
+def decorator(f):
+    def wrapper(*args):
+        return f(*args)
+    return wrapper
+
+
+class Foo(object):
+    def method(self):
+        return [][0]
+
+    @staticmethod
+    def static():
+        return [][0]
+
+    @property
+    def prop(self):
+        return [][0]
+
+
+@decorator
+def decorated():
+    return [][0]
+
+
+def subscr_binary():
+    a = []
+    a[0]
+'''
+
+
+def trampoline(f):
+    calls = []
+    original = f.func_code
+
+    def activate():
+        calls.append(1)
+        f.func_code = original
+        return f
+    f.func_code = lazy.make_trampoline(original, activate)
+    return calls
+
+
+class MakeTrampolineTest(unittest.TestCase):
+    def testPositional(self):
+        def f(a, b=2):
+            return a, b
+        calls = trampoline(f)
+        self.assertEqual((1, 3), f(1, b=3))
+        self.assertEqual([1], calls)
+        self.assertEqual((1, 2), f(1))
+        self.assertEqual([1], calls)
+
+    def testVarArgs(self):
+        def f(a, *args, **kwargs):
+            return a, args, kwargs
+        trampoline(f)
+        self.assertEqual((1, (2, 3), {'c': 4}), f(1, 2, 3, c=4))
+
+    def testKwArgs(self):
+        def f(**kwargs):
+            return kwargs
+        trampoline(f)
+        self.assertEqual({'c': 4}, f(c=4))
+
+    def testClosure(self):
+        x = []
+        def f(y):
+            x.append(y)
+            return x
+        trampoline(f)
+        self.assertEqual([1], f(1))
+
+    def testGenerator(self):
+        def f(n):
+            for i in xrange(n):
+                yield i
+        trampoline(f)
+        self.assertEqual([0, 1, 2], list(f(3)))
+
+
+class LazyPatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.patched = []
+        def patch(code):
+            self.patched.append(code.co_name)
+            return code
+        self.patcher = lazy.LazyPatcher(patch)
+
+    def testInstall(self):
+        namespace = {'__name__': 'lazy_data'}
+        exec LAZY_DATA in namespace
+        self.patcher.install(namespace)
+        self.assertEqual([], self.patched)
+
+        with self.assertRaises(IndexError):
+            namespace['subscr_binary']()
+        self.assertEqual(['subscr_binary'], self.patched)
+        with self.assertRaises(IndexError):
+            namespace['subscr_binary']()
+        self.assertEqual(['subscr_binary'], self.patched)
+
+    def testIterFunctions(self):
+        namespace = {'__name__': 'lazy_data'}
+        exec LAZY_DATA in namespace
+        names = sorted(f.func_name for f in lazy.iter_functions(namespace))
+        self.assertEqual(['decorated', 'decorator', 'method', 'prop', 'static',
+                          'subscr_binary', 'wrapper'], names)
+
+    def testSharedCode(self):
+        namespace = {'__name__': 'lazy_data'}
+        exec 'def make():\n  def f():\n    return 1\n  return f\n' in namespace
+        namespace['f'] = namespace['make']()
+        namespace['g'] = namespace['make']()
+        self.patcher.install(namespace)
+        self.assertEqual(1, namespace['f']())
+        self.assertEqual(1, namespace['g']())
+        self.assertEqual(['f'], self.patched)
+
+
+class ModuleImporterLazyTest(unittest.TestCase):
+    def testLazy(self):
+        importer = debug_exception.ModuleImporter(lazy=True)
+        importer.uninstall()
+        mod = importer.get_module_from_code(
+            'lazy_data', compile(LAZY_DATA, 'lazy_data.py', 'exec'))
+        del sys.modules['lazy_data']
+        self.assertNotIn('_s_attr', mod.subscr_binary.func_code.co_names)
+
+        for f in (mod.subscr_binary, mod.decorated, mod.Foo.static,
+                  mod.Foo().method, lambda: mod.Foo().prop):
+            with self.assertRaises(IndexError) as ctx:
+                debug_exception.debug_exceptions(f)()
+            self.assertIn('Debug info:\n\tObject: []\n\tObject len: 0\n\tIndex: 0',
+                          str(ctx.exception))
+        self.assertIn('_s_attr', mod.subscr_binary.func_code.co_names)
+
+
+if __name__ == '__main__':
+    unittest.main()
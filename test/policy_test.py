@@ -0,0 +1,138 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import sys
+import unittest
+
+import python_exceptions_improved.asm as asm
+import python_exceptions_improved.debug_exception as debug_exception
+import python_exceptions_improved.hotness as hotness
+import python_exceptions_improved.policy as policy
+
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class InstrumentationPolicyTest(unittest.TestCase):
+    def testDefault(self):
+        p = policy.InstrumentationPolicy()
+        self.assertTrue(p.should_instrument('os', '/usr/lib/python2.7/os.py'))
+        self.assertEqual(asm.FAMILIES, p.families)
+
+    def testInclude(self):
+        p = policy.InstrumentationPolicy(include=['foo', 'bar_*'])
+        self.assertTrue(p.should_instrument('foo', 'foo.py'))
+        self.assertTrue(p.should_instrument('foo.baz', 'foo/baz.py'))
+        self.assertTrue(p.should_instrument('bar_data', 'bar_data.py'))
+        self.assertFalse(p.should_instrument('foobar', 'foobar.py'))
+
+    def testExclude(self):
+        p = policy.InstrumentationPolicy(include=['foo'], exclude=['foo.vendor'])
+        self.assertTrue(p.should_instrument('foo.baz', 'foo/baz.py'))
+        self.assertFalse(p.should_instrument('foo.vendor', 'foo/vendor'))
+        self.assertFalse(p.should_instrument('foo.vendor.x', 'foo/vendor/x.py'))
+
+    def testPaths(self):
+        p = policy.InstrumentationPolicy(paths=['/src/project'])
+        self.assertTrue(p.should_instrument('foo', '/src/project/foo.py'))
+        self.assertTrue(p.should_instrument('project', '/src/project'))
+        self.assertFalse(p.should_instrument('foo', '/src/project2/foo.py'))
+        self.assertFalse(p.should_instrument('os', '/usr/lib/python2.7/os.py'))
+
+    def testUnknownFamily(self):
+        with self.assertRaises(ValueError):
+            policy.InstrumentationPolicy(families=['calls'])
+
+    def testFromEnvironment(self):
+        p = policy.InstrumentationPolicy.from_environment({
+            policy.INCLUDE_ENVIRONMENT_VARIABLE: 'foo, bar',
+            policy.EXCLUDE_ENVIRONMENT_VARIABLE: 'foo.vendor',
+            policy.PATHS_ENVIRONMENT_VARIABLE: os.pathsep.join(['/a', '/b']),
+            policy.OPCODES_ENVIRONMENT_VARIABLE: 'subscripts',
+        })
+        self.assertEqual(['foo', 'bar'], p.include)
+        self.assertEqual(['foo.vendor'], p.exclude)
+        self.assertEqual(['/a/', '/b/'], p.paths)
+        self.assertEqual((asm.SUBSCRIPTS,), p.families)
+
+    def testFromEmptyEnvironment(self):
+        p = policy.InstrumentationPolicy.from_environment({})
+        self.assertEqual([], p.include)
+        self.assertEqual(asm.FAMILIES, p.families)
+
+
+class HotnessPolicyTest(unittest.TestCase):
+    def setUp(self):
+        profile = hotness.Profile({('hot.py', 3, 'f'): 50,
+                                   ('hot.py', 1, '<module>'): 1})
+        self.policy = policy.InstrumentationPolicy(profile=profile,
+                                                   max_calls=10)
+
+    def testShouldSkipCode(self):
+        code = compile('x = 1\n\ndef f():\n    pass\n', 'hot.py', 'exec')
+        f_code = asm.rewriter.Code.from_code(code)
+        nested_code, = [arg for _, arg in f_code.code
+                        if isinstance(arg, asm.rewriter.Code)]
+        self.assertFalse(self.policy.should_skip_code(f_code))
+        self.assertTrue(self.policy.should_skip_code(nested_code))
+        self.assertFalse(policy.InstrumentationPolicy().should_skip_code(
+            nested_code))
+
+    def testFileOptions(self):
+        self.assertEqual(((3, 'f'),), self.policy.get_file_options('hot.py'))
+        self.assertEqual((), self.policy.get_file_options('cold.py'))
+        self.assertEqual(
+            (), policy.InstrumentationPolicy().get_file_options('hot.py'))
+
+    def testImporterSkipsHotCode(self):
+        importer = debug_exception.ModuleImporter(policy=self.policy)
+        importer.uninstall()
+        importer.get_module_from_code('hot_data', compile(
+            'x = {}\n\ndef f(a):\n    return a[0]\n', 'hot.py', 'exec'))
+        del sys.modules['hot_data']
+
+        stats = importer.get_stats()
+        self.assertEqual(['f:3'], stats['modules'][0]['skipped'])
+        self.assertEqual(1, stats['totals']['skipped'])
+        self.assertEqual({asm.ATTRIBUTES: 0, asm.SUBSCRIPTS: 0},
+                         stats['totals']['sites'])
+
+
+class ModuleImporterPolicyTest(unittest.TestCase):
+    def testFindModuleExcluded(self):
+        importer = debug_exception.ModuleImporter(
+            policy=policy.InstrumentationPolicy(exclude=['foo_data']))
+        importer.uninstall()
+        self.assertIsNone(importer.find_module('foo_data', [TEST_DIR]))
+
+    def testFindModuleIncluded(self):
+        importer = debug_exception.ModuleImporter(
+            policy=policy.InstrumentationPolicy(paths=[TEST_DIR]))
+        importer.uninstall()
+        self.assertIs(importer, importer.find_module('foo_data', [TEST_DIR]))
+        self.assertEqual(os.path.join(TEST_DIR, 'foo_data.py'),
+                         importer.specs['foo_data'].origin)
+
+    def testFamilies(self):
+        importer = debug_exception.ModuleImporter(
+            policy=policy.InstrumentationPolicy(families=[asm.SUBSCRIPTS]))
+        importer.uninstall()
+        code = importer.patch_code(compile('a = {}\na.b\na[0]', 'f.py', 'exec'))
+        opcodes = [op for op, _ in asm.rewriter.Code.from_code(code).code]
+        self.assertIn(asm.bytecode.DUP_TOPX, opcodes)
+        self.assertNotIn(asm.bytecode.DUP_TOP, opcodes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sys
+import unittest
+
+import python_exceptions_improved.debug_exception as debug_exception
+import python_exceptions_improved.postmortem as postmortem
+
+
+class Foo(object):
+    def __init__(self):
+        self.name = 'Foo'
+        self.items = [1, 2]
+
+
+def get_debug_vars(f):
+    try:
+        f()
+    except Exception:
+        return postmortem.get_debug_vars(sys.exc_info()[2])
+    raise AssertionError('no exception raised')
+
+
+class PostmortemTest(unittest.TestCase):
+    def testSubscrBinary(self):
+        def f():
+            a = [1, 2]
+            return a[2]
+        self.assertEqual(([1, 2], 2, True, True), get_debug_vars(f))
+
+    def testSubscrStore(self):
+        def f():
+            a = {}
+            b = 'key'
+            a[b] = a['other']
+        self.assertEqual(({}, 'other', True, True), get_debug_vars(f))
+
+    def testSubscrDelete(self):
+        def f():
+            a = {'a': 1}
+            del a['b']
+        self.assertEqual(({'a': 1}, 'b', True, True), get_debug_vars(f))
+
+    def testNestedSubscr(self):
+        def f():
+            a = [1, 2]
+            b = [2, 3, 4]
+            c = 0
+            return a[b[c]]
+        self.assertEqual(([1, 2], 2, True, True), get_debug_vars(f))
+
+    def testComprehension(self):
+        def f():
+            d = {'a': 1}
+            return [d[k] for k in ['a', 'b']]
+        self.assertEqual(({'a': 1}, 'b', True, True), get_debug_vars(f))
+
+    def testAttrChain(self):
+        o = Foo()
+        def f():
+            return o.items[5]
+        self.assertEqual(([1, 2], 5, True, True), get_debug_vars(f))
+
+    def testAttrLoad(self):
+        o = Foo()
+        def f():
+            return o.names
+        self.assertEqual((o, None, True, False), get_debug_vars(f))
+
+    def testAttrStore(self):
+        o = object()
+        def f():
+            o.name = 1
+        self.assertEqual((o, None, True, False), get_debug_vars(f))
+
+    def testCallNotEvaluated(self):
+        calls = []
+        def g():
+            calls.append(1)
+            return []
+        def f():
+            return g()[0]
+        self.assertEqual((None, 0, False, True), get_debug_vars(f))
+        self.assertEqual([1], calls)
+
+    def testNoOperation(self):
+        def f():
+            raise ValueError()
+        self.assertEqual((None, None, False, False), get_debug_vars(f))
+
+
+class PostmortemBackendTest(unittest.TestCase):
+    def tearDown(self):
+        debug_exception.set_backend(debug_exception.INSTRUMENTED)
+
+    def testIndexError(self):
+        debug_exception.set_backend(debug_exception.POSTMORTEM)
+
+        @debug_exception.debug_exceptions
+        def f():
+            a = [1, 2]
+            a[2]
+
+        with self.assertRaises(IndexError) as ctx:
+            f()
+        self.assertIn('Debug info:\n\tObject: [1, 2]\n\tObject len: 2\n\tIndex: 2',
+                      str(ctx.exception))
+
+    def testUnknownBackend(self):
+        with self.assertRaises(ValueError):
+            debug_exception.set_backend('unknown')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import py_compile
+import shutil
+import sys
+import tempfile
+import unittest
+
+import python_exceptions_improved.asm as asm
+import python_exceptions_improved.cache as cache
+import python_exceptions_improved.debug_exception as debug_exception
+import python_exceptions_improved.policy as policy
+import python_exceptions_improved.precompile as precompile
+
+
+def write(path, source):
+    with open(path, 'w') as f:
+        f.write(source)
+
+
+class PrecompileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = cache.CodeCache(os.path.join(self.directory, 'cache'))
+        self.source = os.path.join(self.directory, 'src')
+        os.mkdir(self.source)
+        os.mkdir(os.path.join(self.source, 'aot_pkg'))
+        os.mkdir(os.path.join(self.source, 'not_a_package'))
+        write(os.path.join(self.source, 'aot_mod.py'), 'value = [1][0]\n')
+        write(os.path.join(self.source, 'aot_pkg', '__init__.py'), '')
+        write(os.path.join(self.source, 'aot_pkg', 'sub.py'), 'x = {}\n')
+        write(os.path.join(self.source, 'not_a_package', 'other.py'), '')
+
+    def tearDown(self):
+        for name in ('aot_mod', 'aot_pkg', 'aot_pkg.sub'):
+            sys.modules.pop(name, None)
+        shutil.rmtree(self.directory)
+
+    def testIterModules(self):
+        self.assertEqual(
+            [('aot_mod', os.path.join(self.source, 'aot_mod.py')),
+             ('aot_pkg', os.path.join(self.source, 'aot_pkg', '__init__.py')),
+             ('aot_pkg.sub', os.path.join(self.source, 'aot_pkg', 'sub.py'))],
+            list(precompile.iter_paths([self.source])))
+
+    def testIncremental(self):
+        report = precompile.compile_paths([self.source], self.cache)
+        self.assertEqual(3, report.counts[precompile.COMPILED])
+        self.assertEqual(3, report.files)
+
+        write(os.path.join(self.source, 'aot_mod.py'), 'value = [2][0]\n')
+        report = precompile.compile_paths([self.source], self.cache)
+        self.assertEqual(1, report.counts[precompile.COMPILED])
+        self.assertEqual(2, report.counts[precompile.UP_TO_DATE])
+        self.assertIn(
+            '3 files (1 compiled, 2 up to date, 0 skipped, 0 failed)',
+            report.get_summary())
+
+    def testOptionsArePartOfTheKey(self):
+        precompile.compile_paths([self.source], self.cache)
+        report = precompile.compile_paths([self.source], self.cache,
+                                          capture=asm.CAPTURE_THREAD)
+        self.assertEqual(3, report.counts[precompile.COMPILED])
+
+    def testImporterLoadsPrecompiledCode(self):
+        precompile.compile_paths([self.source], self.cache, jobs=2)
+        importer = debug_exception.ModuleImporter(cache=self.cache)
+        importer.uninstall()
+        path = os.path.join(self.source, 'aot_mod.py')
+        mod = importer.get_module_from_source('aot_mod', path)
+        self.assertEqual(1, mod.value)
+        self.assertEqual('hit', importer.stats[path].cache)
+
+    def testImporterLoadsPrecompiledPackage(self):
+        precompile.compile_paths([self.source], self.cache)
+        path = os.path.join(self.source, 'aot_pkg', '__init__.py')
+        py_compile.compile(path)
+        importer = debug_exception.ModuleImporter(cache=self.cache)
+        importer.uninstall()
+        importer.get_module_from_package('aot_pkg',
+                                         os.path.dirname(path))
+        self.assertEqual('hit', importer.stats[path].cache)
+        self.assertEqual(1, len(importer.stats))
+
+    def testPolicyAndFailures(self):
+        write(os.path.join(self.source, 'broken.py'), 'def f(:\n')
+        calls = []
+        report = precompile.compile_paths(
+            [self.source], self.cache,
+            policy=policy.InstrumentationPolicy(exclude=['aot_pkg']),
+            callback=calls.append)
+        self.assertEqual(1, report.counts[precompile.COMPILED])
+        self.assertEqual(2, report.counts[precompile.SKIPPED])
+        self.assertEqual(
+            [os.path.join(self.source, 'broken.py')],
+            [file_path for file_path, _ in report.failures])
+        self.assertIn('SyntaxError', report.failures[0][1])
+        self.assertEqual(4, len(calls))
+
+
+if __name__ == '__main__':
+    unittest.main()
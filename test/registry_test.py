@@ -0,0 +1,93 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import imp
+import unittest
+
+import python_exceptions_improved.debug_exception as debug_exception
+import python_exceptions_improved.registry as registry
+
+
+def new_module(name, **kwargs):
+    module = imp.new_module(name)
+    vars(module).update(kwargs)
+    return module
+
+
+class Foo(object):
+    pass
+
+
+class OtherFoo(object):
+    pass
+OtherFoo.__name__ = 'Foo'
+
+
+class TypeRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.modules = {
+            '__builtin__': new_module('__builtin__', str=str),
+            'registry_test': new_module('registry_test', Foo=Foo),
+        }
+        self.registry = registry.TypeRegistry(self.modules)
+
+    def testLookup(self):
+        self.assertIs(str, self.registry.lookup('str'))
+        self.assertIs(Foo, self.registry.lookup('Foo'))
+        self.assertIsNone(self.registry.lookup('Bar'))
+
+    def testNewModule(self):
+        self.assertIsNone(self.registry.lookup('Bar'))
+        Bar = type('Bar', (object,), {})
+        self.modules['bar'] = new_module('bar', Bar=Bar)
+        self.assertIs(Bar, self.registry.lookup('Bar'))
+
+    def testModuleChanged(self):
+        self.registry.refresh()
+        Bar = type('Bar', (object,), {})
+        self.modules['registry_test'].Bar = Bar
+        self.assertIs(Bar, self.registry.lookup('Bar'))
+
+    def testMissIsRemembered(self):
+        self.assertIsNone(self.registry.lookup('Bar'))
+        Bar = type('Bar', (object,), {})
+        self.modules['registry_test'].Bar = Bar
+        self.assertIsNone(self.registry.lookup('Bar'))
+        self.modules['other'] = new_module('other')
+        self.assertIs(Bar, self.registry.lookup('Bar'))
+
+    def testRemovedModule(self):
+        self.assertIs(Foo, self.registry.lookup('Foo'))
+        del self.modules['registry_test']
+        self.modules['other'] = new_module('other')
+        self.assertIsNone(self.registry.lookup('Foo'))
+
+    def testResolutionOrder(self):
+        self.modules['a_module'] = new_module('a_module', Foo=OtherFoo)
+        self.registry.refresh()
+        self.assertEqual([Foo, OtherFoo], self.registry.get_candidates('Foo'))
+
+    def testDoesNotLookupAttributes(self):
+        class LazyModule(object):
+            def __getattr__(self, name):
+                raise AssertionError('attribute %s looked up' % name)
+        self.modules['lazy'] = LazyModule()
+        self.assertIs(Foo, self.registry.lookup('Foo'))
+
+    def testNameToClass(self):
+        self.assertIs(registry.TypeRegistry, debug_exception.name_to_class(
+            'TypeRegistry'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+import time
+import unittest
+
+import python_exceptions_improved.render as render
+
+
+class Table(object):
+    """Container whose repr renders all its rows, like a data frame."""
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __nonzero__(self):
+        raise ValueError('The truth value of a Table is ambiguous')
+
+    def __repr__(self):
+        raise AssertionError('repr should not be called')
+
+
+class Record(object):
+    def __repr__(self):
+        raise AssertionError('repr should not be called')
+
+
+class RenderTest(unittest.TestCase):
+    def testSmallObjects(self):
+        for obj in ([1, 2], (1,), (), {'a': [1]}, {}, set(), 'abc', 1, None):
+            self.assertEqual(repr(obj), render.render_repr(obj))
+        self.assertEqual('abc', render.render_str('abc'))
+
+    def testLargeList(self):
+        self.assertEqual('[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, ...] (1000 items)',
+                         render.render_repr(range(1000)))
+
+    def testLargeString(self):
+        rendered = render.render_str('a' * 1000)
+        self.assertTrue(rendered.endswith('... (1000 items)'))
+        self.assertLess(len(rendered), 100)
+
+    def testNested(self):
+        self.assertEqual('[[[[...]]]] (1 items)',
+                         render.render_repr([[[[1]]]]))
+
+    def testSubclass(self):
+        self.assertEqual("OrderedDict({'a': 1})",
+                         render.render_repr(collections.OrderedDict(a=1)))
+
+    def testLargeDictIsBounded(self):
+        large = dict.fromkeys(xrange(10 ** 6))
+        start = time.time()
+        rendered = render.render_repr(large)
+        self.assertLess(time.time() - start, 0.1)
+        self.assertTrue(rendered.endswith('...} (1000000 items)'))
+
+    def testLargeCustomContainer(self):
+        self.assertEqual('Table([0, 1, 2, 3, 4, 5, 6, 7, 8, 9, ...]) '
+                         '(1000000 items)',
+                         render.render_repr(Table(xrange(10 ** 6))))
+        self.assertEqual('Table([])', render.render_repr(Table([])))
+        self.assertEqual('[Table([Table([Table([...])])])] (1 items)',
+                         render.render_repr([Table([Table([Table([1])])])]))
+
+    def testCustomReprIsNotCalled(self):
+        record = Record()
+        self.assertEqual('<%s.Record object at %#x>' % (__name__, id(record)),
+                         render.render_repr(record))
+        self.assertEqual(repr(time), render.render_repr(time))
+
+    def testScalarSubclassReprIsNotCalled(self):
+        calls = []
+
+        class Name(str):
+            def __repr__(self):
+                calls.append(self)
+                raise ValueError('repr should not be called')
+
+        self.assertEqual("'abc'", render.render_repr(Name('abc')))
+        self.assertEqual("['abc']", render.render_repr([Name('abc')]))
+        self.assertEqual([], calls)
+
+    def testAttributes(self):
+        self.assertEqual("['a', 'b']", render.render_attributes(['a', 'b']))
+        attributes = ['a%03d' % i for i in xrange(150)]
+        self.assertTrue(render.render_attributes(attributes).endswith(
+            "'a099'] (50 more)"))
+
+
+class PreviewTest(unittest.TestCase):
+    def testSimilarStringKeys(self):
+        self.assertEqual(['foo'],
+                         render.get_similar_keys({'foo': 1, 'bar': 2}, 'fooo'))
+
+    def testSimilarNumericKeys(self):
+        self.assertEqual([99, 98],
+                         render.get_similar_keys(dict.fromkeys(range(100)),
+                                                 101)[:2])
+
+    def testSimilarKeysNotMapping(self):
+        self.assertEqual([], render.get_similar_keys([1, 2], 3))
+
+    def testNearbyItems(self):
+        self.assertEqual([(8, 8), (9, 9)],
+                         render.get_nearby_items(range(10), 10)[-2:])
+        self.assertEqual([(0, 0), (1, 1)],
+                         render.get_nearby_items(range(10), -11)[:2])
+        self.assertEqual([], render.get_nearby_items([], 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
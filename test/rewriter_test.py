@@ -0,0 +1,234 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import inspect
+import types
+import unittest
+
+try:
+    import byteplay as bp
+except ImportError:
+    bp = None
+
+import python_exceptions_improved.asm as asm
+import python_exceptions_improved.rewriter as rewriter
+
+
+SAMPLE_SOURCE = '''
+"""Docstring."""
+from __future__ import with_statement
+import os
+
+
+class Foo(object):
+    x = {'a': [1, 2]}
+
+    def method(self, *args, **kwargs):
+        try:
+            return self.x['a'][0] + args[0]
+        except (IndexError, KeyError) as e:
+            del self.x['a']
+        finally:
+            kwargs.clear()
+
+
+def closure(items):
+    def inner(i):
+        return items[i].attr
+    return [inner(i) for i in items if i.value], lambda: items[0]
+
+
+def generator(path):
+    with open(path) as f:
+        for line in f:
+            if not line:
+                continue
+            elif line == 'stop':
+                break
+            yield line[:10], os.path.join(path, line)
+    while True:
+        try:
+            pass
+        finally:
+            return
+
+
+def long_function(a):
+    %s
+    return a.b
+''' % '\n    '.join('a%d = a[%d]' % (i, i) for i in xrange(300))
+
+
+def get_corpus():
+    """Returns code objects of the sample, of stdlib and of this package."""
+    codes = [compile(SAMPLE_SOURCE, 'sample.py', 'exec')]
+    for module in (inspect, unittest.case, asm, rewriter):
+        source = inspect.getsource(module)
+        codes.append(compile(source, module.__file__, 'exec'))
+    return codes
+
+
+def from_byteplay(bp_code):
+    """Returns the rewriter.Code with the same instructions as a bp.Code."""
+    labels = {}
+    code = []
+    for op, arg in bp_code.code:
+        if isinstance(op, bp.Label):
+            op = labels.setdefault(op, rewriter.Label())
+        elif op is bp.SetLineno:
+            op = rewriter.SetLineno
+        else:
+            op = int(op)
+            if isinstance(arg, bp.Label):
+                arg = labels.setdefault(arg, rewriter.Label())
+            elif isinstance(arg, bp.Code):
+                arg = from_byteplay(arg)
+        code.append((op, arg))
+    return rewriter.Code(code, bp_code.freevars, bp_code.args,
+                         bp_code.varargs, bp_code.varkwargs,
+                         bp_code.newlocals, bp_code.name, bp_code.filename,
+                         bp_code.firstlineno, bp_code.docstring)
+
+
+def to_byteplay(code):
+    """Returns the bp.Code with the same instructions as a rewriter.Code."""
+    labels = {}
+    bp_code = []
+    for op, arg in code.code:
+        if isinstance(op, rewriter.Label):
+            op = labels.setdefault(op, bp.Label())
+        elif op is rewriter.SetLineno:
+            op = bp.SetLineno
+        else:
+            op = bp.Opcode(op)
+            if isinstance(arg, rewriter.Label):
+                arg = labels.setdefault(arg, bp.Label())
+            elif isinstance(arg, rewriter.Code):
+                arg = to_byteplay(arg)
+        bp_code.append((op, arg))
+    return bp.Code(bp_code, code.freevars, code.args, code.varargs,
+                   code.varkwargs, code.newlocals, code.name, code.filename,
+                   code.firstlineno, code.docstring)
+
+
+def byteplay_patch_code(code, capture):
+    """Patches code as asm.patch_code did with byteplay."""
+    f_code = from_byteplay(bp.Code.from_code(code))
+    asm.add_suggestion_tables(f_code)
+    f_code = asm.patch_rewriter_code(f_code, capture, asm.FAMILIES, None,
+                                     asm.get_module_names(f_code),
+                                     not f_code.newlocals)
+    return to_byteplay(f_code).to_code()
+
+
+def get_instructions(code):
+    """Returns the opcodes and resolved arguments of a code object."""
+    instructions = []
+    for op, arg in rewriter.Code.from_code(code).code:
+        if isinstance(op, rewriter.Label):
+            op = 'label'
+        if isinstance(arg, rewriter.Label):
+            arg = 'label'
+        elif isinstance(arg, rewriter.Code):
+            arg = None
+        instructions.append((op, arg))
+    return instructions
+
+
+ATTRIBUTES = ('co_argcount', 'co_nlocals', 'co_stacksize', 'co_flags',
+              'co_code', 'co_names', 'co_varnames', 'co_filename', 'co_name',
+              'co_firstlineno', 'co_lnotab', 'co_freevars', 'co_cellvars')
+
+
+class RewriterTest(unittest.TestCase):
+    def assertCodeIdentical(self, expected, actual):
+        for attribute in ATTRIBUTES:
+            self.assertEqual(getattr(expected, attribute),
+                             getattr(actual, attribute),
+                             '%s of %s differ' % (attribute, expected.co_name))
+        self.assertEqual(len(expected.co_consts), len(actual.co_consts))
+        for expected_const, actual_const in zip(expected.co_consts,
+                                                actual.co_consts):
+            if isinstance(expected_const, types.CodeType):
+                self.assertCodeIdentical(expected_const, actual_const)
+            elif isinstance(expected_const, tuple):
+                # Like the sites added by asm.CAPTURE_RING.
+                self.assertEqual(expected_const, actual_const)
+            else:
+                self.assertIs(expected_const, actual_const)
+
+    def testRoundTrip(self):
+        for code in get_corpus():
+            roundtrip = rewriter.Code.from_code(code).to_code()
+            self.assertEqual(get_instructions(code),
+                             get_instructions(roundtrip))
+            self.assertEqual(code.co_varnames, roundtrip.co_varnames)
+
+    def testRoundTripKeepsBehaviour(self):
+        namespace = {}
+        exec rewriter.Code.from_code(compile(SAMPLE_SOURCE, 'sample.py',
+                                             'exec')).to_code() in namespace
+        self.assertEqual([1, 2], namespace['Foo'].x['a'])
+        inner = namespace['closure']([])[1]
+        self.assertRaises(IndexError, inner)
+
+    def testExtendedArg(self):
+        source = 'x = (%s)\nx[0]\n' % ', '.join('%d.5' % i
+                                               for i in xrange(70000))
+        code = compile(source, 'big.py', 'exec')
+        namespace = {}
+        exec asm.patch_code(code) in namespace
+        self.assertEqual(0.5, namespace['x'][0])
+
+    def testExtendedJump(self):
+        body = ''.join('        total += items[%d] + item.real\n' % (i % 2)
+                       for i in xrange(3000))
+        source = ('def f(items):\n    total = 0\n    for item in items:\n' +
+                  body + '    return total\n')
+        code = compile(source, 'loop.py', 'exec')
+        patched = asm.patch_code(code)
+        function_code = [const for const in patched.co_consts
+                         if isinstance(const, types.CodeType)][0]
+        self.assertGreater(len(function_code.co_code), 0x10000)
+        namespace = {}
+        exec patched in namespace
+        self.assertEqual(2 * 4500 + 3 * 3000, namespace['f']([1, 2]))
+        self.assertEqual(
+            get_instructions(function_code),
+            get_instructions(rewriter.Code.from_code(function_code).to_code()))
+
+    def testInconsistentStack(self):
+        f_code = rewriter.Code.from_code(compile('a', 'f.py', 'eval'))
+        label = rewriter.Label()
+        f_code.code[1:1] = [(label, None),
+                            (asm.bytecode.POP_JUMP_IF_TRUE, label)]
+        self.assertRaises(ValueError, f_code.get_stacksize)
+
+    def testCountInstructions(self):
+        def f(x):
+            return lambda: x
+        self.assertEqual(5 + 2, rewriter.count_instructions(f.func_code))
+
+    @unittest.skipIf(bp is None, 'byteplay is not installed')
+    def testSameDecodingAsByteplay(self):
+        for code in get_corpus():
+            self.assertCodeIdentical(
+                bp.Code.from_code(code).to_code(),
+                rewriter.Code.from_code(code).to_code())
+
+    @unittest.skipIf(bp is None, 'byteplay is not installed')
+    def testSamePatchingAsByteplay(self):
+        for code in get_corpus():
+            for capture in asm.CAPTURE_MODES:
+                self.assertCodeIdentical(byteplay_patch_code(code, capture),
+                                         asm.patch_code(code, capture))
@@ -0,0 +1,31 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import time
+import unittest
+
+
+class PassingTest(unittest.TestCase):
+    def testPass(self):
+        pass
+
+
+class DyingTest(unittest.TestCase):
+    def testExit(self):
+        os._exit(1)
+
+
+class HangingTest(unittest.TestCase):
+    def testSleep(self):
+        time.sleep(60)
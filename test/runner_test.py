@@ -0,0 +1,126 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import StringIO
+import types
+import unittest
+
+import python_exceptions_improved.asm as asm
+import python_exceptions_improved.debug_exception as debug_exception
+import python_exceptions_improved.runner as runner
+
+
+class RunnerTest(unittest.TestCase):
+    def run_parallel(self, names, verbosity=1):
+        stream = StringIO.StringIO()
+        successful = runner.run_parallel(names, 2, verbosity=verbosity,
+                                         stream=stream)
+        return successful, stream.getvalue()
+
+    def testFailures(self):
+        successful, output = self.run_parallel(['runner_data'])
+        self.assertFalse(successful)
+        self.assertEqual('.EFs', ''.join(sorted(output.splitlines()[0])))
+        self.assertIn('ERROR: testIndexError (runner_data.FailingTest)\n',
+                      output)
+        self.assertIn('IndexError: list index out of range\nDebug info:\n'
+                      '\tObject: [1, 2]\n\tObject len: 2\n\tIndex: 2', output)
+        self.assertIn('FAIL: testFailure (runner_data.FailingTest)\n', output)
+        self.assertIn('Ran 4 tests in ', output)
+        self.assertIn('FAILED (failures=1, errors=1, skipped=1)\n', output)
+
+    def testSuccess(self):
+        successful, output = self.run_parallel(['runner_data.PassingTest'],
+                                               verbosity=2)
+        self.assertTrue(successful)
+        self.assertIn('testPass (runner_data.PassingTest) ... ok\n', output)
+        self.assertIn("testSkip (runner_data.PassingTest) ... skipped "
+                      "'not ready'\n", output)
+        self.assertTrue(output.endswith('\nOK (skipped=1)\n'))
+
+    def testLostGroups(self):
+        stream = StringIO.StringIO()
+        successful = runner.run_parallel(['runner_crash_data'], 2,
+                                         verbosity=2, stream=stream,
+                                         timeout=1)
+        output = stream.getvalue()
+        self.assertFalse(successful)
+        self.assertIn('ERROR: runner_crash_data.DyingTest.testExit\n', output)
+        self.assertIn('Worker process died', output)
+        self.assertIn('ERROR: runner_crash_data.HangingTest.testSleep\n',
+                      output)
+        self.assertIn('Timed out after 1s', output)
+        self.assertIn('testPass (runner_crash_data.PassingTest) ... ok\n',
+                      output)
+        self.assertTrue(output.endswith('\nFAILED (errors=2)\n'))
+
+    def testListTestGroups(self):
+        self.assertEqual(
+            [['runner_data.PassingTest.testPass',
+              'runner_data.PassingTest.testSkip']],
+            runner.list_test_groups(['runner_data.PassingTest']))
+
+    def testCollectingResult(self):
+        result = runner.CollectingResult()
+        test = unittest.FunctionTestCase(lambda: [][0])
+        test.run(result)
+        self.assertEqual(1, len(result.outcomes))
+        kind, _, _, text = result.outcomes[0]
+        self.assertEqual(runner.ERROR, kind)
+        self.assertIn('IndexError', text)
+
+
+class EnrichingTextTestRunnerTest(unittest.TestCase):
+    def setUp(self):
+        debug_exception.set_backend(debug_exception.POSTMORTEM)
+
+    def tearDown(self):
+        debug_exception.set_backend(debug_exception.INSTRUMENTED)
+
+    def run_function(self, f):
+        stream = StringIO.StringIO()
+        result = runner.EnrichingTextTestRunner(stream).run(
+            unittest.FunctionTestCase(f))
+        return result, stream.getvalue()
+
+    def testErrorIsEnriched(self):
+        def f():
+            a = [1, 2]
+            a[2]
+        result, output = self.run_function(f)
+        self.assertEqual(1, len(result.errors))
+        self.assertIn('IndexError: list index out of range\nDebug info:\n'
+                      '\tObject: [1, 2]\n\tObject len: 2\n\tIndex: 2', output)
+
+    def testPassingTestIsNotWrapped(self):
+        def f():
+            self.assertFalse(hasattr(f, 'debug_exceptions'))
+        result, _ = self.run_function(f)
+        self.assertTrue(result.wasSuccessful())
+
+    def testRingIsClearedAfterTest(self):
+        def g(a):
+            return a[0]
+        patched = types.FunctionType(
+            asm.patch_code(g.func_code, asm.CAPTURE_RING), g.func_globals)
+
+        def f():
+            patched([1])
+            self.assertEqual(1, len(asm.get_ring_captures()))
+        result, _ = self.run_function(f)
+        self.assertTrue(result.wasSuccessful())
+        self.assertEqual([], asm.get_ring_captures())
+
+
+if __name__ == '__main__':
+    unittest.main()
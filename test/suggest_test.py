@@ -0,0 +1,128 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import __builtin__
+import difflib
+import unittest
+
+import python_exceptions_improved.suggest as suggest
+
+
+def brute_force(name, names):
+    def similar(x):
+        a = name.lower().replace('_', '')
+        b = x.lower().replace('_', '')
+        return difflib.SequenceMatcher(a=a, b=b).ratio() >= 0.75
+    return [x for x in names if similar(x)]
+
+
+class BoundedIndelDistanceTest(unittest.TestCase):
+    def testDistance(self):
+        self.assertEqual(0, suggest.bounded_indel_distance('abc', 'abc', 2))
+        self.assertEqual(1, suggest.bounded_indel_distance('abc', 'abcd', 2))
+        self.assertEqual(2, suggest.bounded_indel_distance('abc', 'abd', 2))
+        self.assertEqual(2, suggest.bounded_indel_distance('', 'ab', 2))
+
+    def testEarlyExit(self):
+        self.assertEqual(3, suggest.bounded_indel_distance('abc', 'xyz', 2))
+        self.assertEqual(2, suggest.bounded_indel_distance('a', 'abcdef', 1))
+
+
+class SuggestionIndexTest(unittest.TestCase):
+    def testSuggest(self):
+        index = suggest.SuggestionIndex(dir(str))
+        self.assertEqual(['islower', 'lower'], index.suggest('Lower'))
+        self.assertEqual([], index.suggest('foo'))
+
+    def testDuplicates(self):
+        index = suggest.SuggestionIndex(['foo', 'bar', 'foo'])
+        self.assertEqual(['foo'], index.suggest('fooo'))
+
+    def testMatchesSequenceMatcher(self):
+        names = sorted(set(dir(__builtin__) + dir(str) + dir(dict) +
+                           dir(unittest.TestCase)))
+        index = suggest.SuggestionIndex(names)
+        queries = names[::7] + ['Lower', 'asertEqual', 'assertEquals_', 'x', '',
+                           '__init', 'setdefalt', 'ValueErorr', 'lenn']
+        for query in queries:
+            self.assertEqual(brute_force(query, names), index.suggest(query),
+                             query)
+
+
+class LRUCacheTest(unittest.TestCase):
+    def testEviction(self):
+        cache = suggest.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual({'size': 2, 'hits': 3, 'misses': 1, 'hit_rate': 0.75},
+                         cache.get_stats())
+
+
+class Foo(object):
+    def lower(self):
+        pass
+
+
+class AttributeSuggestionsTest(unittest.TestCase):
+    def setUp(self):
+        self.suggestions = suggest.AttributeSuggestions()
+
+    def testCached(self):
+        self.assertEqual(['islower', 'lower'],
+                         self.suggestions.get_similar_attributes('', 'Lower'))
+        self.assertEqual(['islower', 'lower'],
+                         self.suggestions.get_similar_attributes('a', 'Lower'))
+        self.assertEqual(dir(str), self.suggestions.dir('a'))
+        stats = self.suggestions.get_stats()
+        self.assertEqual(1, stats['suggestions']['hits'])
+        self.assertEqual(1, stats['suggestions']['misses'])
+        self.assertEqual(0.5, stats['suggestions']['hit_rate'])
+
+    def testInvalidation(self):
+        class Bar(Foo):
+            pass
+        self.assertEqual(['lower'],
+                         self.suggestions.get_similar_attributes(Bar, 'Lower'))
+        Foo.slower = None
+        try:
+            self.assertEqual(['lower', 'slower'],
+                             self.suggestions.get_similar_attributes(Bar, 'Lower'))
+            self.assertIn('slower', self.suggestions.dir(Bar))
+        finally:
+            del Foo.slower
+        self.assertEqual(['lower'],
+                         self.suggestions.get_similar_attributes(Bar, 'Lower'))
+
+    def testInstance(self):
+        foo = Foo()
+        foo.flower = 1
+        self.assertEqual(dir(foo), self.suggestions.dir(foo))
+        self.assertEqual(['flower', 'lower'],
+                         self.suggestions.get_similar_attributes(foo, 'Lower'))
+        self.assertEqual(['lower'],
+                         self.suggestions.get_similar_attributes(Foo(), 'Lower'))
+
+    def testModule(self):
+        self.assertEqual(dir(suggest), self.suggestions.dir(suggest))
+        self.assertEqual(['normalize'],
+                         self.suggestions.get_similar_attributes(suggest,
+                                                                 'normalise'))
+
+
+if __name__ == '__main__':
+    unittest.main()
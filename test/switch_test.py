@@ -0,0 +1,169 @@
+# Copyright 2013-2014 Sebastian Kreft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import signal
+import sys
+import unittest
+
+import python_exceptions_improved.debug_exception as debug_exception
+import python_exceptions_improved.switch as switch
+
+
+SOURCE = '''
+def f(a):
+    return a[0]
+
+class Foo(object):
+    def method(self):
+        return self.value
+'''
+
+
+class TogglingFunction(object):
+    """Stand-in for a function toggling its switch when its code is set.
+
+    The first of them whose code is set toggles the switch, as the signal
+    handler could while the switch is updating the functions.
+    """
+    def __init__(self, code_switch, func_code, toggles):
+        self.code_switch = code_switch
+        self.code = func_code
+        self.toggles = toggles
+
+    @property
+    def func_code(self):
+        return self.code
+
+    @func_code.setter
+    def func_code(self, code):
+        self.code = code
+        if not self.toggles:
+            self.toggles.append(code)
+            self.code_switch.toggle()
+
+
+class CodeSwitchTest(unittest.TestCase):
+    def setUp(self):
+        self.switch = switch.CodeSwitch()
+        self.namespace = {'__name__': 'switch_data'}
+        exec SOURCE in self.namespace
+        self.original_code = self.namespace['f'].func_code
+        self.patched_code = compile('def f(a):\n    return a\n', 'patched.py',
+                                    'exec').co_consts[0]
+
+    def testRegister(self):
+        f = self.namespace['f']
+        self.switch.register(f, self.patched_code)
+        self.assertIs(self.patched_code, f.func_code)
+        self.assertEqual([1], f([1]))
+
+        self.switch.disable()
+        self.assertIs(self.original_code, f.func_code)
+        self.assertEqual(1, f([1]))
+
+        self.switch.toggle()
+        self.assertTrue(self.switch.enabled)
+        self.assertIs(self.patched_code, f.func_code)
+
+    def testRegisterDisabled(self):
+        self.switch.disable()
+        f = self.namespace['f']
+        self.switch.register(f, self.patched_code)
+        self.assertIs(self.original_code, f.func_code)
+        self.switch.enable()
+        self.assertIs(self.patched_code, f.func_code)
+
+    def testRegisterNamespace(self):
+        patched = []
+
+        def patch(code):
+            patched.append(code.co_name)
+            return code
+        self.switch.register_namespace(self.namespace, patch)
+        self.assertEqual(['f', 'method'], sorted(patched))
+        self.assertEqual(2, len(self.switch))
+
+    def testWeakReferences(self):
+        f = self.namespace.pop('f')
+        self.switch.register(f, self.patched_code)
+        self.assertEqual(1, len(self.switch))
+        del f
+        self.assertEqual(0, len(self.switch))
+
+    def testSignalHandler(self):
+        previous = switch.install_signal_handler(signal.SIGUSR1, self.switch)
+        try:
+            os.kill(os.getpid(), signal.SIGUSR1)
+            self.assertFalse(self.switch.enabled)
+            os.kill(os.getpid(), signal.SIGUSR1)
+            self.assertTrue(self.switch.enabled)
+        finally:
+            signal.signal(signal.SIGUSR1, previous)
+
+    def testToggleWhileSwitching(self):
+        self.switch.disable()
+        toggles = []
+        functions = [TogglingFunction(self.switch, self.original_code, toggles)
+                     for _ in xrange(3)]
+        for function in functions:
+            self.switch.register(function, self.patched_code)
+        self.switch.enable()
+        self.assertEqual(1, len(toggles))
+        self.assertFalse(self.switch.enabled)
+        for function in functions:
+            self.assertIs(self.original_code, function.func_code)
+
+    def testEnvironment(self):
+        self.assertTrue(switch.is_enabled_in_environment({}))
+        self.assertTrue(switch.is_enabled_in_environment(
+            {switch.ENABLED_ENVIRONMENT_VARIABLE: '1'}))
+        for value in ('0', 'false', 'No', ' off '):
+            self.assertFalse(switch.is_enabled_in_environment(
+                {switch.ENABLED_ENVIRONMENT_VARIABLE: value}))
+
+
+class SwitchableImporterTest(unittest.TestCase):
+    def tearDown(self):
+        switch.enable()
+
+    def testSwitch(self):
+        importer = debug_exception.ModuleImporter(switchable=True)
+        importer.uninstall()
+        code = compile(SOURCE, 'switch_data.py', 'exec')
+        mod = importer.get_module_from_code('switch_data', code)
+        del sys.modules['switch_data']
+
+        self.assertIn('_s_attr', mod.f.func_code.co_names)
+        with self.assertRaises(IndexError) as ctx:
+            debug_exception.debug_exceptions(mod.f)([])
+        self.assertIn('Debug info:\n\tObject: []', str(ctx.exception))
+
+        switch.disable()
+        self.assertNotIn('_s_attr', mod.f.func_code.co_names)
+        self.assertNotIn('_s_attr', mod.Foo.method.func_code.co_names)
+        # The operands are then recovered from the frame.
+        with self.assertRaises(IndexError) as ctx:
+            debug_exception.debug_exceptions(mod.f)([])
+        self.assertIn('Debug info:\n\tObject: []', str(ctx.exception))
+
+        switch.enable()
+        self.assertIn('_s_attr', mod.f.func_code.co_names)
+
+    def testLazy(self):
+        with self.assertRaises(ValueError):
+            debug_exception.ModuleImporter(lazy=True, switchable=True)
+
+
+if __name__ == '__main__':
+    unittest.main()